@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Read-only JSON API: the user directory, single users, and a user's message wall.
+
+Every resource has cheap validators (an ETag and a Last-Modified time) computed from
+`updated_at` maxima and row counts with aggregate queries, so a client polling with
+`If-None-Match` gets a `304` before any rows are loaded or serialized. Counts are part of
+the ETag because deleting a row changes them but not any remaining `updated_at`; for the
+same reason only single users answer `If-Modified-Since`, collections compare ETags.
+
+Rows are read with `only()` the columns that are serialized (no passwords, no counters).
+"""
+from __future__ import unicode_literals
+import hashlib
+from calendar import timegm
+from collections import OrderedDict
+from django.db.models import Count, Max
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from .models import User, Message, Comment, ArchivedMessage, ArchivedComment, MESSAGE_TIERS
+from .pagination import keyset_paginate, tiered_paginate
+
+USER_FIELDS = ["id", "first_name", "last_name", "email", "description", "user_level", "created_at", "updated_at"]
+MESSAGE_FIELDS = ["id", "sender_id", "description", "created_at", "updated_at"]
+COMMENT_FIELDS = ["id", "message_id", "sender_id", "description", "created_at", "updated_at"]
+
+
+class Validators(object):
+    """
+    Creates instances of `Validators`, the ETag and Last-Modified time of a resource.
+
+    Parameters:
+    - `parts` - Values identifying the resource's current state (hashed into the ETag).
+    - `last_modified` - Latest `updated_at` in the resource (None if it is empty).
+    - `collection` - True if rows can be deleted from the resource without changing `last_modified`.
+    """
+
+    def __init__(self, parts, last_modified, collection=True):
+        self.etag = 'W/"{}"'.format(hashlib.md5(":".join(unicode(part) for part in parts).encode("utf-8")).hexdigest())
+        self.last_modified = timegm(last_modified.utctimetuple()) if last_modified else None
+        self.collection = collection
+
+
+def user_list_validators():
+    """Returns the `Validators` of the user directory."""
+
+    state = User.objects.aggregate(count=Count("id"), last=Max("updated_at"))
+    return Validators(["users", state["count"], state["last"]], state["last"])
+
+def user_validators(user_id):
+    """Returns the `Validators` of one user, or None if there is no such user."""
+
+    updated_at = User.objects.filter(id=user_id).values_list("updated_at", flat=True).first()
+    if updated_at is None:
+        return None
+    return Validators(["user", user_id, updated_at], updated_at, collection=False)
+
+def wall_validators(receiver_id):
+    """Returns the `Validators` of a user's message wall, or None if there is no such user."""
+
+    if not User.objects.filter(id=receiver_id).exists():
+        return None
+    messages = Message.objects.filter(receiver_id=receiver_id, sender__deleted_at__isnull=True).aggregate(count=Count("id"), last=Max("updated_at"))
+    comments = Comment.objects.filter(receiver_id=receiver_id, sender__deleted_at__isnull=True).aggregate(count=Count("id"), last=Max("updated_at"))
+    # Archived rows no longer change, but they can be deleted (with their sender), which only shows in their counts:
+    archived_messages = ArchivedMessage.objects.filter(receiver_id=receiver_id, sender__deleted_at__isnull=True).count()
+    archived_comments = ArchivedComment.objects.filter(receiver_id=receiver_id, sender__deleted_at__isnull=True).count()
+    # A wall can have messages but no comments (datetimes do not compare with None):
+    last_modified = max([last for last in (messages["last"], comments["last"]) if last is not None] or [None])
+    return Validators(["wall", receiver_id, messages["count"], messages["last"], comments["count"], comments["last"], archived_messages, archived_comments], last_modified)
+
+def serialize(obj, fields):
+    """Returns the given fields of a model instance as an ordered dictionary (datetimes as ISO strings)."""
+
+    data = OrderedDict()
+    for field in fields:
+        value = getattr(obj, field)
+        data[field] = value.isoformat() if hasattr(value, "isoformat") else value
+    return data
+
+def user_list(page_size, after=None, before=None):
+    """Returns one keyset page of the user directory, ordered by last name."""
+
+    page = keyset_paginate(User.objects.only(*USER_FIELDS), ["last_name", "id"], page_size, after=after, before=before)
+    return OrderedDict([
+        ("users", [serialize(user, USER_FIELDS) for user in page.items]),
+        ("next_cursor", page.next_cursor),
+        ("prev_cursor", page.prev_cursor),
+    ])
+
+def user_detail(user_id):
+    """Returns one user."""
+
+    return serialize(User.objects.only(*USER_FIELDS).get(id=user_id), USER_FIELDS)
+
+def wall(receiver_id, page_size, after=None):
+    """
+    Returns one keyset page of a user's received messages, newest first, each with its comments (oldest first).
+
+    Comments are loaded for the whole page in one query (per tier, on pages reaching archived
+    messages); senders are ids (see `user_detail()`).
+    """
+
+    # Messages and comments of users being removed are hidden (see `UserManager.schedule_removal()`):
+    tiers = [(message_model.objects.filter(receiver_id=receiver_id, sender__deleted_at__isnull=True).only(*MESSAGE_FIELDS), comment_model) for message_model, comment_model in MESSAGE_TIERS]
+    page = tiered_paginate([messages for messages, comment_model in tiers], ["-created_at", "-id"], page_size, after=after)
+    comments = {}
+    for messages, comment_model in tiers:
+        message_ids = [message.id for message in page.items if isinstance(message, messages.model)]
+        if not message_ids:
+            continue
+        for comment in comment_model.objects.filter(message_id__in=message_ids, sender__deleted_at__isnull=True).only(*COMMENT_FIELDS).order_by("created_at", "id"):
+            comments.setdefault(comment.message_id, []).append(serialize(comment, COMMENT_FIELDS))
+    messages = []
+    for message in page.items:
+        data = serialize(message, MESSAGE_FIELDS)
+        data["comments"] = comments.get(message.id, [])
+        messages.append(data)
+    return OrderedDict([
+        ("messages", messages),
+        ("next_cursor", page.next_cursor),
+    ])
+
+def conditional_json(request, validators, build):
+    """
+    Returns a `304` if the client's copy is current, else the JSON built by `build()`.
+
+    Parameters:
+    - `request` - Current request.
+    - `validators` - `Validators` of the requested resource.
+    - `build` - Function returning the response data; only called on a miss.
+    """
+
+    # Deletions do not move a collection's Last-Modified time, so only its ETag may answer:
+    last_modified = None if validators.collection else validators.last_modified
+    response = get_conditional_response(request, etag=validators.etag, last_modified=last_modified)
+    if response is None:
+        response = JsonResponse(build())
+    response["ETag"] = validators.etag
+    if validators.last_modified is not None:
+        response["Last-Modified"] = http_date(validators.last_modified)
+    # Data is behind a login; clients may keep it, but must revalidate each time:
+    response["Cache-Control"] = "private, no-cache"
+    return response
@@ -2,7 +2,17 @@
 from __future__ import unicode_literals
 
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class DashboardConfig(AppConfig):
-    name = 'dashboard'
+    name = 'apps.dashboard'
+    label = 'dashboard'
+
+    def ready(self):
+        from .database import configure_connection
+        # Apply the SQLite connection profile to every new connection:
+        connection_created.connect(configure_connection, dispatch_uid="dashboard.configure_connection")
+        from .perf import instrument_connection
+        # Count and time queries of sampled requests (see `./perf.py`):
+        connection_created.connect(instrument_connection, dispatch_uid="dashboard.instrument_connection")
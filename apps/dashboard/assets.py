@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+Static asset bundles: build step, template tags and a precompressed file handler.
+
+`python manage.py build_assets` concatenates each bundle in `ASSET_BUNDLES` from the
+minified vendor files (and our own, lightly minified, CSS), names it by a hash of its
+content, eg: `dashboard/css/vendor.3f9c1e0b2a4d.css`, and writes `.gz` (and, with the
+`brotli` package, `.br`) variants next to it. Files referenced from CSS (Bootstrap's
+fonts) are copied under hashed names too, and the CSS is rewritten to point at them.
+A `manifest.json` in `ASSET_ROOT` maps bundle names to the built files.
+
+Rebuilds write next to the files of earlier builds, which stay listed (and served): pages
+rendered before the build, in caches or open in browsers, still point at them. Running
+processes reload the manifest when it changes. `python manage.py prune_assets` deletes files
+no build has produced for `ASSET_KEEP_DAYS`.
+
+Templates load bundles with `{% asset_tags "dashboard/js/vendor.js" %}` (see
+`templatetags/dashboard_assets.py`): one tag for the built bundle, or one tag per source
+file when the bundle has not been built (eg: in development and tests).
+
+`StaticAssetMiddleware` serves built files, and only those, straight from `ASSET_ROOT`:
+the `.br` or `.gz` variant when the client accepts it, with far-future `immutable`
+cache headers (a changed file gets a new name, so cached copies never go stale).
+
+Settings (see `user_dashboard/settings.py`):
+- `ASSET_BUNDLES` - Bundle name -> list of source files (static paths), in order.
+- `ASSET_ROOT` - Directory the build writes to.
+- `ASSET_KEEP_DAYS` - Days files of earlier builds are kept by `prune_assets`.
+"""
+from __future__ import unicode_literals
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import threading
+import time
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.http import FileResponse
+from django.templatetags.static import static
+
+try:
+    import brotli # optional, adds `.br` variants
+except ImportError:
+    brotli = None
+
+MANIFEST_NAME = "manifest.json"
+HASH_LENGTH = 12
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Precompressed variants, preferred first: (Accept-Encoding token, file suffix):
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+MIN_COMPRESSION = 0.95 # variants are only kept if smaller than this share of the original
+CSS_URL_REGEX = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+CSS_COMMENT_REGEX = re.compile(r"/\*(?!!).*?\*/", re.S) # keeps /*! license */ comments
+CSS_SPACE_REGEX = re.compile(r"\s*([{};,>])\s*") # not ":", "a :hover" differs from "a:hover"
+SOURCE_MAP_REGEX = re.compile(r"^[/*#@ ]*sourceMappingURL=.*$", re.M)
+mimetypes.add_type("font/woff2", ".woff2")
+mimetypes.add_type("font/woff", ".woff")
+
+
+def hashed_name(path, content):
+    """Returns `path` with a hash of `content` before its extension."""
+
+    root, extension = posixpath.splitext(path)
+    return "{}.{}{}".format(root, hashlib.md5(content).hexdigest()[:HASH_LENGTH], extension)
+
+def minify_css(css):
+    """Strips comments and redundant whitespace from CSS (conservatively, for our own small files)."""
+
+    css = CSS_COMMENT_REGEX.sub("", css)
+    css = CSS_SPACE_REGEX.sub(r"\1", css)
+    return re.sub(r"\s+", " ", css).replace(";}", "}").strip()
+
+def read_source(path):
+    """Returns the text of a static source file, found with the staticfiles finders."""
+
+    found = finders.find(path)
+    if not found:
+        raise IOError("Static file not found: {}".format(path))
+    with io.open(found, encoding="utf-8") as source:
+        return source.read()
+
+
+def write_file(target, content):
+    """Writes `content` to `target` through a temporary file, so readers never see it half written."""
+
+    with open(target + ".tmp", "wb") as output:
+        output.write(content)
+    os.rename(target + ".tmp", target)
+
+def read_manifest(root):
+    """Returns the manifest in `root`, or None if nothing was built."""
+
+    try:
+        with io.open(os.path.join(root, MANIFEST_NAME), encoding="utf-8") as manifest:
+            data = json.load(manifest)
+    except (IOError, OSError, ValueError):
+        return None
+    if isinstance(data["files"], list):
+        # Manifests written before files were kept across builds:
+        data["files"] = dict.fromkeys(data["files"], 0)
+    return data
+
+def write_manifest(root, manifest):
+    write_file(os.path.join(root, MANIFEST_NAME), json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+
+
+class AssetBuilder(object):
+    """
+    Creates instances of an `AssetBuilder`, which writes hashed, precompressed bundles to `root`.
+
+    Parameters:
+    - `root` - Output directory (files of earlier builds are kept).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.built_at = int(time.time())
+        self.manifest = {"bundles": {}, "files": []}
+
+    def build(self, bundles):
+        """Builds every bundle, writes the manifest and returns it."""
+
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        for name, sources in bundles.items():
+            self.manifest["bundles"][name] = self.build_bundle(name, sources)
+        # Files of earlier builds stay listed, so they are still served (see `prune()`):
+        previous = read_manifest(self.root)
+        files = previous["files"] if previous is not None else {}
+        files.update(dict.fromkeys(self.manifest["files"], self.built_at))
+        self.manifest["files"] = files
+        self.manifest["built_at"] = self.built_at
+        write_manifest(self.root, self.manifest)
+        return self.manifest
+
+    def build_bundle(self, name, sources):
+        """Concatenates the sources of one bundle and writes it, returning the built file's path."""
+
+        parts = []
+        for source in sources:
+            text = SOURCE_MAP_REGEX.sub("", read_source(source)) # maps are not shipped
+            if name.endswith(".css"):
+                if not source.endswith(".min.css"):
+                    text = minify_css(text)
+                text = self.rewrite_css_urls(text, source, name)
+            parts.append(text.strip())
+        # `;` guards against a script that does not end its last statement:
+        separator = "\n" if name.endswith(".css") else "\n;\n"
+        return self.write(name, separator.join(parts).encode("utf-8"))
+
+    def rewrite_css_urls(self, css, source, bundle):
+        """Copies files referenced by `url()` in `source` under hashed names and points the CSS at them."""
+
+        def replace(match):
+            url = match.group(2)
+            if url.startswith(("data:", "http:", "https:", "//", "/", "#")):
+                return match.group(0)
+            path, suffix = re.match(r"([^?#]*)(.*)", url).groups()
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(source), path))
+            found = finders.find(target)
+            if not found:
+                return match.group(0)
+            with open(found, "rb") as referenced:
+                built = self.write(target, referenced.read())
+            return "url({}{})".format(posixpath.relpath(built, posixpath.dirname(bundle)), suffix)
+
+        return CSS_URL_REGEX.sub(replace, css)
+
+    def write(self, path, content):
+        """Writes `content` under its hashed name, with precompressed variants, returning that name."""
+
+        built = hashed_name(path, content)
+        if built in self.manifest["files"]:
+            return built
+        self.manifest["files"].append(built)
+        target = os.path.join(self.root, *built.split("/"))
+        if os.path.exists(target):
+            # Built before: same name, same content (and it may be being served right now):
+            return built
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        # mtime=0 keeps rebuilds of unchanged files byte for byte identical:
+        buffer = io.BytesIO()
+        with gzip.GzipFile(filename="", mode="wb", fileobj=buffer, compresslevel=9, mtime=0) as compressed:
+            compressed.write(content)
+        variants = [(".gz", buffer.getvalue())]
+        if brotli is not None:
+            variants.append((".br", brotli.compress(content)))
+        for suffix, compressed in variants:
+            # Already compressed formats (eg: woff2) are left alone:
+            if len(compressed) < len(content) * MIN_COMPRESSION:
+                write_file(target + suffix, compressed)
+        # The file itself last, so a file that exists has its variants:
+        write_file(target, content)
+        return built
+
+
+def prune(root, max_age):
+    """
+    Deletes built files that no build has produced for `max_age` seconds, returning their names.
+
+    Files of the latest build are always kept.
+    """
+
+    manifest = read_manifest(root)
+    if manifest is None:
+        return []
+    oldest = time.time() - max_age
+    pruned = sorted(name for name, built_at in manifest["files"].items() if built_at < oldest and built_at != manifest.get("built_at"))
+    for name in pruned:
+        del manifest["files"][name]
+    # Unlisted first, so no process serves a file being deleted:
+    write_manifest(root, manifest)
+    for name in pruned:
+        target = os.path.join(root, *name.split("/"))
+        for suffix in [""] + [suffix for token, suffix in ENCODINGS]:
+            try:
+                os.remove(target + suffix)
+            except OSError:
+                pass
+    return pruned
+
+
+_manifests = {} # root -> (mtime, manifest)
+_manifests_lock = threading.Lock()
+
+def load_manifest():
+    """Returns the manifest in `ASSET_ROOT` (loaded again whenever its mtime changes), or None if nothing was built."""
+
+    root = settings.ASSET_ROOT
+    try:
+        mtime = os.stat(os.path.join(root, MANIFEST_NAME)).st_mtime
+    except OSError:
+        mtime = None
+    with _manifests_lock:
+        if root not in _manifests or _manifests[root][0] != mtime:
+            _manifests[root] = (mtime, read_manifest(root) if mtime is not None else None)
+        return _manifests[root][1]
+
+def reset():
+    """Forgets loaded manifests, eg: after a build."""
+
+    with _manifests_lock:
+        _manifests.clear()
+
+def bundle_urls(name):
+    """Returns the URLs to load bundle `name`: the built file, or its sources if it was not built."""
+
+    manifest = load_manifest()
+    if manifest is not None and name in manifest["bundles"]:
+        return [static(manifest["bundles"][name])]
+    return [static(source) for source in settings.ASSET_BUNDLES[name]]
+
+
+class StaticAssetMiddleware(object):
+    """Serves built asset files from `ASSET_ROOT`, precompressed, with immutable cache headers."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.method in ("GET", "HEAD") and request.path.startswith(settings.STATIC_URL):
+            manifest = load_manifest()
+            path = request.path[len(settings.STATIC_URL):]
+            if manifest is not None and path in manifest["files"]:
+                return self.serve(request, path)
+        return self.get_response(request)
+
+    def serve(self, request, path):
+        """Returns a response with the best variant of built file `path` that the client accepts."""
+
+        filename = os.path.join(settings.ASSET_ROOT, *path.split("/"))
+        accepted = [token.split(";")[0].strip() for token in request.META.get("HTTP_ACCEPT_ENCODING", "").split(",")]
+        encoding = None
+        for token, suffix in ENCODINGS:
+            if token in accepted and os.path.exists(filename + suffix):
+                filename, encoding = filename + suffix, token
+                break
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type == "application/javascript":
+            content_type += "; charset=utf-8"
+        response = FileResponse(open(filename, "rb"), content_type=content_type)
+        response["Content-Length"] = os.path.getsize(filename)
+        if encoding:
+            response["Content-Encoding"] = encoding
+        response["Vary"] = "Accept-Encoding"
+        response["Cache-Control"] = CACHE_CONTROL
+        return response
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Shared helpers for the dashboard's benchmark management commands: dataset seeding,
+latency summaries and JSON reports that can be compared between runs.
+"""
+from __future__ import unicode_literals
+import json
+import math
+import os
+import random
+import shutil
+import string
+import tempfile
+from datetime import datetime
+from django.core.management import call_command
+from django.db import connections, transaction
+from .models import User, Message, Comment, update_counters
+from . import hashing
+
+SEED_BATCH_SIZE = 500 # rows per `bulk_create()` while seeding
+
+def use_throwaway_database():
+    """
+    Points the default database at a fresh, migrated SQLite file, so benchmarks never touch real data.
+
+    Returns the temporary directory to pass to `drop_throwaway_database()` afterwards.
+    """
+
+    temp_dir = tempfile.mkdtemp(prefix="benchmark-")
+    connections["default"].close()
+    connections.databases["default"]["NAME"] = os.path.join(temp_dir, "benchmark.sqlite3")
+    call_command("migrate", interactive=False, verbosity=0)
+    return temp_dir
+
+def drop_throwaway_database(temp_dir):
+    """Closes the connection to a throwaway database and deletes it."""
+
+    connections["default"].close()
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+def letters(number):
+    """Returns a distinct letters-only name of at least two letters for `number` (names must pass validation)."""
+
+    number += 26 # skip the single letter names
+    name = ""
+    while True:
+        number, remainder = divmod(number, 26)
+        name = string.ascii_lowercase[remainder] + name
+        if number == 0:
+            return name.capitalize()
+        number -= 1
+
+def seed(users, messages, comments, password, tag="", admins=1):
+    """
+    Seeds `users` users, `messages` messages received per user and `comments` comments per message.
+
+    Every seeded user shares one password, hashed once. Emails are `bench{tag}.{n}@example.com`.
+
+    Parameters:
+    - `users` - Number of users to create.
+    - `messages` - Messages received per user (from random senders).
+    - `comments` - Comments per message (from random senders).
+    - `password` - Plain text password for every seeded user.
+    - `tag` - Run tag kept in emails, so repeated seeding into one database does not collide.
+    - `admins` - Number of seeded users (the first ones) made admins.
+
+    Returns the list of seeded user ids.
+    """
+
+    hashed = hashing.hash_password(password)
+    with transaction.atomic():
+        created = [User(first_name="Bench", last_name=letters(number), email="bench{}.{}@example.com".format(tag, number), password=hashed, user_level=1 if number < admins else 0) for number in range(users)]
+        for start in range(0, len(created), SEED_BATCH_SIZE):
+            User.objects.bulk_create(created[start:start + SEED_BATCH_SIZE])
+        # `bulk_create()` does not set ids on SQLite, read them back:
+        user_ids = list(User.objects.filter(email__startswith="bench{}.".format(tag)).order_by("id").values_list("id", flat=True))
+
+        pending = []
+        for receiver_id in user_ids:
+            for number in range(messages):
+                pending.append(Message(description="Benchmark message {}".format(number), sender_id=random.choice(user_ids), receiver_id=receiver_id))
+            if len(pending) >= SEED_BATCH_SIZE:
+                Message.objects.bulk_create(pending)
+                update_counters(messages=[(message.sender_id, message.receiver_id) for message in pending])
+                pending = []
+        Message.objects.bulk_create(pending)
+        update_counters(messages=[(message.sender_id, message.receiver_id) for message in pending])
+
+        if comments:
+            pending = []
+            for message_id, receiver_id in Message.objects.filter(receiver_id__in=user_ids).values_list("id", "receiver_id").iterator():
+                for number in range(comments):
+                    pending.append(Comment(description="Benchmark comment {}".format(number), sender_id=random.choice(user_ids), receiver_id=receiver_id, message_id=message_id))
+                if len(pending) >= SEED_BATCH_SIZE:
+                    Comment.objects.bulk_create(pending)
+                    update_counters(comments=[(comment.sender_id, comment.message_id) for comment in pending])
+                    pending = []
+            Comment.objects.bulk_create(pending)
+            update_counters(comments=[(comment.sender_id, comment.message_id) for comment in pending])
+    return user_ids
+
+def percentile(values, percent):
+    """
+    Returns the nearest-rank percentile of `values`.
+
+    Parameters:
+    - `values` - Sorted list of numbers.
+    - `percent` - Percentile to return, 0-100.
+    """
+
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+def summarize(latencies, elapsed=None):
+    """
+    Returns count, mean and p50/p95/p99 (in milliseconds) of a list of latencies in seconds.
+
+    Parameters:
+    - `latencies` - Latencies in seconds.
+    - `elapsed` - Wall clock seconds the samples were taken over (adds a per-second rate).
+    """
+
+    values = sorted(round(latency * 1000, 3) for latency in latencies)
+    summary = {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values), 3) if values else None,
+        "p50_ms": percentile(values, 50),
+        "p95_ms": percentile(values, 95),
+        "p99_ms": percentile(values, 99),
+    }
+    if elapsed:
+        summary["per_sec"] = round(len(values) / elapsed, 2)
+    return summary
+
+def write_report(path, report):
+    """
+    Saves a benchmark report as JSON, stamped with the time it was written.
+
+    Parameters:
+    - `path` - File to write.
+    - `report` - Dictionary of results.
+    """
+
+    report = dict(report, generated_at=datetime.utcnow().isoformat() + "Z")
+    with open(path, "w") as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite connection profile.
+
+`configure_connection()` runs on every new database connection (connected in `apps.py`) and
+applies the PRAGMAs in the `SQLITE_PRAGMAS` setting, eg: WAL journaling, so readers and the
+writer stop blocking each other, and a busy timeout, so writers queue for the lock instead of
+failing with "database is locked". With `CONN_MAX_AGE`, connections (and their page cache and
+memory map) are reused across requests, so this runs once per connection, not per request.
+
+`sync_replica()` copies the primary database into a read replica file (see `routers.py`),
+standing in for replication when running replicas locally.
+"""
+from __future__ import unicode_literals
+import os
+import re
+import sqlite3
+from django.conf import settings
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+PRAGMA_REGEX = re.compile(r'^\w+$') # names and values are interpolated, so only plain words and numbers pass
+VALUE_REGEX = re.compile(r'^-?\w+$')
+
+def configure_connection(sender, connection, **kwargs):
+    """
+    Applies `SQLITE_PRAGMAS` to a new SQLite connection (a `connection_created` signal receiver).
+
+    Parameters:
+    - `sender` - Database wrapper class.
+    - `connection` - New database connection wrapper.
+    """
+
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, "SQLITE_PRAGMAS", []):
+            value = unicode(value)
+            if not PRAGMA_REGEX.match(name) or not VALUE_REGEX.match(value):
+                logger.warning("sqlite.pragma.invalid", pragma=name, value=value)
+                continue
+            cursor.execute("PRAGMA {} = {}".format(name, value))
+        if connection.alias in getattr(settings, "READ_REPLICAS", []):
+            # Replicas are only written by `sync_replicas`, refuse writes routed to them by mistake:
+            cursor.execute("PRAGMA query_only = 1")
+
+def current_pragmas(connection, names):
+    """
+    Returns the current values of the given PRAGMAs on `connection`, eg: to check the profile was applied.
+
+    Parameters:
+    - `connection` - Database connection wrapper.
+    - `names` - PRAGMA names.
+    """
+
+    values = {}
+    with connection.cursor() as cursor:
+        for name in names:
+            if PRAGMA_REGEX.match(name):
+                cursor.execute("PRAGMA {}".format(name))
+                row = cursor.fetchone()
+                values[name] = row[0] if row else None
+    return values
+
+def _schema(db):
+    """Returns the tables, indexes and views of an open sqlite3 connection as sorted (type, name, sql) rows."""
+
+    return sorted(db.execute("SELECT type, name, sql FROM sqlite_master WHERE type IN ('table', 'index', 'view') AND sql IS NOT NULL").fetchall())
+
+def _quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+def sync_replica(primary_path, replica_path):
+    """
+    Brings a replica file up to date with the primary.
+
+    Parameters:
+    - `primary_path` - Primary SQLite file.
+    - `replica_path` - Replica SQLite file (created if missing).
+
+    If the schemas match, every table is refreshed in place in one transaction, so replica readers
+    (in WAL mode) see either the old or the new snapshot. Otherwise (a new replica, or a migration
+    on the primary) the replica is rebuilt from a `VACUUM INTO` snapshot without triggers, so only
+    rebuild while nothing is reading it. Triggers are dropped because the rows they maintain (eg:
+    the search index) are copied from the primary as they are.
+
+    Returns "refreshed" or "rebuilt".
+    """
+
+    primary = sqlite3.connect(primary_path, timeout=30, isolation_level=None)
+    try:
+        schema = _schema(primary)
+        if os.path.exists(replica_path):
+            replica = sqlite3.connect(replica_path, timeout=30, isolation_level=None)
+            try:
+                if _schema(replica) == schema:
+                    replica.execute("ATTACH DATABASE ? AS src", (primary_path,))
+                    replica.execute("BEGIN IMMEDIATE")
+                    try:
+                        for kind, name, sql in schema:
+                            # Virtual tables are refreshed through their shadow tables:
+                            if kind == "table" and not sql.upper().startswith("CREATE VIRTUAL TABLE"):
+                                replica.execute("DELETE FROM main.{0}".format(_quote(name)))
+                                replica.execute("INSERT INTO main.{0} SELECT * FROM src.{0}".format(_quote(name)))
+                        replica.execute("COMMIT")
+                    except Exception:
+                        replica.execute("ROLLBACK")
+                        raise
+                    return "refreshed"
+            finally:
+                replica.close()
+
+        temp_path = replica_path + ".sync"
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        primary.execute("VACUUM INTO ?", (temp_path,))
+    finally:
+        primary.close()
+
+    snapshot = sqlite3.connect(temp_path, isolation_level=None)
+    try:
+        for (name,) in snapshot.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+            snapshot.execute("DROP TRIGGER {}".format(_quote(name)))
+    finally:
+        snapshot.close()
+    # The old replica's WAL files must not be replayed into the new file:
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(replica_path + suffix):
+            os.remove(replica_path + suffix)
+    os.rename(temp_path, replica_path)
+    return "rebuilt"
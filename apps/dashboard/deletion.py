@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Background removal of users with large message histories.
+
+`UserManager.schedule_removal()` hides users at once and records a `UserDeletion` job for
+each. A worker then deletes the user's comments and messages in chunks of
+`USER_DELETION_CHUNK_SIZE` rows, each chunk one short transaction of plain DELETEs by id,
+with the counter updates for the rows that stay and the job's progress. So the SQLite
+write lock is only held for a moment at a time, and other requests write in between.
+Django's cascade collector would instead load every related message and comment into
+memory and hold the lock for the whole delete. The user row goes last.
+
+Workers lease a job before each chunk (`USER_DELETION_LEASE_SECONDS`), so two workers never
+delete the same rows or lower the same counters twice. If a worker dies, its lease expires
+and the next worker carries on where it stopped. Each chunk deletes whatever is left, so
+there is nothing to undo.
+
+Workers:
+- A thread in the web process, started after a removal is scheduled (`start_worker()`,
+  unless `USER_DELETION_THREAD` is off).
+- `python manage.py process_deletions` - Finishes unfinished jobs, eg: after a restart;
+  with `--interval` it keeps checking.
+
+Settings (see `user_dashboard/settings.py`):
+- `USER_DELETION_CHUNK_SIZE` - Rows deleted per transaction (at most 999, SQLite's query parameter limit).
+- `USER_DELETION_PAUSE` - Seconds to sleep between chunks, leaving room for other writers.
+- `USER_DELETION_LEASE_SECONDS` - How long a job stays with a worker that stopped renewing it.
+- `USER_DELETION_THREAD` - Start a worker thread in the web process.
+"""
+from __future__ import unicode_literals
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, router, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import User, UserDeletion, MESSAGE_TIERS, update_counters
+from . import user_cache # logged in user cache invalidation
+from . import wall_cache # rendered message wall invalidation
+from .log import get_logger # structured logging
+
+logger = get_logger(__name__)
+
+
+class LeaseLost(Exception):
+    """Raised when a job's lease is held by another worker (or the job is finished)."""
+    pass
+
+
+def worker_name():
+    """Returns a name for the current thread, unique across hosts and processes."""
+
+    return "{}:{}:{}".format(socket.gethostname(), os.getpid(), threading.current_thread().ident)
+
+def _raw_delete(model, ids):
+    """Deletes rows of `model` by id with one DELETE (no collector, no cascade), returning how many were deleted."""
+
+    return model._base_manager.filter(id__in=ids)._raw_delete(router.db_for_write(model))
+
+def delete_chunk(user_id, chunk_size):
+    """
+    Deletes the next chunk of a hidden user's rows, lowering the counters of the rows that stay.
+
+    Parameters:
+    - `user_id` - ID of the user being removed.
+    - `chunk_size` - Most rows deleted.
+
+    Notes: Deletes, in order, the comments the user wrote, other users' comments on the user's
+    messages (sent or received), the messages the user sent, then the ones they received, so
+    nothing deleted is still pointed at; hot rows first, then archived ones. Each call starts
+    from the top, so rows written while the removal runs are still caught. Call it in a
+    transaction.
+
+    Returns (comments deleted, messages deleted, IDs of the walls they were on); nothing deleted
+    means only the user row is left.
+    """
+
+    for message_model, comment_model in MESSAGE_TIERS:
+        # Comments the user wrote; messages that stay have their comment count lowered
+        # (a comment's receiver is its message's receiver):
+        rows = list(comment_model.objects.filter(sender_id=user_id).values_list("id", "message_id", "receiver_id", "message__sender_id")[:chunk_size])
+        if rows:
+            update_counters(comments=[(None, message_id if user_id not in (receiver_id, message_sender_id) else None) for comment_id, message_id, receiver_id, message_sender_id in rows], sign=-1, message_model=message_model)
+            return _raw_delete(comment_model, [row[0] for row in rows]), 0, set(row[2] for row in rows)
+
+        # Other users' comments on the user's wall, then on messages the user sent to others:
+        for comments in (comment_model.objects.filter(receiver_id=user_id), comment_model.objects.filter(message__sender_id=user_id)):
+            rows = list(comments.values_list("id", "sender_id", "receiver_id")[:chunk_size])
+            if rows:
+                update_counters(comments=[(sender_id, None) for comment_id, sender_id, receiver_id in rows], sign=-1)
+                return _raw_delete(comment_model, [row[0] for row in rows]), 0, set(row[2] for row in rows)
+
+        # Messages the user sent, lowering the receivers' counts:
+        rows = list(message_model.objects.filter(sender_id=user_id).values_list("id", "receiver_id")[:chunk_size])
+        if rows:
+            update_counters(messages=[(None, receiver_id if receiver_id != user_id else None) for message_id, receiver_id in rows], sign=-1)
+            return 0, _raw_delete(message_model, [row[0] for row in rows]), set(row[1] for row in rows)
+
+        # Messages the user received, lowering the senders' counts:
+        rows = list(message_model.objects.filter(receiver_id=user_id).values_list("id", "sender_id")[:chunk_size])
+        if rows:
+            update_counters(messages=[(sender_id, None) for message_id, sender_id in rows], sign=-1)
+            return 0, _raw_delete(message_model, [row[0] for row in rows]), set([user_id])
+
+    return 0, 0, set()
+
+def claim(job_id, worker):
+    """
+    Takes or renews the lease on a job, returning False if another worker holds it or the job is finished.
+
+    Parameters:
+    - `job_id` - ID of the `UserDeletion`.
+    - `worker` - Name of the worker (see `worker_name()`).
+    """
+
+    now = timezone.now()
+    free = Q(lease_expires__isnull=True) | Q(lease_expires__lt=now) | Q(lease_owner=worker)
+    leased = UserDeletion.objects.filter(free, id=job_id, finished_at__isnull=True).update(
+        lease_owner=worker,
+        lease_expires=now + timedelta(seconds=settings.USER_DELETION_LEASE_SECONDS),
+    )
+    return leased == 1
+
+def run_job(job_id, chunk_size=None, pause=None, worker=None):
+    """
+    Deletes a job's rows chunk by chunk, then the user row.
+
+    Parameters:
+    - `job_id` - ID of the `UserDeletion`.
+    - `chunk_size` - Rows per transaction (default `USER_DELETION_CHUNK_SIZE`).
+    - `pause` - Seconds between chunks (default `USER_DELETION_PAUSE`).
+    - `worker` - Name of the worker (default: this thread's).
+
+    Returns True if this call finished the job, False if another worker holds it (or it was already finished).
+    """
+
+    chunk_size = chunk_size or settings.USER_DELETION_CHUNK_SIZE
+    pause = settings.USER_DELETION_PAUSE if pause is None else pause
+    worker = worker or worker_name()
+    user_id = UserDeletion.objects.filter(id=job_id).values_list("user_id", flat=True).get()
+    while True:
+        try:
+            with transaction.atomic():
+                # Renewing the lease first also takes the write lock before anything is read:
+                if not claim(job_id, worker):
+                    raise LeaseLost()
+                comments, messages, receiver_ids = delete_chunk(user_id, chunk_size)
+                if comments or messages:
+                    UserDeletion.objects.filter(id=job_id).update(comments_deleted=F("comments_deleted") + comments, messages_deleted=F("messages_deleted") + messages, updated_at=timezone.now())
+                else:
+                    # Nothing points at the user any more:
+                    _raw_delete(User, [user_id])
+                    UserDeletion.objects.filter(id=job_id).update(finished_at=timezone.now(), lease_owner="", lease_expires=None, updated_at=timezone.now())
+        except LeaseLost:
+            logger.info("user.deletion.skipped", job_id=job_id, user_id=user_id)
+            return False
+
+        if receiver_ids:
+            # Counts shown on these walls changed:
+            wall_cache.bump(*receiver_ids)
+        if not comments and not messages:
+            user_cache.invalidate(user_id)
+            logger.info("user.deletion.finished", job_id=job_id, user_id=user_id)
+            return True
+        if pause:
+            time.sleep(pause)
+
+def run_pending(chunk_size=None, pause=None):
+    """Runs every unfinished job that no other worker holds, oldest first, returning how many it finished."""
+
+    worker = worker_name()
+    finished = 0
+    for job_id in list(UserDeletion.objects.filter(finished_at__isnull=True).order_by("id").values_list("id", flat=True)):
+        if run_job(job_id, chunk_size=chunk_size, pause=pause, worker=worker):
+            finished += 1
+    return finished
+
+
+_worker = None
+_worker_wanted = False
+_worker_lock = threading.Lock()
+
+def start_worker():
+    """Runs pending jobs on a background thread of this process, unless `USER_DELETION_THREAD` is off."""
+
+    global _worker, _worker_wanted
+    if not settings.USER_DELETION_THREAD:
+        return
+    with _worker_lock:
+        # A running worker checks for new jobs again before it stops:
+        _worker_wanted = True
+        if _worker is None:
+            _worker = threading.Thread(target=_work, name="dashboard-deletion")
+            _worker.daemon = True
+            _worker.start()
+
+def _work():
+    global _worker, _worker_wanted
+    try:
+        while True:
+            with _worker_lock:
+                if not _worker_wanted:
+                    _worker = None
+                    return
+                _worker_wanted = False
+            try:
+                run_pending()
+            except Exception as err:
+                # The job keeps its place; the next worker (or `process_deletions`) carries on after the lease expires:
+                logger.error("user.deletion.failed", error=str(err))
+    finally:
+        # This thread's database connection is not closed by any request:
+        connection.close()
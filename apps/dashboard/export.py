@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export of the user directory.
+
+Users are read in keyset chunks of `DASHBOARD_EXPORT_CHUNK_SIZE` (ordered by id, each chunk
+its own short query), with message counts read from the users' counter columns. Rows
+are formatted one at a time as the response is sent, so memory stays flat and the first
+bytes go out before the rest of the table is read.
+"""
+from __future__ import unicode_literals
+import csv
+import json
+from collections import OrderedDict
+from .models import User
+
+EXPORT_FIELDS = ["id", "first_name", "last_name", "email", "created_at", "user_level", "messages_sent", "messages_received"]
+
+def iter_directory(chunk_size):
+    """
+    Yields every user as an ordered dictionary of `EXPORT_FIELDS`, in id order.
+
+    Parameters:
+    - `chunk_size` - Users read per query.
+    """
+
+    last_id = 0
+    while True:
+        chunk = list(User.objects.filter(id__gt=last_id).order_by("id").values_list("id", "first_name", "last_name", "email", "created_at", "user_level", "messages_sent_count", "messages_received_count")[:chunk_size])
+        if not chunk:
+            return
+        for row in chunk:
+            user = OrderedDict(zip(EXPORT_FIELDS, row))
+            user["created_at"] = user["created_at"].isoformat()
+            yield user
+        last_id = chunk[-1][0]
+
+
+class _Echo(object):
+    """File-like object whose `write()` returns the value, so `csv.writer` formats one row at a time."""
+
+    def write(self, value):
+        return value
+
+def csv_lines(users):
+    """Yields a CSV header line and then one line per user dictionary."""
+
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for user in users:
+        # Python 2's `csv` module works on bytes:
+        yield writer.writerow([unicode(user[field]).encode("utf-8") for field in EXPORT_FIELDS])
+
+def jsonl_lines(users):
+    """Yields one JSON object line per user dictionary."""
+
+    for user in users:
+        yield json.dumps(user) + "\n"
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded worker pool for bcrypt.
+
+At 14 rounds a single hash holds a CPU for roughly a second. Running hashes inline lets
+a handful of sign-ups or logins stall every request worker. Instead, hashes run on a
+small, fixed number of threads (bcrypt releases the GIL while hashing), behind a queue
+with a maximum depth. When the queue is full, or a job waits longer than the timeout,
+the caller gets `HashingUnavailable` straight away and can answer "try again" rather
+than piling up.
+
+Settings (see `user_dashboard/settings.py`):
+- `PASSWORD_HASH_ROUNDS` - bcrypt cost factor.
+- `PASSWORD_HASH_WORKERS` - Number of hashing threads.
+- `PASSWORD_HASH_QUEUE_SIZE` - Maximum number of jobs waiting for a thread.
+- `PASSWORD_HASH_TIMEOUT` - Seconds a request will wait for its hash.
+"""
+from __future__ import unicode_literals
+import threading # worker threads and job signalling
+import Queue # bounded job queue
+import bcrypt # bcrypt for password encryption/decryption
+from django.conf import settings
+
+
+class HashingUnavailable(Exception):
+    """Raised when a hash cannot be computed because the pool is saturated or too slow."""
+    pass
+
+class PoolSaturated(HashingUnavailable):
+    """Raised when the hashing queue is full."""
+    pass
+
+class HashTimeout(HashingUnavailable):
+    """Raised when a hash does not finish within `PASSWORD_HASH_TIMEOUT` seconds."""
+    pass
+
+
+class _Job(object):
+    """A single function call waiting for (or running on) a pool thread."""
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = threading.Event()
+        self.cancelled = False
+        self.value = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except Exception as err:
+            # Hand the error (eg: bcrypt's `ValueError` for corrupt hashes) back to the caller:
+            self.error = err
+        self.done.set()
+
+    def result(self, timeout):
+        if not self.done.wait(timeout):
+            # Skip the job if no thread has picked it up yet:
+            self.cancelled = True
+            raise HashTimeout("Password hashing timed out after {} seconds.".format(timeout))
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class HashingPool(object):
+    """Creates instances of a `HashingPool`, a fixed set of threads fed by a bounded queue."""
+
+    def __init__(self, workers, queue_size):
+        """
+        Parameters:
+        - `workers` - Number of hashing threads.
+        - `queue_size` - Maximum number of jobs allowed to wait for a thread.
+        """
+
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._counters = {
+            "submitted": 0,
+            "completed": 0,
+            "rejected": 0,
+            "timed_out": 0,
+            "max_queue_depth": 0,
+        }
+        for number in range(workers):
+            thread = threading.Thread(target=self._work, name="bcrypt-worker-{}".format(number))
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        """Thread loop: take jobs off the queue and run them."""
+
+        while True:
+            job = self._queue.get()
+            if job.cancelled:
+                continue
+            with self._lock:
+                self._busy += 1
+            try:
+                job.run()
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                    self._counters["completed"] += 1
+
+    def run(self, func, *args, **kwargs):
+        """
+        Runs `func(*args)` on a pool thread and waits for its result.
+
+        Parameters:
+        - `func` - Function to run.
+        - `*args` - Arguments for `func`.
+        - `timeout` - Seconds to wait for the result.
+
+        Raises `PoolSaturated` if the queue is full, `HashTimeout` if the wait runs out.
+        """
+
+        job = _Job(func, args)
+        try:
+            self._queue.put_nowait(job)
+        except Queue.Full:
+            with self._lock:
+                self._counters["rejected"] += 1
+            raise PoolSaturated("Password hashing queue is full ({} waiting).".format(self.queue_size))
+        with self._lock:
+            self._counters["submitted"] += 1
+            self._counters["max_queue_depth"] = max(self._counters["max_queue_depth"], self._queue.qsize())
+        try:
+            return job.result(kwargs["timeout"])
+        except HashTimeout:
+            with self._lock:
+                self._counters["timed_out"] += 1
+            raise
+
+    def stats(self):
+        """Returns a snapshot of pool size, current load and lifetime counters."""
+
+        with self._lock:
+            stats = dict(self._counters)
+            stats["busy_workers"] = self._busy
+        stats["workers"] = self.workers
+        stats["queue_size"] = self.queue_size
+        stats["queue_depth"] = self._queue.qsize()
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Returns the process-wide `HashingPool`, starting it on first use."""
+
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = HashingPool(settings.PASSWORD_HASH_WORKERS, settings.PASSWORD_HASH_QUEUE_SIZE)
+    return _pool
+
+def hash_password(password):
+    """
+    Hashes a new password on the pool.
+
+    Parameters:
+    - `password` - Plain text password.
+    """
+
+    return get_pool().run(bcrypt.hashpw, password.encode(), bcrypt.gensalt(settings.PASSWORD_HASH_ROUNDS), timeout=settings.PASSWORD_HASH_TIMEOUT)
+
+def check_password(password, hashed):
+    """
+    Checks a password against a stored hash on the pool.
+
+    Parameters:
+    - `password` - Plain text password submitted by the user.
+    - `hashed` - Hash stored on the `User`.
+
+    Raises `ValueError` if the stored hash is not a valid bcrypt hash.
+    """
+
+    return get_pool().run(bcrypt.hashpw, password.encode(), hashed.encode(), timeout=settings.PASSWORD_HASH_TIMEOUT) == hashed
+
+def stats():
+    """Returns saturation metrics for the hashing pool."""
+
+    return get_pool().stats()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Structured, non-blocking logging for the dashboard.
+
+Code logs named events with fields, eg: `logger.info("user.login.invalid", errors=errors)`.
+Records are handed to `QueueStreamHandler`, which only puts them on a bounded queue;
+a background thread formats them as JSON lines and writes them out, so request threads
+never wait on stdout. Each record carries the id of the request that logged it (set
+by `RequestLogMiddleware`).
+
+Levels are set with the `LOGGING` setting (see `user_dashboard/settings.py`). Events
+below the configured level return before building a record or formatting anything.
+"""
+from __future__ import unicode_literals
+import json
+from collections import OrderedDict
+import logging
+import Queue # bounded record queue
+import threading # background writer and per-thread request ids
+import time
+import uuid # request correlation ids
+
+_context = threading.local()
+
+def get_request_id():
+    """Returns the correlation id of the request being handled by this thread, or None."""
+
+    return getattr(_context, "request_id", None)
+
+
+class EventLogger(object):
+    """Creates instances of an `EventLogger`, which logs named events with keyword fields."""
+
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+
+    def log(self, level, event, **fields):
+        # Check the level first, so dropped events cost nothing more:
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, event, extra={"fields": fields})
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(logging.ERROR, event, **fields)
+
+def get_logger(name):
+    """Returns an `EventLogger` for the given module name."""
+
+    return EventLogger(name)
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as single-line JSON objects."""
+
+    def format(self, record):
+        data = OrderedDict([
+            ("time", self.formatTime(record)),
+            ("level", record.levelname),
+            ("logger", record.name),
+            ("event", record.getMessage()),
+            ("request_id", getattr(record, "request_id", None)),
+        ])
+        data.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=unicode)
+
+
+class QueueStreamHandler(logging.Handler):
+    """
+    Logging handler that queues records for a background thread to format and write.
+
+    Parameters:
+    - `stream` - File-like object to write to (eg: `sys.stdout`).
+    - `queue_size` - Maximum number of records waiting to be written; extra records are dropped and counted.
+    """
+
+    def __init__(self, stream, queue_size=10000):
+        logging.Handler.__init__(self)
+        self.stream = stream
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self._writer = threading.Thread(target=self._write, name="log-writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def emit(self, record):
+        # Capture the request id now, the writer thread has no request context:
+        record.request_id = get_request_id()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        """Writer thread loop: format queued records and write them out."""
+
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                self.stream.write(self.format(record) + "\n")
+                if self.queue.empty():
+                    self.stream.flush()
+            except Exception:
+                self.handleError(record)
+
+    def close(self):
+        """Writes out queued records (waiting up to a second) and stops the writer thread."""
+
+        try:
+            self.queue.put(None, timeout=1)
+            self._writer.join(1)
+        except Queue.Full:
+            pass
+        logging.Handler.close(self)
+
+
+class RequestLogMiddleware(object):
+    """
+    Gives each request a correlation id and logs its method, path, status and duration.
+
+    The id is taken from an incoming `X-Request-ID` header when present, and returned in the
+    `X-Request-ID` response header.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.logger = get_logger("apps.dashboard.requests")
+
+    def __call__(self, request):
+        request_id = request.META.get("HTTP_X_REQUEST_ID", "")
+        if not request_id or len(request_id) > 64 or not request_id.replace("-", "").isalnum():
+            request_id = uuid.uuid4().hex
+        request.request_id = request_id
+        _context.request_id = request_id
+        start = time.time()
+        try:
+            response = self.get_response(request)
+            response["X-Request-ID"] = request_id
+            self.logger.info("request.finished", method=request.method, path=request.path, status=response.status_code, duration_ms=round((time.time() - start) * 1000, 2))
+            return response
+        finally:
+            _context.request_id = None
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from ...models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves messages older than --days, with their comments, from the message and comment tables to "
+        "the archive tables, oldest first, one short transaction per batch. Keeps the tables (and indexes) "
+        "that every wall page reads small; walls read archived messages back on deep pages, and archived "
+        "messages can no longer be commented on. Safe to stop and run again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=settings.MESSAGE_ARCHIVE_AFTER_DAYS, help="Archive messages older than this many days.")
+        parser.add_argument("--batch-size", type=int, default=settings.MESSAGE_ARCHIVE_BATCH_SIZE, help="Messages moved per transaction (at most 999).")
+        parser.add_argument("--pause", type=float, default=0.0, help="Seconds to sleep between batches, to leave room for other writers.")
+
+    def handle(self, *args, **options):
+        if not 1 <= options["batch_size"] <= 999:
+            raise CommandError("--batch-size must be between 1 and 999.")
+        start = time.time()
+        before = timezone.now() - timedelta(days=options["days"])
+        moved = {"messages": 0, "comments": 0}
+        while True:
+            batch = Message.objects.archive(before=before, batch_size=options["batch_size"])
+            if not batch["messages"]:
+                break
+            moved["messages"] += batch["messages"]
+            moved["comments"] += batch["comments"]
+            if options["pause"]:
+                time.sleep(options["pause"])
+        self.stdout.write("Archived {} messages and {} comments created before {:%Y-%m-%d} in {:.1f}s.".format(moved["messages"], moved["comments"], before, time.time() - start))
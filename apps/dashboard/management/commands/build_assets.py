@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from ... import assets
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds the static asset bundles in `ASSET_BUNDLES` into `ASSET_ROOT`: concatenated, minified, "
+        "named by content hash, with gzip (and brotli, if installed) variants. Files of earlier builds "
+        "are kept (see prune_assets); running servers pick up the new bundles on their next request."
+    )
+
+    def handle(self, *args, **options):
+        manifest = assets.AssetBuilder(settings.ASSET_ROOT).build(settings.ASSET_BUNDLES)
+        assets.reset()
+        for name, built in sorted(manifest["bundles"].items()):
+            path = os.path.join(settings.ASSET_ROOT, *built.split("/"))
+            sizes = ["{} bytes".format(os.path.getsize(path))]
+            for token, suffix in assets.ENCODINGS:
+                if os.path.exists(path + suffix):
+                    sizes.append("{} {}".format(os.path.getsize(path + suffix), token))
+            self.stdout.write("{} -> {} ({})".format(name, built, ", ".join(sizes)))
+        if assets.brotli is None:
+            self.stdout.write("brotli is not installed, built gzip variants only.")
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import csv
+import io
+import json
+import time
+from multiprocessing.pool import ThreadPool # bcrypt releases the GIL, so threads hash in parallel
+import bcrypt # bcrypt for password encryption
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+from django.db.models import Max
+from ...models import User, Message, Comment, ArchivedMessage, ALPHACHAR_REGEX, EMAIL_REGEX, update_counters
+from ... import pubsub, wall_cache
+
+ROW_TYPES = ("user", "message", "comment")
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk imports users, messages and comments from a JSONL or CSV file. Rows are streamed, "
+        "validated in batches (with set-wise email checks against the database) and inserted "
+        "with bulk_create(), one transaction per batch.\n\n"
+        "JSONL rows carry a `type` of user, message or comment; a CSV file holds one type, given with --type.\n"
+        "- user: first_name, last_name, email, and password (plain, hashed here) or password_hash (bcrypt); "
+        "optional description, user_level.\n"
+        "- message: sender_email, receiver_email, description; optional ref (for comments to point at).\n"
+        "- comment: sender_email, description, and message_ref (a message ref from this file) or message_id."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="JSONL or CSV file to import.")
+        parser.add_argument("--format", choices=["jsonl", "csv"], default=None, help="File format (default: from the file extension).")
+        parser.add_argument("--type", choices=ROW_TYPES, default=None, help="Row type of a CSV file.")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Rows validated and inserted per transaction.")
+        parser.add_argument("--hash-workers", type=int, default=4, help="Threads hashing plain text passwords.")
+        parser.add_argument("--hash-rounds", type=int, default=None, help="bcrypt rounds for plain text passwords (default: PASSWORD_HASH_ROUNDS).")
+        parser.add_argument("--dry-run", action="store_true", help="Validate only, insert nothing.")
+
+    def handle(self, *args, **options):
+        file_format = options["format"] or ("csv" if options["path"].lower().endswith(".csv") else "jsonl")
+        if file_format == "csv" and not options["type"]:
+            raise CommandError("CSV imports need --type.")
+
+        self.options = options
+        self.rounds = options["hash_rounds"] or settings.PASSWORD_HASH_ROUNDS
+        self.pool = ThreadPool(options["hash_workers"])
+        self.seen_emails = set() # emails imported so far (duplicates within the file are rejected)
+        self.user_ids = {} # email -> id, for users imported or looked up so far
+        self.message_refs = {} # message ref -> (id, receiver_id), for messages imported so far
+        self.counts = {"rows": 0, "user": 0, "message": 0, "comment": 0, "skipped": 0}
+        self.start = time.time()
+
+        with io.open(options["path"], "rb") as source:
+            batch = []
+            for row in self.read_rows(source, file_format):
+                batch.append(row)
+                if len(batch) >= options["batch_size"]:
+                    self.import_batch(batch)
+                    batch = []
+            if batch:
+                self.import_batch(batch)
+        self.pool.close()
+
+        elapsed = time.time() - self.start
+        self.stdout.write("Done: {rows} rows read, {user} users, {message} messages, {comment} comments imported, {skipped} skipped.".format(**self.counts))
+        self.stdout.write("{:.1f}s, {:.0f} rows/sec.".format(elapsed, self.counts["rows"] / elapsed if elapsed else 0))
+
+    def read_rows(self, source, file_format):
+        """Yields (line_number, row) from the file, one at a time."""
+
+        if file_format == "csv":
+            for line_number, row in enumerate(csv.DictReader(source), 2):
+                row = dict((key, value.decode("utf-8")) for key, value in row.items() if value)
+                row["type"] = self.options["type"]
+                yield line_number, row
+        else:
+            for line_number, line in enumerate(source, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = {}
+                # A line holding a list, string or number is as unusable as one that doesn't parse:
+                if not isinstance(row, dict):
+                    row = {}
+                yield line_number, row
+
+    def skip(self, line_number, reason):
+        self.counts["skipped"] += 1
+        self.stderr.write("Line {}: {}".format(line_number, reason))
+
+    def import_batch(self, batch):
+        """Validates and inserts one batch of rows in a single transaction."""
+
+        self.counts["rows"] += len(batch)
+        rows = dict((row_type, []) for row_type in ROW_TYPES)
+        for line_number, row in batch:
+            if row.get("type") not in ROW_TYPES:
+                self.skip(line_number, "Unknown row type.")
+            else:
+                rows[row["type"]].append((line_number, row))
+
+        with transaction.atomic():
+            # Users first, so messages and comments in the same batch can refer to them:
+            users = self.validate_users(rows["user"])
+            self.resolve_emails(rows["message"] + rows["comment"])
+            if not self.options["dry_run"]:
+                self.insert_users(users)
+            messages = self.insert_messages(rows["message"])
+            comments = self.insert_comments(rows["comment"])
+
+        # Drop cached copies of every wall that received messages or comments, and wake their live viewers (see `views.live_wall()`):
+        receiver_ids = set(message.receiver_id for message in messages) | set(comment.receiver_id for comment in comments)
+        wall_cache.bump(*receiver_ids)
+        for receiver_id in receiver_ids:
+            pubsub.publish(pubsub.WALL_TOPIC.format(receiver_id))
+
+        elapsed = time.time() - self.start
+        self.stdout.write("{rows} rows, {user} users, {message} messages, {comment} comments, {skipped} skipped".format(**self.counts) + " ({:.0f} rows/sec)".format(self.counts["rows"] / elapsed if elapsed else 0))
+
+    def validate_users(self, rows):
+        """Returns unsaved `User` objects for the valid user rows, hashing plain passwords in parallel."""
+
+        valid = []
+        for line_number, row in rows:
+            first_name, last_name, email = row.get("first_name", ""), row.get("last_name", ""), row.get("email", "")
+            if len(first_name) < 2 or len(last_name) < 2 or not ALPHACHAR_REGEX.match(first_name) or not ALPHACHAR_REGEX.match(last_name):
+                self.skip(line_number, "First and last name must be letters only and at least 2 characters.")
+            elif len(email) < 5 or len(email) > 50 or not EMAIL_REGEX.match(email):
+                self.skip(line_number, "Email format is invalid.")
+            elif email in self.seen_emails:
+                self.skip(line_number, "Email address appears twice in the import.")
+            elif not row.get("password_hash", "").startswith("$2") and len(row.get("password", "")) < 8:
+                self.skip(line_number, "Password (at least 8 characters) or bcrypt password_hash required.")
+            elif unicode(row.get("user_level", 0)) not in ("0", "1"):
+                self.skip(line_number, "User level must be 0 or 1.")
+            else:
+                self.seen_emails.add(email)
+                valid.append((line_number, row))
+
+        # Check the whole batch's emails against the database in one query (users being removed still hold theirs):
+        taken = set(User._base_manager.filter(email__in=[row["email"] for line_number, row in valid]).values_list("email", flat=True))
+        users = []
+        for line_number, row in valid:
+            if row["email"] in taken:
+                self.skip(line_number, "Email address already registered.")
+            else:
+                users.append(row)
+
+        if self.options["dry_run"]:
+            return []
+
+        plain = [row["password"] for row in users if not row.get("password_hash", "").startswith("$2")]
+        hashed = iter(self.pool.map(self.hash_password, plain))
+        return [User(
+            first_name=row["first_name"],
+            last_name=row["last_name"],
+            email=row["email"],
+            password=row["password_hash"] if row.get("password_hash", "").startswith("$2") else next(hashed),
+            description=row.get("description") or User._meta.get_field("description").default,
+            user_level=int(row.get("user_level") or 0),
+        ) for row in users]
+
+    def hash_password(self, password):
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt(self.rounds))
+
+    def resolve_emails(self, rows):
+        """Looks up ids of every email referenced by message and comment rows not already known."""
+
+        emails = set()
+        for line_number, row in rows:
+            emails.update(row.get(key) for key in ("sender_email", "receiver_email") if row.get(key))
+        missing = list(emails - set(self.user_ids))
+        for start in range(0, len(missing), 500):
+            self.user_ids.update(User.objects.filter(email__in=missing[start:start + 500]).values_list("email", "id"))
+
+    def insert_users(self, users):
+        """Inserts users and records their ids by email."""
+
+        User.objects.bulk_create(users)
+        # `bulk_create()` does not return ids on SQLite, read them back by (unique) email:
+        emails = [user.email for user in users]
+        for start in range(0, len(emails), 500):
+            self.user_ids.update(User.objects.filter(email__in=emails[start:start + 500]).values_list("email", "id"))
+        self.counts["user"] += len(users)
+
+    def next_ids(self, model, count):
+        """
+        Reserves `count` primary keys for `model`.
+
+        Ids are assigned explicitly so messages can be referenced by comments after `bulk_create()`.
+        They start after the table's AUTOINCREMENT sequence, not after its largest id, so ids of
+        deleted rows are never handed out again (live wall cursors rely on ids only growing, see
+        `MessageManager.wall_updates()`); inserting them moves the sequence on. This runs inside the
+        batch transaction; a concurrent insert would fail the batch on the primary key rather than
+        mix up rows. Archived messages keep their ids, so new ones start after those too.
+        """
+
+        models = [model, ArchivedMessage] if model is Message else [model]
+        last_ids = []
+        for table_model in models:
+            last_ids.append(table_model.objects.aggregate(last=Max("id"))["last"] or 0)
+            with connections[router.db_for_write(table_model)].cursor() as cursor:
+                cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table_model._meta.db_table])
+                row = cursor.fetchone()
+            last_ids.append(row[0] if row else 0)
+        start = max(last_ids) + 1
+        return range(start, start + count)
+
+    def insert_messages(self, rows):
+        """Validates and inserts message rows."""
+
+        messages = []
+        for line_number, row in rows:
+            sender_id = self.user_ids.get(row.get("sender_email"))
+            receiver_id = self.user_ids.get(row.get("receiver_email"))
+            if sender_id is None or receiver_id is None:
+                self.skip(line_number, "Unknown sender or receiver email.")
+            elif not 1 <= len(row.get("description", "")) <= 500:
+                self.skip(line_number, "Message description required (at most 500 characters).")
+            else:
+                messages.append((row.get("ref"), Message(description=row["description"], sender_id=sender_id, receiver_id=receiver_id)))
+
+        if self.options["dry_run"] or not messages:
+            return []
+        for message_id, (ref, message) in zip(self.next_ids(Message, len(messages)), messages):
+            message.id = message_id
+            if ref is not None:
+                self.message_refs[ref] = (message.id, message.receiver_id)
+        Message.objects.bulk_create([message for ref, message in messages])
+        update_counters(messages=[(message.sender_id, message.receiver_id) for ref, message in messages])
+        self.counts["message"] += len(messages)
+        return [message for ref, message in messages]
+
+    def insert_comments(self, rows):
+        """Validates and inserts comment rows."""
+
+        # Comments on existing messages (by `message_id`) are checked against the database in one query:
+        message_ids = [int(row["message_id"]) for line_number, row in rows if "message_ref" not in row and unicode(row.get("message_id", "")).isdigit()]
+        existing = dict(Message.objects.filter(id__in=message_ids).values_list("id", "receiver_id"))
+
+        comments = []
+        for line_number, row in rows:
+            if "message_ref" in row:
+                message = self.message_refs.get(row["message_ref"])
+            else:
+                message_id = int(row["message_id"]) if unicode(row.get("message_id", "")).isdigit() else None
+                message = (message_id, existing[message_id]) if message_id in existing else None
+            sender_id = self.user_ids.get(row.get("sender_email"))
+            if message is None:
+                self.skip(line_number, "Unknown message.")
+            elif sender_id is None:
+                self.skip(line_number, "Unknown sender email.")
+            elif not 1 <= len(row.get("description", "")) <= 500:
+                self.skip(line_number, "Comment description required (at most 500 characters).")
+            else:
+                comments.append(Comment(description=row["description"], sender_id=sender_id, receiver_id=message[1], message_id=message[0]))
+
+        if self.options["dry_run"] or not comments:
+            return []
+        Comment.objects.bulk_create(comments)
+        update_counters(comments=[(comment.sender_id, comment.message_id) for comment in comments])
+        self.counts["comment"] += len(comments)
+        return comments
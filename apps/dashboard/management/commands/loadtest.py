@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import cookielib # cookie jar for the HTTP client
+import random
+import re
+import threading
+import time
+import urllib
+import urllib2
+from datetime import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from ... import benchmarks
+from ...models import User
+
+PASSWORD = "benchmark-password"
+MESSAGE_ID_REGEX = re.compile(r'name="message_id" value="(\d+)"')
+
+
+class TestClientDriver(object):
+    """Drives the app in-process through Django's test client, counting SQL queries per request."""
+
+    counts_queries = True
+
+    def __init__(self):
+        self.client = Client(HTTP_HOST="localhost")
+
+    def request(self, method, path, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            if method == "POST":
+                response = self.client.post(path, data or {})
+            else:
+                response = self.client.get(path)
+        return response.status_code, response.get("Location", ""), response.content.decode("utf-8"), len(queries)
+
+
+class _NoRedirect(urllib2.HTTPRedirectHandler):
+    """Returns redirects to the caller instead of following them, so each request is timed on its own."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpDriver(object):
+    """Drives a running server over HTTP, keeping cookies and sending the CSRF token with POSTs."""
+
+    counts_queries = False
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.cookies = cookielib.CookieJar()
+        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.cookies), _NoRedirect())
+
+    def request(self, method, path, data=None):
+        body = None
+        if method == "POST":
+            data = dict(data or {})
+            for cookie in self.cookies:
+                if cookie.name == "csrftoken":
+                    data["csrfmiddlewaretoken"] = cookie.value
+            body = urllib.urlencode(data)
+        try:
+            response = self.opener.open(self.base_url + path, body)
+        except urllib2.HTTPError as response:
+            # Redirects and error statuses arrive as `HTTPError`:
+            pass
+        return response.code, response.headers.get("Location", ""), response.read().decode("utf-8"), None
+
+
+class Command(BaseCommand):
+    help = (
+        "Load tests the dashboard's core flows (register, signin, dashboard, show user with message and "
+        "comment posts, admin edit) from concurrent threads, and saves latency, throughput and SQL query "
+        "counts as JSON. Runs in-process against a throwaway database unless --url is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=200, help="Users to seed.")
+        parser.add_argument("--messages", type=int, default=10, help="Messages received per seeded user.")
+        parser.add_argument("--comments", type=int, default=2, help="Comments per seeded message.")
+        parser.add_argument("--threads", type=int, default=4, help="Concurrent virtual users.")
+        parser.add_argument("--iterations", type=int, default=10, help="Flows each virtual user runs.")
+        parser.add_argument("--hash-rounds", type=int, default=None, help="bcrypt rounds while testing in-process (default: PASSWORD_HASH_ROUNDS).")
+        parser.add_argument("--url", help="Base URL of a running server to test, eg: http://localhost:8000. Seeds the database in settings.")
+        parser.add_argument("--no-seed", action="store_true", help="With --url, skip seeding (reuse an earlier --tag).")
+        parser.add_argument("--tag", default=None, help="Tag for seeded emails (default: a timestamp).")
+        parser.add_argument("--output", default=None, help="Report file (default: loadtest-<timestamp>.json).")
+
+    def handle(self, *args, **options):
+        if options["users"] < 2:
+            self.stderr.write("At least 2 users are needed (one admin, one edit target).")
+            return
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        tag = options["tag"] or stamp.replace("-", "")
+        output = options["output"] or "loadtest-{}.json".format(stamp)
+
+        temp_dir = None
+        if options["url"]:
+            make_driver = lambda: HttpDriver(options["url"])
+        else:
+            # Point the default database at a fresh file, so the real database is never touched:
+            temp_dir = benchmarks.use_throwaway_database()
+            if options["hash_rounds"]:
+                settings.PASSWORD_HASH_ROUNDS = options["hash_rounds"]
+            # Every virtual user signs in from the same address; do not let login throttling cap the test:
+            settings.LOGIN_THROTTLE_PER_IP = settings.LOGIN_THROTTLE_PER_EMAIL = None
+            make_driver = TestClientDriver
+
+        try:
+            if not options["no_seed"]:
+                self.stdout.write("Seeding {users} users, {messages} messages per user, {comments} comments per message...".format(**options))
+                seed_start = time.time()
+                benchmarks.seed(options["users"], options["messages"], options["comments"], PASSWORD, tag=tag)
+                self.stdout.write("Seeded in {:.1f}s.".format(time.time() - seed_start))
+            # Seeded users as (number, id); the first is the admin, everyone else is a normal user:
+            seeded = list(enumerate(User.objects.filter(email__startswith="bench{}.".format(tag), first_name="Bench").order_by("id").values_list("id", flat=True)))
+            if len(seeded) < 2:
+                self.stderr.write("No seeded users found for tag {}.".format(tag))
+                return
+
+            results = {}
+            lock = threading.Lock()
+            workers = [threading.Thread(target=self.run_worker, args=(make_driver, number, options["iterations"], seeded, tag, results, lock)) for number in range(options["threads"])]
+            self.stdout.write("Running {} flows on {} threads...".format(options["iterations"] * options["threads"], options["threads"]))
+            start = time.time()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.time() - start
+        finally:
+            if temp_dir:
+                benchmarks.drop_throwaway_database(temp_dir)
+
+        report = self.build_report(results, elapsed, options, tag)
+        benchmarks.write_report(output, report)
+        self.print_report(report)
+        self.stdout.write("Report saved to {}".format(output))
+
+    def run_worker(self, make_driver, number, iterations, seeded, tag, results, lock):
+        """Runs `iterations` flows as one virtual user, recording each request under its route name."""
+
+        try:
+            for iteration in range(iterations):
+                self.run_flow(make_driver(), number, iteration, seeded, tag, results, lock)
+        finally:
+            connection.close()
+
+    def run_flow(self, driver, number, iteration, seeded, tag, results, lock):
+        """One pass through the core user flows."""
+
+        def timed(route, method, path, data=None, expect_redirect=None):
+            start = time.time()
+            try:
+                status, location, body, queries = driver.request(method, path, data)
+                failed = status >= 400 or (expect_redirect is not None and not location.endswith(expect_redirect))
+            except Exception:
+                status, body, queries, failed = None, "", None, True
+            latency = time.time() - start
+            with lock:
+                route_results = results.setdefault(route, {"latencies": [], "queries": [], "errors": 0})
+                route_results["latencies"].append(latency)
+                if queries is not None:
+                    route_results["queries"].append(queries)
+                if failed:
+                    route_results["errors"] += 1
+            return body
+
+        # Register a brand new user:
+        timed("register_form", "GET", "/register")
+        timed("register", "POST", "/register", {
+            "first_name": "Load",
+            "last_name": benchmarks.letters(number * 100000 + iteration),
+            "email": "bench{}.r{}x{}@example.com".format(tag, number, iteration),
+            "password": PASSWORD,
+            "confirm_pwd": PASSWORD,
+        }, expect_redirect="/dashboard")
+        driver.request("GET", "/logout")
+
+        # Sign in as a seeded normal user, load the dashboard, and post on someone's wall:
+        user_number, user_id = random.choice(seeded[1:])
+        timed("signin", "POST", "/signin", {"login_email": "bench{}.{}@example.com".format(tag, user_number), "login_password": PASSWORD}, expect_redirect="/dashboard")
+        timed("dashboard", "GET", "/dashboard")
+        target_number, target_id = random.choice(seeded[1:])
+        show_path = "/users/show/{}".format(target_id)
+        body = timed("show_user", "GET", show_path)
+        timed("post_message", "POST", show_path, {"description": "Load test message"}, expect_redirect=show_path)
+        message_ids = MESSAGE_ID_REGEX.findall(body)
+        if message_ids:
+            message_id = random.choice(message_ids)
+            timed("post_comment", "POST", show_path + "/comment", {"message_id": message_id, "desc_" + message_id: "Load test comment"}, expect_redirect=show_path)
+        driver.request("GET", "/logout")
+
+        # Sign in as the admin and edit a user (re-saving their current details):
+        admin_number, admin_id = seeded[0]
+        timed("signin_admin", "POST", "/signin", {"login_email": "bench{}.{}@example.com".format(tag, admin_number), "login_password": PASSWORD}, expect_redirect="/dashboard")
+        edit_path = "/users/edit/{}".format(target_id)
+        timed("admin_edit_form", "GET", edit_path)
+        timed("admin_edit", "POST", edit_path, {
+            "first_name": "Bench",
+            "last_name": benchmarks.letters(target_number),
+            "email": "bench{}.{}@example.com".format(tag, target_number),
+            "user_level": "0",
+        }, expect_redirect="/dashboard")
+        driver.request("GET", "/logout")
+
+    def build_report(self, results, elapsed, options, tag):
+        """Summarizes raw results per route and overall."""
+
+        routes = {}
+        all_latencies = []
+        all_queries = []
+        errors = 0
+        for route, route_results in results.items():
+            summary = benchmarks.summarize(route_results["latencies"], elapsed)
+            summary["errors"] = route_results["errors"]
+            summary["queries_per_request"] = round(float(sum(route_results["queries"])) / len(route_results["queries"]), 2) if route_results["queries"] else None
+            routes[route] = summary
+            all_latencies.extend(route_results["latencies"])
+            all_queries.extend(route_results["queries"])
+            errors += route_results["errors"]
+
+        total = benchmarks.summarize(all_latencies, elapsed)
+        total["errors"] = errors
+        total["queries_per_request"] = round(float(sum(all_queries)) / len(all_queries), 2) if all_queries else None
+        return {
+            "config": {
+                "mode": "http" if options["url"] else "in-process",
+                "url": options["url"],
+                "users": options["users"],
+                "messages_per_user": options["messages"],
+                "comments_per_message": options["comments"],
+                "threads": options["threads"],
+                "iterations": options["iterations"],
+                "hash_rounds": settings.PASSWORD_HASH_ROUNDS,
+                "tag": tag,
+            },
+            "elapsed_s": round(elapsed, 3),
+            "total": total,
+            "routes": routes,
+        }
+
+    def print_report(self, report):
+        """Prints a table of per-route results."""
+
+        row = "{:<16} {:>7} {:>9} {:>9} {:>9} {:>9} {:>8} {:>7}"
+        self.stdout.write(row.format("route", "count", "p50 ms", "p95 ms", "p99 ms", "req/s", "queries", "errors"))
+        for route, summary in sorted(report["routes"].items()) + [("TOTAL", report["total"])]:
+            self.stdout.write(row.format(route, summary["count"], summary["p50_ms"], summary["p95_ms"], summary["p99_ms"], summary.get("per_sec"), summary["queries_per_request"], summary["errors"]))
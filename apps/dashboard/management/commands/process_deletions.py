@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from ... import deletion
+from ...models import UserDeletion
+
+
+class Command(BaseCommand):
+    help = (
+        "Finishes removing deleted users: deletes their messages and comments a chunk per short transaction, "
+        "then the user rows (see `apps/dashboard/deletion.py`). Picks up jobs left unfinished by a restart or "
+        "crash once their lease expires; jobs another worker is running are skipped. With --interval, keeps "
+        "checking for new jobs every few seconds."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=0, help="Seconds between checks; 0 runs pending jobs once.")
+        parser.add_argument("--chunk-size", type=int, default=settings.USER_DELETION_CHUNK_SIZE, help="Rows deleted per transaction.")
+        parser.add_argument("--pause", type=float, default=settings.USER_DELETION_PAUSE, help="Seconds to sleep between chunks, to leave room for other writers.")
+
+    def handle(self, *args, **options):
+        while True:
+            start = time.time()
+            finished = deletion.run_pending(chunk_size=options["chunk_size"], pause=options["pause"])
+            pending = UserDeletion.objects.filter(finished_at__isnull=True).count()
+            if finished or pending or not options["interval"]:
+                self.stdout.write("Removed {} users in {:.1f}s, {} still pending.".format(finished, time.time() - start, pending))
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
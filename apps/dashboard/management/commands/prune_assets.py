@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from ... import assets
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes built asset files (and their compressed variants) from `ASSET_ROOT` that no build of "
+        "`build_assets` has produced for --days days. Files of the latest build are always kept; older "
+        "ones are only needed by pages rendered before it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=float, default=settings.ASSET_KEEP_DAYS, help="Keep files built within this many days.")
+
+    def handle(self, *args, **options):
+        pruned = assets.prune(settings.ASSET_ROOT, options["days"] * 24 * 60 * 60)
+        for name in pruned:
+            self.stdout.write("Deleted {}".format(name))
+        self.stdout.write("Deleted {} files.".format(len(pruned)))
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import time
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes expired rows from the session table (left by the `db` and `cached_db` session stores, "
+        "or from before switching stores). Unlike `clearsessions`, rows are deleted in small batches, "
+        "each its own short transaction, so the SQLite write lock is never held for long."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Sessions deleted per transaction.")
+        parser.add_argument("--pause", type=float, default=0.0, help="Seconds to sleep between batches, to leave room for other writers.")
+
+    def handle(self, *args, **options):
+        start = time.time()
+        now = timezone.now()
+        deleted = 0
+        while True:
+            with transaction.atomic():
+                keys = list(Session.objects.filter(expire_date__lt=now).values_list("session_key", flat=True)[:options["batch_size"]])
+                if not keys:
+                    break
+                Session.objects.filter(session_key__in=keys).delete()
+            deleted += len(keys)
+            if options["pause"]:
+                time.sleep(options["pause"])
+        self.stdout.write("Deleted {} expired sessions in {:.1f}s.".format(deleted, time.time() - start))
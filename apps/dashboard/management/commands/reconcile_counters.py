@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import time
+from collections import Counter
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from ...models import User, Message, Comment, ArchivedMessage, ArchivedComment
+
+# Counter fields, with the models counted (hot and archived rows both count) and the foreign key they are rebuilt from:
+COUNTERS = [
+    (User, "messages_sent_count", [Message, ArchivedMessage], "sender_id"),
+    (User, "messages_received_count", [Message, ArchivedMessage], "receiver_id"),
+    (User, "comments_count", [Comment, ArchivedComment], "sender_id"),
+    (Message, "comments_count", [Comment], "message_id"),
+    (ArchivedMessage, "comments_count", [ArchivedComment], "message_id"),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Recounts the denormalized activity counters (messages sent / received and comments per user, "
+        "comments per message) and fixes any that drifted. Rows are checked in id-ordered chunks, one "
+        "short transaction per chunk, with grouped COUNT queries; only rows that differ are updated."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=2000, help="Rows checked per chunk.")
+        parser.add_argument("--dry-run", action="store_true", help="Report drift without fixing it.")
+
+    def handle(self, *args, **options):
+        start = time.time()
+        for model, field, counted_models, foreign_key in COUNTERS:
+            checked, drifted = self.reconcile(model, field, counted_models, foreign_key, options["batch_size"], options["dry_run"])
+            self.stdout.write("{}.{}: {} rows checked, {} {}.".format(model.__name__, field, checked, drifted, "drifted" if options["dry_run"] else "fixed"))
+        self.stdout.write("Done in {:.1f}s.".format(time.time() - start))
+
+    def reconcile(self, model, field, counted_models, foreign_key, batch_size, dry_run):
+        """
+        Recounts one counter column chunk by chunk.
+
+        Parameters:
+        - `model` - Model holding the counter.
+        - `field` - Counter field name.
+        - `counted_models` - Models whose rows are counted (summed).
+        - `foreign_key` - Field of the counted models pointing at `model`.
+        - `batch_size` - Rows per chunk.
+        - `dry_run` - If True, only count drifted rows.
+
+        Returns (rows checked, rows drifted).
+        """
+
+        checked = drifted = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                stored = list(model.objects.filter(id__gt=last_id).order_by("id").values_list("id", field)[:batch_size])
+                if not stored:
+                    return checked, drifted
+                ids = [pk for pk, count in stored]
+                actual = Counter()
+                for counted_model in counted_models:
+                    actual.update(dict(counted_model.objects.filter(**{foreign_key + "__in": ids}).order_by().values_list(foreign_key).annotate(count=Count("id"))))
+                for pk, count in stored:
+                    if actual.get(pk, 0) != count:
+                        drifted += 1
+                        if not dry_run:
+                            model.objects.filter(id=pk).update(**{field: actual.get(pk, 0)})
+            checked += len(stored)
+            last_id = ids[-1]
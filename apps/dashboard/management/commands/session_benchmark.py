@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import time
+from datetime import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from ... import benchmarks
+
+PASSWORD = "benchmark-password"
+
+# (name, session store, message store) combinations compared, see `DASHBOARD_SESSION_STORE` in settings:
+MODES = [
+    ("db", "db", "fallback"),
+    ("db+session_messages", "db", "session"),
+    ("cached_db", "cached_db", "fallback"),
+    ("cache", "cache", "fallback"),
+    ("signed_cookies", "signed_cookies", "fallback"),
+]
+SESSION_WRITES = ("INSERT", "UPDATE", "DELETE")
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares session and flash message stores on the login / post / redirect / logout flow, "
+        "in-process against a throwaway database. Reports latency, SQL queries per request and "
+        "session table reads and writes per request for each store, and saves them as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=50, help="Flows run per store.")
+        parser.add_argument("--hash-rounds", type=int, default=4, help="bcrypt rounds, kept low so hashing does not hide session costs.")
+        parser.add_argument("--output", default=None, help="Report file (default: session-benchmark-<timestamp>.json).")
+
+    def handle(self, *args, **options):
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = options["output"] or "session-benchmark-{}.json".format(stamp)
+        temp_dir = benchmarks.use_throwaway_database()
+        try:
+            # Every flow signs in as the same user; do not let login throttling cap the benchmark:
+            with override_settings(PASSWORD_HASH_ROUNDS=options["hash_rounds"], LOGIN_THROTTLE_PER_IP=None, LOGIN_THROTTLE_PER_EMAIL=None):
+                user_id, other_id = benchmarks.seed(2, 5, 1, PASSWORD, tag=stamp.replace("-", ""), admins=0)
+                email = "bench{}.0@example.com".format(stamp.replace("-", ""))
+                results = {}
+                for name, session_store, message_store in MODES:
+                    with override_settings(SESSION_ENGINE=settings.SESSION_STORES[session_store], MESSAGE_STORAGE=settings.MESSAGE_STORES[message_store]):
+                        results[name] = self.run_mode(options["iterations"], email, other_id)
+        finally:
+            benchmarks.drop_throwaway_database(temp_dir)
+
+        report = {"config": {"iterations": options["iterations"], "hash_rounds": options["hash_rounds"]}, "modes": results}
+        benchmarks.write_report(output, report)
+        row = "{:<20} {:>9} {:>9} {:>9} {:>9} {:>15} {:>15}"
+        self.stdout.write(row.format("store", "requests", "mean ms", "p95 ms", "queries", "session reads", "session writes"))
+        for name, session_store, message_store in MODES:
+            summary = results[name]
+            self.stdout.write(row.format(name, summary["count"], summary["mean_ms"], summary["p95_ms"], summary["queries_per_request"], summary["session_reads_per_request"], summary["session_writes_per_request"]))
+        self.stdout.write("Report saved to {}".format(output))
+
+    def run_mode(self, iterations, email, other_id):
+        """Runs the flow `iterations` times with a fresh client, returning a latency and query summary."""
+
+        client = Client(HTTP_HOST="localhost")
+        show_path = "/users/show/{}".format(other_id)
+        flow = [
+            ("POST", "/signin", {"login_email": email, "login_password": PASSWORD}),
+            ("GET", "/dashboard", None),
+            ("POST", show_path, {"description": "Benchmark message"}),
+            ("GET", show_path, None),
+            ("GET", "/logout", None),
+            ("GET", "/", None),
+        ]
+        latencies = []
+        queries = []
+        for iteration in range(iterations):
+            for method, path, data in flow:
+                start = time.time()
+                with CaptureQueriesContext(connection) as captured:
+                    if method == "POST":
+                        client.post(path, data)
+                    else:
+                        client.get(path)
+                latencies.append(time.time() - start)
+                queries.extend(query["sql"] for query in captured)
+
+        session_queries = [sql for sql in queries if "django_session" in sql]
+        summary = benchmarks.summarize(latencies)
+        summary["queries_per_request"] = round(float(len(queries)) / len(latencies), 2)
+        summary["session_reads_per_request"] = round(float(len([sql for sql in session_queries if sql.startswith("SELECT")])) / len(latencies), 2)
+        summary["session_writes_per_request"] = round(float(len([sql for sql in session_queries if sql.startswith(SESSION_WRITES)])) / len(latencies), 2)
+        return summary
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import random
+import threading
+import time
+from datetime import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, OperationalError
+from django.test.utils import override_settings
+from ... import benchmarks
+from ...database import current_pragmas
+from ...models import Message
+
+# (name, PRAGMAs) connection profiles compared; `default` is SQLite's own rollback journal profile:
+PROFILES = [
+    ("default", [("journal_mode", "DELETE"), ("synchronous", "FULL")]),
+    ("configured", None), # `SQLITE_PRAGMAS` from settings
+]
+REPORTED_PRAGMAS = ("journal_mode", "synchronous", "busy_timeout", "mmap_size", "cache_size", "temp_store")
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares SQLite connection profiles (the default rollback journal against the `SQLITE_PRAGMAS` "
+        "setting) under concurrent load: reader threads load message walls while writer threads post "
+        "messages, against a throwaway database. Reports reads and writes per second, latency and "
+        "\"database is locked\" errors for each profile, and saves them as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--readers", type=int, default=4, help="Reader threads.")
+        parser.add_argument("--writers", type=int, default=2, help="Writer threads.")
+        parser.add_argument("--seconds", type=float, default=10.0, help="Seconds each profile runs.")
+        parser.add_argument("--users", type=int, default=200, help="Users seeded.")
+        parser.add_argument("--messages", type=int, default=20, help="Messages seeded per user.")
+        parser.add_argument("--output", default=None, help="Report file (default: sqlite-benchmark-<timestamp>.json).")
+
+    def handle(self, *args, **options):
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = options["output"] or "sqlite-benchmark-{}.json".format(stamp)
+        results = {}
+        for name, pragmas in PROFILES:
+            # The journal mode sticks to the database file, so every profile gets a fresh database:
+            with override_settings(SQLITE_PRAGMAS=settings.SQLITE_PRAGMAS if pragmas is None else pragmas, PASSWORD_HASH_ROUNDS=4):
+                temp_dir = benchmarks.use_throwaway_database()
+                try:
+                    user_ids = benchmarks.seed(options["users"], options["messages"], 1, "benchmark-password", admins=0)
+                    pragma_values = current_pragmas(connection, REPORTED_PRAGMAS)
+                    connection.close()
+                    results[name] = self.run_profile(user_ids, options["readers"], options["writers"], options["seconds"])
+                    results[name]["pragmas"] = pragma_values
+                finally:
+                    benchmarks.drop_throwaway_database(temp_dir)
+
+        config = dict((key, options[key]) for key in ("readers", "writers", "seconds", "users", "messages"))
+        benchmarks.write_report(output, {"config": config, "profiles": results})
+        row = "{:<12} {:>12} {:>12} {:>13} {:>13} {:>8}"
+        self.stdout.write(row.format("profile", "reads/s", "writes/s", "read p95 ms", "write p95 ms", "locked"))
+        for name, pragmas in PROFILES:
+            summary = results[name]
+            self.stdout.write(row.format(name, summary["reads"]["per_sec"], summary["writes"]["per_sec"], summary["reads"]["p95_ms"], summary["writes"]["p95_ms"], summary["locked_errors"]))
+        self.stdout.write("Report saved to {}".format(output))
+
+    def run_profile(self, user_ids, readers, writers, seconds):
+        """Runs reader and writer threads for `seconds`, returning read and write summaries."""
+
+        deadline = time.time() + seconds
+        latencies = {"reads": [], "writes": []}
+        errors = []
+        lock = threading.Lock()
+
+        def read():
+            page = Message.objects.wall_page(receiver_id=random.choice(user_ids), page_size=settings.WALL_PAGE_SIZE)
+            for message in page.items:
+                list(message.comment.all())
+
+        def write():
+            Message.objects.add(description="Benchmark message", sender_id=random.choice(user_ids), receiver_id=random.choice(user_ids))
+
+        def worker(kind, operation):
+            # Each thread opens its own connection, configured by the `connection_created` hook:
+            timings = []
+            try:
+                while time.time() < deadline:
+                    start = time.time()
+                    try:
+                        operation()
+                    except OperationalError as error:
+                        with lock:
+                            errors.append(unicode(error))
+                        continue
+                    timings.append(time.time() - start)
+            finally:
+                connection.close()
+                with lock:
+                    latencies[kind].extend(timings)
+
+        threads = [threading.Thread(target=worker, args=("reads", read)) for number in range(readers)]
+        threads += [threading.Thread(target=worker, args=("writes", write)) for number in range(writers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        summary = {"locked_errors": len([error for error in errors if "locked" in error]), "other_errors": len([error for error in errors if "locked" not in error])}
+        for kind in ("reads", "writes"):
+            summary[kind] = benchmarks.summarize(latencies[kind], elapsed)
+        return summary
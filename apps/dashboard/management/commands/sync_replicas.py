@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from ...database import sync_replica
+
+
+class Command(BaseCommand):
+    help = (
+        "Copies the primary SQLite database into each read replica in `READ_REPLICAS` (set with "
+        "DASHBOARD_READ_REPLICAS), standing in for replication. Replicas with the primary's schema are "
+        "refreshed in place in one transaction; new replicas, or replicas of a migrated primary, are "
+        "rebuilt from a snapshot (do that while no server is reading them). With --interval, keeps "
+        "syncing every few seconds."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=0, help="Seconds between syncs; 0 syncs once.")
+
+    def handle(self, *args, **options):
+        if not settings.READ_REPLICAS:
+            raise CommandError("No read replicas configured, set DASHBOARD_READ_REPLICAS.")
+        primary_path = connections.databases["default"]["NAME"]
+        while True:
+            for alias in settings.READ_REPLICAS:
+                start = time.time()
+                result = sync_replica(primary_path, connections.databases[alias]["NAME"])
+                self.stdout.write("{}: {} in {:.1f} ms.".format(alias, result, (time.time() - start) * 1000))
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import time
+from datetime import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.template import Engine, RequestContext, engines
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from ... import benchmarks
+from ...models import User, Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Renders each dashboard page template with representative data, in-process against a throwaway "
+        "database, with and without the cached template loader. Reports per template the time to load and "
+        "compile it (including the base layouts and includes it pulls in) and the time to render it, and "
+        "saves them as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=200, help="Renders per template and loader.")
+        parser.add_argument("--users", type=int, default=25, help="Users seeded (the directory page shows up to `DASHBOARD_PAGE_SIZE`).")
+        parser.add_argument("--output", default=None, help="Report file (default: template-benchmark-<timestamp>.json).")
+
+    def handle(self, *args, **options):
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = options["output"] or "template-benchmark-{}.json".format(stamp)
+        temp_dir = benchmarks.use_throwaway_database()
+        try:
+            with override_settings(PASSWORD_HASH_ROUNDS=4):
+                user_ids = benchmarks.seed(options["users"], 5, 1, "benchmark-password")
+            pages = self.pages(user_ids)
+        finally:
+            benchmarks.drop_throwaway_database(temp_dir)
+
+        # Engines like the configured one, loading templates through the loaders without and with the cache:
+        configured = engines["django"].engine
+        loaders = settings.DASHBOARD_TEMPLATE_LOADERS
+        uncached = Engine(dirs=configured.dirs, loaders=loaders, context_processors=configured.context_processors, libraries=configured.libraries)
+        cached = Engine(dirs=configured.dirs, loaders=[("django.template.loaders.cached.Loader", loaders)], context_processors=configured.context_processors, libraries=configured.libraries)
+        request = RequestFactory(HTTP_HOST="localhost").get("/")
+
+        results = {}
+        for name, data in pages:
+            results[name] = self.measure(uncached, cached, name, data, request, options["iterations"])
+
+        benchmarks.write_report(output, {"config": {"iterations": options["iterations"], "users": options["users"]}, "templates": results})
+        row = "{:<36} {:>11} {:>11} {:>13} {:>13}"
+        self.stdout.write(row.format("template", "compile ms", "render ms", "uncached ms", "compile share"))
+        for name, data in pages:
+            summary = results[name]
+            self.stdout.write(row.format(name, summary["compile_ms"], summary["render_ms"], summary["uncached_ms"], "{:.0%}".format(summary["compile_share"])))
+        self.stdout.write("Report saved to {}".format(output))
+
+    def pages(self, user_ids):
+        """Returns (template name, context data) pairs for every page, with querysets already evaluated."""
+
+        admin = User.objects.get(id=user_ids[0])
+        show_user = User.objects.get(id=user_ids[1])
+        directory = User.objects.directory_page(page_size=settings.DASHBOARD_PAGE_SIZE)
+        wall = Message.objects.wall_page(receiver_id=show_user.id, page_size=settings.WALL_PAGE_SIZE)
+        for message in wall.items:
+            list(message.comment.all()) # fills the prefetch cache, so renders run no queries
+        return [
+            ("dashboard/index.html", {}),
+            ("dashboard/login.html", {}),
+            ("dashboard/register.html", {}),
+            ("dashboard/user_dashboard.html", {"logged_in_user": admin, "all_users": directory.items, "page": directory}),
+            ("dashboard/admin_dashboard.html", {"logged_in_user": admin, "all_users": directory.items, "page": directory}),
+            ("dashboard/message_wall.html", {"show_user": show_user, "page": wall, "csrf_token": "benchmark"}),
+            ("dashboard/show_user.html", {"show_user": show_user, "logged_in_user": admin, "wall": ""}),
+            ("dashboard/admin_add_user.html", {"logged_in_user": admin}),
+            ("dashboard/admin_edit_user.html", {"user": show_user}),
+            ("dashboard/user_edit_profile.html", {"user": admin}),
+        ]
+
+    def measure(self, uncached, cached, name, data, request, iterations):
+        """
+        Times one template.
+
+        - `uncached_ms` - Load, compile and render on every request (no template cache).
+        - `render_ms` - Render with the cached loader (already compiled).
+        - `compile_ms` - The difference: reading and compiling the template, its layouts and includes.
+        """
+
+        def run(engine):
+            latencies = []
+            for iteration in range(iterations):
+                start = time.time()
+                engine.get_template(name).render(RequestContext(request, data))
+                latencies.append(time.time() - start)
+            return benchmarks.summarize(latencies)
+
+        run(cached) # warm the cache
+        uncached_summary = run(uncached)
+        cached_summary = run(cached)
+        compile_ms = max(0, uncached_summary["mean_ms"] - cached_summary["mean_ms"])
+        return {
+            "uncached_ms": uncached_summary["mean_ms"],
+            "render_ms": cached_summary["mean_ms"],
+            "compile_ms": round(compile_ms, 3),
+            "compile_share": round(compile_ms / uncached_summary["mean_ms"], 3) if uncached_summary["mean_ms"] else 0,
+            "uncached": uncached_summary,
+            "cached": cached_summary,
+        }
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from .models import User
+from .routers import use_primary
+from .user_cache import get_user_cache
+
+class SessionUserMiddleware(object):
+    """
+    Loads the logged in `User` once per request and attaches it as `request.logged_in_user`.
+
+    Users are served from the process-local `UserCache` when enabled (see `./user_cache.py`),
+    so most authenticated page views skip the user lookup entirely. `request.logged_in_user`
+    is None when there is no session, or the session's user no longer exists.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.logged_in_user = load_session_user(request)
+        return self.get_response(request)
+
+
+def load_session_user(request):
+    """
+    Returns the `User` for the current session, or None.
+
+    Parameters:
+    - `request` - Current request (with session).
+    """
+
+    try:
+        user_id = int(request.session["user_id"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    user_cache = get_user_cache()
+    if user_cache is not None:
+        user = user_cache.get(user_id)
+        if user is not None:
+            return user
+
+    if user_cache is None:
+        return User.objects.filter(id=user_id).first()
+
+    # Cached users outlive replication lag, so they are loaded from the primary:
+    with use_primary():
+        user = User.objects.filter(id=user_id).first()
+    if user is not None:
+        user_cache.set(user)
+    return user
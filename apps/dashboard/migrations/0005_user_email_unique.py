@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 15:07
+from __future__ import unicode_literals
+
+import sys
+
+from django.db import migrations, models
+from django.db.models import Count
+
+# Stands in for the email of a later account that registered an address already taken:
+DUPLICATE_EMAIL = "duplicate-{}@example.invalid"
+
+
+def rename_duplicate_emails(apps, schema_editor):
+    """
+    Frees duplicate emails, which registration's racy existence check could let in, before the unique index is added.
+
+    The oldest account keeps the address; the others get `DUPLICATE_EMAIL`, so they can no
+    longer sign in with it (an admin can set a new email on their edit page). Each change is
+    reported.
+    """
+
+    User = apps.get_model('dashboard', 'User')
+    duplicates = User.objects.values('email').annotate(count=Count('id')).filter(count__gt=1).values_list('email', flat=True)
+    for email in list(duplicates):
+        for user_id in list(User.objects.filter(email=email).order_by('id').values_list('id', flat=True))[1:]:
+            User.objects.filter(id=user_id).update(email=DUPLICATE_EMAIL.format(user_id))
+            sys.stdout.write("\n  User {} shared the email {}, renamed to {}".format(user_id, email, DUPLICATE_EMAIL.format(user_id)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0004_user_directory_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicate_emails, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='user',
+            name='email',
+            field=models.CharField(max_length=50, unique=True),
+        ),
+    ]
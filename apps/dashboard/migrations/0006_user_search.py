@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Full-text index of users for `apps/dashboard/search.py` (SQLite FTS5).
+# External content: the index reads text back from `dashboard_user`, so it is not stored twice.
+CREATE_TABLE = (
+    "CREATE VIRTUAL TABLE dashboard_user_fts USING fts5("
+    "first_name, last_name, email, description, "
+    "content='dashboard_user', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+)
+
+# Triggers keep the index in sync with every write, including `update()` and `bulk_create()`.
+# Updates only reindex when a searched column changes (not on password or `updated_at` changes).
+# The default description is indexed as empty text, or "user" would match every user who never set one.
+DESCRIPTION = "CASE WHEN {0}.description = 'This user has not set a description yet.' THEN '' ELSE {0}.description END"
+
+CREATE_TRIGGERS = [
+    "CREATE TRIGGER dashboard_user_fts_insert AFTER INSERT ON dashboard_user BEGIN "
+    "INSERT INTO dashboard_user_fts(rowid, first_name, last_name, email, description) "
+    "VALUES (new.id, new.first_name, new.last_name, new.email, " + DESCRIPTION.format('new') + "); END",
+    "CREATE TRIGGER dashboard_user_fts_delete AFTER DELETE ON dashboard_user BEGIN "
+    "INSERT INTO dashboard_user_fts(dashboard_user_fts, rowid, first_name, last_name, email, description) "
+    "VALUES ('delete', old.id, old.first_name, old.last_name, old.email, " + DESCRIPTION.format('old') + "); END",
+    "CREATE TRIGGER dashboard_user_fts_update AFTER UPDATE OF first_name, last_name, email, description ON dashboard_user BEGIN "
+    "INSERT INTO dashboard_user_fts(dashboard_user_fts, rowid, first_name, last_name, email, description) "
+    "VALUES ('delete', old.id, old.first_name, old.last_name, old.email, " + DESCRIPTION.format('old') + "); "
+    "INSERT INTO dashboard_user_fts(rowid, first_name, last_name, email, description) "
+    "VALUES (new.id, new.first_name, new.last_name, new.email, " + DESCRIPTION.format('new') + "); END",
+]
+
+DROP_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS dashboard_user_fts_insert",
+    "DROP TRIGGER IF EXISTS dashboard_user_fts_delete",
+    "DROP TRIGGER IF EXISTS dashboard_user_fts_update",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0005_user_email_unique'),
+    ]
+
+    operations = [
+        migrations.RunSQL([CREATE_TABLE], ["DROP TABLE dashboard_user_fts"]),
+        migrations.RunSQL(CREATE_TRIGGERS, DROP_TRIGGERS),
+        # Index the users already registered:
+        migrations.RunSQL([
+            "INSERT INTO dashboard_user_fts(rowid, first_name, last_name, email, description) "
+            "SELECT id, first_name, last_name, email, " + DESCRIPTION.format("dashboard_user") + " FROM dashboard_user"
+        ], migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 15:22
+from __future__ import unicode_literals
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+# Adding or removing columns rebuilds `dashboard_user` on SQLite, which drops the search index triggers:
+user_search = import_module('apps.dashboard.migrations.0006_user_search')
+
+# Count the messages and comments that already exist:
+COUNT_EXISTING = [
+    "UPDATE dashboard_user SET "
+    "messages_sent_count = (SELECT COUNT(*) FROM dashboard_message WHERE sender_id = dashboard_user.id), "
+    "messages_received_count = (SELECT COUNT(*) FROM dashboard_message WHERE receiver_id = dashboard_user.id), "
+    "comments_count = (SELECT COUNT(*) FROM dashboard_comment WHERE sender_id = dashboard_user.id)",
+    "UPDATE dashboard_message SET "
+    "comments_count = (SELECT COUNT(*) FROM dashboard_comment WHERE message_id = dashboard_message.id)",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0007_message_wall_index'),
+    ]
+
+    operations = [
+        # Reversed last, after removing the column has rebuilt the table:
+        migrations.RunSQL(migrations.RunSQL.noop, user_search.DROP_TRIGGERS + user_search.CREATE_TRIGGERS),
+        migrations.AddField(
+            model_name='message',
+            name='comments_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='comments_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='messages_received_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='messages_sent_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunSQL(user_search.DROP_TRIGGERS + user_search.CREATE_TRIGGERS, migrations.RunSQL.noop),
+        migrations.RunSQL(COUNT_EXISTING, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 15:50
+from __future__ import unicode_literals
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+# Adding or removing a column rebuilds `dashboard_user` on SQLite, which drops the search index triggers:
+user_search = import_module('apps.dashboard.migrations.0006_user_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0008_activity_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserDeletion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.IntegerField(unique=True)),
+                ('comments_deleted', models.IntegerField(default=0)),
+                ('messages_deleted', models.IntegerField(default=0)),
+                ('lease_owner', models.CharField(default='', max_length=100)),
+                ('lease_expires', models.DateTimeField(default=None, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(default=None, null=True)),
+            ],
+        ),
+        # Reversed last, after removing the column has rebuilt the table:
+        migrations.RunSQL(migrations.RunSQL.noop, user_search.DROP_TRIGGERS + user_search.CREATE_TRIGGERS),
+        migrations.AddField(
+            model_name='user',
+            name='deleted_at',
+            field=models.DateTimeField(default=None, null=True),
+        ),
+        migrations.RunSQL(user_search.DROP_TRIGGERS + user_search.CREATE_TRIGGERS, migrations.RunSQL.noop),
+    ]
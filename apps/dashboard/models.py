@@ -1,12 +1,40 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-from django.db import models
+from collections import Counter, defaultdict
+from django.db import connections, models, router, transaction, IntegrityError
+from django.db.models import Count, Exists, F, Q
+from django.utils import timezone
 import re # regex for email validation
-import bcrypt # bcrypt for password encryption/decryption
+from . import hashing # bcrypt for password encryption/decryption, on a bounded worker pool
+from .pagination import KeysetPage, keyset_paginate, tiered_paginate, encode_cursor, decode_cursor # cursor pagination for large tables
+from . import user_cache # logged in user cache invalidation
+from . import search # full-text user search
+from . import wall_cache # rendered message wall invalidation
+from . import pubsub # live wall updates
+from .log import get_logger # structured logging
+
+logger = get_logger(__name__)
+
+# Validation patterns (compiled once, shared by the managers and the bulk import command):
+ALPHACHAR_REGEX = re.compile(r'^[a-zA-Z]*$') # letters only, for first and last names
+EMAIL_REGEX = re.compile(r'^[a-zA-Z0-9\.\+_-]+@[a-zA-Z0-9\._-]+\.[a-zA-Z]*$')
+
+DELETE_BATCH_SIZE = 250 # user ids per bulk statement (SQLite allows 999 query parameters; some statements use them three times)
+WALL_UPDATES_LIMIT = 50 # most messages (and most comments) returned per live wall update
 
 class UserManager(models.Manager):
     """Additional instance method functions for `User`"""
 
+    def get_queryset(self):
+        """
+        Users being removed in the background (see `schedule_removal()`) are hidden from every lookup.
+
+        Their rows (and emails) still exist until the removal finishes, so checks against the unique
+        email index go through `User._base_manager`.
+        """
+
+        return super(UserManager, self).get_queryset().filter(deleted_at__isnull=True)
+
     def register(self, **kwargs):
         """
         Validates and registers a new user.
@@ -32,9 +60,8 @@ class UserManager(models.Manager):
             errors.append('First and last name are required must be at least 2 characters.')
 
         # Check if first_name or last_name contains letters only:
-        alphachar_regex = re.compile(r'^[a-zA-Z]*$') # Create regex object
         # Test first_name and last_name against regex object:
-        if not alphachar_regex.match(kwargs["first_name"]) or not alphachar_regex.match(kwargs["last_name"]):
+        if not ALPHACHAR_REGEX.match(kwargs["first_name"]) or not ALPHACHAR_REGEX.match(kwargs["last_name"]):
             errors.append('First and last name must be letters only.')
 
         #------------#
@@ -47,15 +74,15 @@ class UserManager(models.Manager):
         # Else if email is greater than 5 characters:
         else:
             # Check if email is in valid format (using regex):
-            email_regex = re.compile(r'^[a-zA-Z0-9\.\+_-]+@[a-zA-Z0-9\._-]+\.[a-zA-Z]*$')
-            if not email_regex.match(kwargs["email"]):
+            if not EMAIL_REGEX.match(kwargs["email"]):
                 errors.append('Email format is invalid.')
             else:
                 #---------------#
                 #-- EXISTING: --#
                 #---------------#
-                # Check for existing User via email:
-                if len(User.objects.filter(email=kwargs["email"])) > 0:
+                # Check for existing User via email (checked before hashing, so taken emails cost no bcrypt time;
+                # users being removed still hold theirs, so `_base_manager` sees them):
+                if User._base_manager.filter(email=kwargs["email"]).exists():
                     errors.append('Email address already registered.')
 
         #---------------#
@@ -72,25 +99,35 @@ class UserManager(models.Manager):
         # Check for validation errors:
         # If none, hash password, create user and send new user back:
         if len(errors) == 0:
-            print "Registration data passed validation...hashing password..."
-            kwargs["password"] = bcrypt.hashpw(kwargs["password"].encode(), bcrypt.gensalt(14))
-            print "Creating new user with data..."
+            logger.debug("user.register.valid")
+            try:
+                kwargs["password"] = hashing.hash_password(kwargs["password"])
+            except hashing.HashingUnavailable as err:
+                # If the hashing pool is saturated, ask the user to retry rather than queueing forever:
+                logger.warning("password.hash.unavailable", error=unicode(err))
+                return {
+                    "errors": ['The server is busy. Please try again in a moment.'],
+                }
             # Create new validated User:
             validated_user = {
                 "logged_in_user": User(first_name=kwargs["first_name"], last_name=kwargs["last_name"], email=kwargs["email"], password=kwargs["password"])
             }
             # Save new User:
-            validated_user["logged_in_user"].save()
-            print "New `User` created:"
-            print "{} {} | {} | {}".format(validated_user["logged_in_user"].first_name,validated_user["logged_in_user"].last_name, validated_user["logged_in_user"].email, validated_user["logged_in_user"].created_at)
-            print "Logging user in..."
+            try:
+                with transaction.atomic():
+                    validated_user["logged_in_user"].save()
+            except IntegrityError:
+                # Another request registered this email after our check (enforced by the unique index on `email`):
+                logger.info("user.register.invalid", errors=['Email address already registered.'])
+                return {
+                    "errors": ['Email address already registered.'],
+                }
+            logger.info("user.created", user_id=validated_user["logged_in_user"].id)
             # Return created User:
             return validated_user
         else:
-            # Else, if validation fails, print errors to console and return errors object:
-            print "Errors validating User registration."
-            for error in errors:
-                print "Validation Error: ", error
+            # Else, if validation fails, log errors and return errors object:
+            logger.info("user.register.invalid", errors=errors)
             # Prepare data for controller:
             errors = {
                 "errors": errors,
@@ -127,40 +164,41 @@ class UserManager(models.Manager):
             # Look for existing User to login:
             try:
                 logged_in_user = User.objects.get(email=kwargs["email"])
-                print "User found..."
 
                 #------------------#
                 #---- PASSWORD ----#
                 #------------------#
                 # Compare passwords with bcrypt:
-                # Notes: We pass in our `kwargs['password']` chained to the `str.encode()` method so it's ready for bcrypt.
+                # Notes: `hashing.check_password()` runs bcrypt on the hashing pool and compares against the stored hash.
                 try:
                     # If password is incorrect:
-                    if bcrypt.hashpw(kwargs["password"].encode(), logged_in_user.password.encode()) != logged_in_user.password:
+                    if not hashing.check_password(kwargs["password"], logged_in_user.password):
                         errors.append('Login invalid.')
                 except ValueError:
                     # If user's stored password is unable to be used by bcrypt (meaning the created user's p/w was never hashed):
                     errors.append('This user is corrupt. Please contact the administrator.')
+                except hashing.HashingUnavailable as err:
+                    # If the hashing pool is saturated, ask the user to retry:
+                    logger.warning("password.hash.unavailable", error=unicode(err))
+                    errors.append('The server is busy. Please try again in a moment.')
 
             # If existing User is not found:
             except User.DoesNotExist:
-                print "Error, User has not been found."
+                logger.debug("user.login.unknown_email")
                 errors.append('Login invalid.')
 
         # If no validation errors, return logged in user:
         if len(errors) == 0:
-            print "Login data passed validation...logging in..."
+            logger.debug("user.login.valid", user_id=logged_in_user.id)
             # Prepare data for controller:
             validated_user = {
                 "logged_in_user": logged_in_user,
             }
             # Send back validated logged in User:
             return validated_user
-        # Else, if validation fails print errors and return errors to controller:
+        # Else, if validation fails log errors and return errors to controller:
         else:
-            print "Errors validating User login."
-            for error in errors:
-                print "Validation Error: ", error
+            logger.info("user.login.invalid", errors=errors)
             # Prepare data for controller:
             errors = {
                 "errors": errors,
@@ -191,9 +229,8 @@ class UserManager(models.Manager):
             errors.append("First and last name required and must be at least 2 characters.")
 
         # Check if first_name or last_name contains letters only:
-        alphachar_regex = re.compile(r'^[a-zA-Z]*$') # Create regex object
         # Test first_name and last_name against regex object:
-        if not alphachar_regex.match(kwargs["first_name"]) or not alphachar_regex.match(kwargs["last_name"]):
+        if not ALPHACHAR_REGEX.match(kwargs["first_name"]) or not ALPHACHAR_REGEX.match(kwargs["last_name"]):
             errors.append('First and last name must be letters only.')
 
         #------------#
@@ -203,92 +240,70 @@ class UserManager(models.Manager):
         if len(kwargs["email"]) < 5:
             errors.append("Email is required and must be at least 5 characters.")
 
-        # Check if email submitted is different than current email on record:
-        if User.objects.get(id=kwargs["user_id"]).email != kwargs["email"]:
-            # Check if email field is empty:
-            if len(kwargs["email"]) < 5:
-                errors.append('Email field must be at least 5 characters.')
+        # Fetch the logged in user, and the user being edited (if an admin is editing someone else), in one query:
+        users = User.objects.in_bulk([kwargs["user_id"], kwargs.get("edit_user_id", kwargs["user_id"])])
+        user = users[int(kwargs["user_id"])]
 
-            # Else if email is greater than 5 characters:
-            else:
-                # Check if email is in valid format (using regex):
-                email_regex = re.compile(r'^[a-zA-Z0-9\.\+_-]+@[a-zA-Z0-9\._-]+\.[a-zA-Z]*$')
-                if not email_regex.match(kwargs["email"]):
-                    errors.append('Email format is invalid.')
-                else:
-                    try:
-                        # If email has not changed, pass, otherwise check if already registered:
-                        if User.objects.get(id=kwargs["edit_user_id"]).email == kwargs["email"]:
-                            pass
-
-                        else:
-                            #---------------#
-                            #-- EXISTING: --#
-                            #---------------#
-                            # Check for existing User via email:
-                            if len(User.objects.filter(email=kwargs["email"])) > 0:
-                                errors.append('Email address already registered.')
-                    except KeyError:
-                        # If email has not changed, pass, otherwise check if already registered:
-                        if User.objects.get(id=kwargs["user_id"]).email == kwargs["email"]:
-                            pass
-                        else:
-                            #---------------#
-                            #-- EXISTING: --#
-                            #---------------#
-                            # Check for existing User via email:
-                            if len(User.objects.filter(email=kwargs["email"])) > 0:
-                                errors.append('Email address already registered.')
+        # Determine whose profile is being updated:
+        """
+        The three scenarios:
+        1. Normal User Updating their profile
+        2. Admin User Updating their profile
+        3. Admin User Updating Normal User profile (includes "edit_user_id")
+        """
+        admin_edit = user.user_level == 1 and "edit_user_id" in kwargs
+        if admin_edit:
+            logger.debug("user.update_profile.admin_edit", user_id=user.id, edit_user_id=kwargs["edit_user_id"])
+            edit_user = users[int(kwargs["edit_user_id"])]
+        else:
+            edit_user = user
 
+        # Check if email submitted is different than current email on record:
+        if edit_user.email != kwargs["email"] and len(kwargs["email"]) >= 5:
+            # Check if email is in valid format (using regex):
+            if not EMAIL_REGEX.match(kwargs["email"]):
+                errors.append('Email format is invalid.')
+            #---------------#
+            #-- EXISTING: --#
+            #---------------#
+            # Check for existing User via email, including users being removed (the unique index on `email` catches any race below):
+            elif User._base_manager.filter(email=kwargs["email"]).exists():
+                errors.append('Email address already registered.')
 
         # Check for validation errors:
         # If none, update information for user:
         if len(errors) == 0:
-            print "User profile data update passed validation..."
-
-            # Updating user:
-            """
-            The three scenarios:
-            1. Normal User Updating their profile
-            2. Admin User Updating their profile
-            3. Admin User Updating Normal User profile (includes "edit_user_id")
-            """
-
-            # If user is not admin, simply update user profile:
-            if User.objects.get(id=kwargs["user_id"]).user_level == 0:
-                User.objects.filter(id=kwargs["user_id"]).update(first_name=kwargs["first_name"], last_name=kwargs["last_name"], email=kwargs["email"])
-                print "User information updated."
-                # Return updated user:
-                return User.objects.get(id=kwargs["user_id"])
-
-
-            # If user is admin, check if this is a self profile update, or updating another user:
-            if User.objects.get(id=kwargs["user_id"]).user_level == 1:
-                # If edit_user_id exists, this is an admin edit to another user:
-                if "edit_user_id" in kwargs:
-                    print "Admin user update detected..."
-                    # Update user by `edit_user_id`, including user level:
-                    User.objects.filter(id=kwargs["edit_user_id"]).update(first_name=kwargs["first_name"], last_name=kwargs["last_name"], email=kwargs["email"], user_level=kwargs["user_level"])
-                    # Return user whom was edited:
-                    return User.objects.get(id=kwargs["edit_user_id"])
-                else:
-                    # Else if edit_user_id does not exist, this is an admin self-profile change:
-                    print "Admin profile update detected..."
-                    # Update user by `user_id`
-                    User.objects.filter(id=kwargs["user_id"]).update(first_name=kwargs["first_name"], last_name=kwargs["last_name"], email=kwargs["email"])
-                    return User.objects.get(id=kwargs["user_id"])
-
-
-        else:
-            # Else, if validation fails, print errors to console and return errors object:
-            print "Errors validating User registration."
-            for error in errors:
-                print "Validation Error: ", error
-            # Prepare data for controller:
-            errors = {
-                "errors": errors,
+            updated_fields = {
+                "first_name": kwargs["first_name"],
+                "last_name": kwargs["last_name"],
+                "email": kwargs["email"],
+                "updated_at": timezone.now(), # `update()` skips `auto_now`, so set it here
             }
-            return errors
+            # Only admin edits (through `edit_user_id`) may change user level:
+            if admin_edit:
+                updated_fields["user_level"] = int(kwargs["user_level"])
+
+            try:
+                with transaction.atomic():
+                    User.objects.filter(id=edit_user.id).update(**updated_fields)
+            except IntegrityError:
+                # Another request claimed this email between our check and the update:
+                errors.append('Email address already registered.')
+            else:
+                logger.info("user.profile.updated", user_id=edit_user.id)
+                user_cache.invalidate(edit_user.id)
+                # Return updated user (applying the changes to the row we already fetched):
+                for field, value in updated_fields.items():
+                    setattr(edit_user, field, value)
+                return edit_user
+
+        # Else, if validation fails, log errors and return errors object:
+        logger.info("user.update_profile.invalid", errors=errors)
+        # Prepare data for controller:
+        errors = {
+            "errors": errors,
+        }
+        return errors
 
     def update_password(self, **kwargs):
         """
@@ -326,27 +341,33 @@ class UserManager(models.Manager):
             3. Admin updating a normal user's password.
             """
 
+            try:
+                hashed_password = hashing.hash_password(kwargs["password"])
+            except hashing.HashingUnavailable as err:
+                # If the hashing pool is saturated, ask the user to retry:
+                logger.warning("password.hash.unavailable", error=unicode(err))
+                return {
+                    "errors": ['The server is busy. Please try again in a moment.'],
+                }
+
             # Check if admin is updating another user's password:
             if "edit_user_id" in kwargs:
-                print "Admin password update for normal user detected..."
                 # Update password for user with ID as `edit_user_id`:
-                print "Password validated...hashing..."
-                User.objects.filter(id=kwargs["edit_user_id"]).update(password=bcrypt.hashpw(kwargs["password"].encode(), bcrypt.gensalt(14)))
-                print "Password hashed..."
+                User.objects.filter(id=kwargs["edit_user_id"]).update(password=hashed_password, updated_at=timezone.now())
+                user_cache.invalidate(kwargs["edit_user_id"])
+                logger.info("user.password.updated", user_id=kwargs["user_id"], edit_user_id=kwargs["edit_user_id"])
                 # Return created User:
                 return User.objects.filter(id=kwargs["edit_user_id"])
             else:
-                print "Profile password update detected..."
-                print "Password validated...hashing..."
-                User.objects.filter(id=kwargs["user_id"]).update(password=bcrypt.hashpw(kwargs["password"].encode(), bcrypt.gensalt(14)))
-                print "Password hashed..."
+                # Else, update the logged in user's own password:
+                User.objects.filter(id=kwargs["user_id"]).update(password=hashed_password, updated_at=timezone.now())
+                user_cache.invalidate(kwargs["user_id"])
+                logger.info("user.password.updated", user_id=kwargs["user_id"])
                 # Return created User:
                 return User.objects.filter(id=kwargs["user_id"])
         else:
-            # Else, if validation fails, print errors to console and return errors object:
-            print "Errors validating password update."
-            for error in errors:
-                print "Validation Error: ", error
+            # Else, if validation fails, log errors and return errors object:
+            logger.info("user.update_password.invalid", errors=errors)
             # Prepare data for controller:
             errors = {
                 "errors": errors,
@@ -376,21 +397,207 @@ class UserManager(models.Manager):
 
         # Check for validation errors, if none, update description:
         if len(errors) == 0:
-            print "Description validated..."
-            User.objects.filter(id=kwargs["user_id"]).update(description=kwargs["description"])
+            User.objects.filter(id=kwargs["user_id"]).update(description=kwargs["description"], updated_at=timezone.now())
+            user_cache.invalidate(kwargs["user_id"])
             # Return created User:
             return User.objects.filter(id=kwargs["user_id"])
         else:
-            # Else, if validation fails, print errors to console and return errors object:
-            print "Errors validating description."
-            for error in errors:
-                print "Validation Error: ", error
+            # Else, if validation fails, log errors and return errors object:
+            logger.info("user.update_description.invalid", errors=errors)
             # Prepare data for controller:
             errors = {
                 "errors": errors,
             }
             return errors
 
+    def remove(self, **kwargs):
+        """
+        Deletes users, with their messages and comments, keeping everyone else's counters right.
+
+        Parameters:
+        - `self` - Instance to whom this method belongs.
+        - `**kwargs` - Dictionary object containing `user_ids` to delete.
+
+        Notes: Removes messages sent to or by the users, and every comment on those messages or
+        by the users, hot or archived, with a few set-based DELETEs per `DELETE_BATCH_SIZE` users
+        (not Django's cascade collector, which loads every message into memory to find its
+        comments). The counters of the remaining users and messages are lowered by what they lose,
+        counted with grouped queries (one row per user or message, never per deleted row), in the
+        same transaction. Walls the users appeared on are invalidated.
+
+        Returns the number of users, messages and comments deleted.
+        """
+
+        user_ids = sorted(set(int(user_id) for user_id in kwargs["user_ids"]))
+        batches = [user_ids[start:start + DELETE_BATCH_SIZE] for start in range(0, len(user_ids), DELETE_BATCH_SIZE)]
+        removed = set(user_ids)
+        receiver_ids = set(removed)
+        deleted = {"users": 0, "messages": 0, "comments": 0}
+        with transaction.atomic():
+            # Hot rows, then archived ones (comments always sit in the same tier as their message):
+            for message_model, comment_model in MESSAGE_TIERS:
+                # Each batch's rows are counted, then deleted, so rows shared with a later batch are only counted once:
+                for batch in batches:
+                    messages = message_model.objects.filter(Q(sender_id__in=batch) | Q(receiver_id__in=batch))
+                    # (A comment's receiver is its message's receiver, so this covers comments on messages sent or received:)
+                    comments = comment_model.objects.filter(Q(sender_id__in=batch) | Q(receiver_id__in=batch) | Q(message__sender_id__in=batch))
+
+                    # Counted per group by the database; only rows that survive the delete need their counters lowered:
+                    sent = _counts_by(messages, "sender_id")
+                    received = _counts_by(messages, "receiver_id")
+                    written = _counts_by(comments, "sender_id")
+                    commented = _counts_by(comments, "message_id", "message__sender_id", "receiver_id")
+                    _add_to_counter(User, "messages_sent_count", dict((sender_id, -count) for (sender_id,), count in sent.items() if sender_id not in removed))
+                    _add_to_counter(User, "messages_received_count", dict((receiver_id, -count) for (receiver_id,), count in received.items() if receiver_id not in removed))
+                    _add_to_counter(User, "comments_count", dict((sender_id, -count) for (sender_id,), count in written.items() if sender_id not in removed))
+                    _add_to_counter(message_model, "comments_count", dict((message_id, -count) for (message_id, sender_id, receiver_id), count in commented.items() if sender_id not in removed and receiver_id not in removed))
+                    receiver_ids.update(receiver_id for (receiver_id,) in received)
+                    receiver_ids.update(receiver_id for message_id, sender_id, receiver_id in commented)
+
+                    # Dependents first, so nothing is left for a cascade (`_raw_delete()` is a single DELETE, without the collector):
+                    deleted["comments"] += comments._raw_delete(router.db_for_write(comment_model))
+                    deleted["messages"] += messages._raw_delete(router.db_for_write(message_model))
+            for batch in batches:
+                deleted["users"] += User.objects.filter(id__in=batch)._raw_delete(router.db_for_write(User))
+
+        wall_cache.bump(*receiver_ids)
+        for user_id in user_ids:
+            user_cache.invalidate(user_id)
+        logger.info("user.removed", user_ids=user_ids, **deleted)
+        return deleted
+
+    def schedule_removal(self, **kwargs):
+        """
+        Hides users at once and queues their deletion, for users whose history is too large to delete in one go.
+
+        Parameters:
+        - `self` - Instance to whom this method belongs.
+        - `**kwargs` - Dictionary object containing `user_ids` to remove.
+
+        Notes: Sets `deleted_at`, which hides the users from `User.objects` (so they cannot log
+        in and are gone from the directory) and their messages and comments from every wall,
+        and records a `UserDeletion` job per user. Their rows are then deleted in small chunks
+        by a background worker (see `./deletion.py`). Returns the number of users hidden.
+        """
+
+        now = timezone.now()
+        with transaction.atomic():
+            user_ids = list(self.filter(id__in=set(int(user_id) for user_id in kwargs["user_ids"])).values_list("id", flat=True))
+            self.filter(id__in=user_ids).update(deleted_at=now, updated_at=now)
+            UserDeletion.objects.bulk_create([UserDeletion(user_id=user_id) for user_id in user_ids])
+
+        # Walls the users wrote on (and their own) must drop their messages and comments:
+        receiver_ids = set(user_ids)
+        for message_model, comment_model in MESSAGE_TIERS:
+            receiver_ids.update(message_model.objects.filter(sender_id__in=user_ids).values_list("receiver_id", flat=True).distinct())
+            receiver_ids.update(comment_model.objects.filter(sender_id__in=user_ids).values_list("receiver_id", flat=True).distinct())
+        wall_cache.bump(*receiver_ids)
+        for user_id in user_ids:
+            user_cache.invalidate(user_id)
+        logger.info("user.removal_scheduled", user_ids=user_ids)
+        return len(user_ids)
+
+    def bulk_update_level(self, **kwargs):
+        """
+        Sets the user level of many users at once.
+
+        Parameters:
+        - `self` - Instance to whom this method belongs.
+        - `**kwargs` - Dictionary object with `user_ids`, the new `user_level`, and `admin_id` of the admin making the change.
+
+        Validations:
+        - User Level - 0 (normal) or 1 (admin)
+        - Users - At least one, not counting the admin (who cannot change their own level here)
+
+        Notes: One transaction of set-based UPDATEs, one per `DELETE_BATCH_SIZE` users; users
+        already at the level are left alone. Returns the number of users changed.
+        """
+
+        errors = []
+
+        # Check the level is one we know:
+        if str(kwargs["user_level"]) not in ("0", "1"):
+            errors.append("User level must be Normal or Admin.")
+
+        # Admins keep their own level, so they cannot lock themselves out:
+        user_ids = sorted(set(int(user_id) for user_id in kwargs["user_ids"]) - set([int(kwargs["admin_id"])]))
+        if len(user_ids) == 0:
+            errors.append("Select at least one other user.")
+
+        if len(errors) > 0:
+            logger.info("user.bulk_update_level.invalid", errors=errors)
+            return {
+                "errors": errors,
+            }
+
+        user_level = int(kwargs["user_level"])
+        changed = 0
+        with transaction.atomic():
+            for start in range(0, len(user_ids), DELETE_BATCH_SIZE):
+                changed += self.filter(id__in=user_ids[start:start + DELETE_BATCH_SIZE]).exclude(user_level=user_level).update(user_level=user_level, updated_at=timezone.now())
+        for user_id in user_ids:
+            user_cache.invalidate(user_id)
+        logger.info("user.bulk_level_updated", user_ids=user_ids, user_level=user_level, changed=changed)
+        return changed
+
+    def directory_page(self, **kwargs):
+        """
+        Returns one page of the user directory, ordered by last name.
+
+        Parameters:
+        - `self` - Instance to whom this method belongs.
+        - `**kwargs` - Dictionary object with `page_size`, and optional `after` / `before` cursors.
+
+        Notes: Uses keyset pagination on (last_name, id), backed by a composite index, so
+        every page is a single index range scan no matter how deep into the directory it is.
+        """
+
+        return keyset_paginate(self.get_queryset(), ["last_name", "id"], kwargs["page_size"], after=kwargs.get("after"), before=kwargs.get("before"))
+
+    def search_page(self, **kwargs):
+        """
+        Returns one page of users matching a search, best matches first.
+
+        Parameters:
+        - `self` - Instance to whom this method belongs.
+        - `**kwargs` - Dictionary object with `query`, `page_size`, and optional `after` / `before` cursors.
+
+        Notes: Matches names, email and description through the FTS5 index (see `./search.py`),
+        ranked by bm25. Pages are keyset paginated on (score, id), like `directory_page()`.
+        Each user on the page gets a `search_score` attribute.
+        """
+
+        match = search.match_expression(kwargs["query"])
+        if match is None:
+            return KeysetPage([], kwargs["page_size"])
+        page_size = kwargs["page_size"]
+        # Cursors are (score, id):
+        key_fields = [models.FloatField(), self.model._meta.get_field("id")]
+        after = decode_cursor(kwargs.get("after"), key_fields)
+        before = decode_cursor(kwargs.get("before"), key_fields)
+
+        # Fetch one extra row to learn whether another page exists:
+        if before is not None:
+            rows = search.ranked_ids(match, page_size + 1, before=before)
+            has_previous = len(rows) > page_size
+            rows = rows[:page_size][::-1]
+            has_next = True
+        else:
+            rows = search.ranked_ids(match, page_size + 1, after=after)
+            has_next = len(rows) > page_size
+            rows = rows[:page_size]
+            has_previous = after is not None
+
+        users = self.in_bulk([user_id for score, user_id in rows])
+        items = []
+        for score, user_id in rows:
+            if user_id in users:
+                users[user_id].search_score = score
+                items.append(users[user_id])
+        next_cursor = encode_cursor(rows[-1]) if has_next and rows else None
+        prev_cursor = encode_cursor(rows[0]) if has_previous and rows else None
+        return KeysetPage(items, page_size, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
 class MessageManager(models.Manager):
     """Additional instance method functions for `Message`"""
 
@@ -410,14 +617,149 @@ class MessageManager(models.Manager):
             errors = {
                 "errors" : errors,
             }
-            print errors["errors"]
+            logger.info("message.add.invalid", errors=errors["errors"])
             return errors
 
-        # Create new message with sender and receiver:
-        new_message = Message(description=kwargs["description"], sender=User.objects.get(id=kwargs["sender_id"]), receiver=User.objects.get(id=kwargs["receiver_id"]))
-        new_message.save()
+        # Check that the sender and receiver both exist and are not being removed (a stale session
+        # can outlive its user), in one query:
+        user_ids = set(int(user_id) for user_id in (kwargs["sender_id"], kwargs["receiver_id"])) # one id when posting on one's own wall
+        if User.objects.filter(id__in=user_ids).count() != len(user_ids):
+            return {
+                "errors": ["User not found."],
+            }
+
+        # Create new message with sender and receiver (assigning ids, so neither user row is fetched),
+        # and count it for both users in the same transaction:
+        new_message = Message(description=kwargs["description"], sender_id=kwargs["sender_id"], receiver_id=kwargs["receiver_id"])
+        with transaction.atomic():
+            new_message.save()
+            update_counters(messages=[(new_message.sender_id, new_message.receiver_id)])
+        wall_cache.bump(kwargs["receiver_id"])
+        # Wake viewers waiting on this wall (see `views.live_wall()`):
+        pubsub.publish(pubsub.WALL_TOPIC.format(new_message.receiver_id))
         return new_message
 
+    def wall(self, **kwargs):
+        """
+        Returns messages received by a user, ready for `show_user.html` (unordered, see `wall_page()`).
+
+        Parameters:
+        - `**kwargs` - Dictionary object containing `receiver_id` of the user whose wall is loaded.
+
+        Notes: Senders are joined in, and comments (with their senders) are prefetched in one
+        extra query, so a page of the wall costs two queries no matter how many messages it holds.
+        """
+
+        # Messages and comments of users being removed are hidden (filtering on the joined sender costs nothing extra):
+        comments = Comment.objects.filter(sender__deleted_at__isnull=True).select_related("sender").order_by("created_at")
+        return self.filter(receiver_id=kwargs["receiver_id"], sender__deleted_at__isnull=True).select_related("sender").prefetch_related(models.Prefetch("comment", queryset=comments))
+
+    def wall_page(self, **kwargs):
+        """
+        Returns one page of a user's wall, newest messages first.
+
+        Parameters:
+        - `**kwargs` - Dictionary object with `receiver_id`, `page_size`, and an optional `after` cursor.
+
+        Notes: Uses keyset pagination on (receiver_id, created_at, id), backed by a composite index,
+        so loading a page costs the same however old the wall is. Archived messages (see `archive()`)
+        are older than every message left, so they are only read once a deep page runs past the hot
+        ones, and then continue the same page.
+        """
+
+        walls = [self.wall(receiver_id=kwargs["receiver_id"]), ArchivedMessage.objects.wall(receiver_id=kwargs["receiver_id"])]
+        return tiered_paginate(walls, ["-created_at", "-id"], kwargs["page_size"], after=kwargs.get("after"))
+
+    def archive(self, **kwargs):
+        """
+        Moves a batch of the oldest messages, with their comments, to the archive tables.
+
+        Parameters:
+        - `self` - Instance to whom this method belongs.
+        - `**kwargs` - Dictionary object with `before` (messages created before this time are moved) and `batch_size` (most messages moved, at most 999).
+
+        Notes: One short transaction. The messages are copied with a single INSERT ... SELECT, which
+        also takes the write lock, so no comment can be added to them until their comments are copied
+        too; then both are deleted from the hot tables by id. Messages move in id order, which is the
+        order they were created in, so every archived message is older than every message left (see
+        `wall_page()`). Ids and counters are kept: archived rows still count for their users.
+        Archived messages are read-only (`CommentManager.add()` only finds hot ones).
+
+        Returns the number of messages and comments moved; no messages means nothing is left to archive.
+        """
+
+        db = router.db_for_write(Message)
+        connection = connections[db]
+        before = connection.ops.adapt_datetimefield_value(kwargs["before"])
+        moved = {"messages": 0, "comments": 0}
+        with transaction.atomic(using=db):
+            with connection.cursor() as cursor:
+                cursor.execute(_copy_rows_sql(Message, ArchivedMessage, "created_at < %s ORDER BY id LIMIT %s"), [before, kwargs["batch_size"]])
+                if not cursor.rowcount:
+                    return moved
+                # Nothing was written since (we hold the lock), so this reads the rows just copied:
+                messages = list(self.filter(created_at__lt=kwargs["before"]).order_by("id").values_list("id", "receiver_id")[:kwargs["batch_size"]])
+                message_ids = [message[0] for message in messages]
+                cursor.execute(_copy_rows_sql(Comment, ArchivedComment, "message_id IN ({})".format(", ".join(["%s"] * len(message_ids)))), message_ids)
+            moved["comments"] = Comment.objects.filter(message_id__in=message_ids)._raw_delete(db)
+            moved["messages"] = self.filter(id__in=message_ids)._raw_delete(db)
+
+        # Archived messages are shown without a comment form:
+        wall_cache.bump(*set(message[1] for message in messages))
+        logger.info("message.archived", **moved)
+        return moved
+
+    def wall_cursor(self, **kwargs):
+        """
+        Returns a cursor marking the newest message and comment on a user's wall, to pass to `wall_updates()`.
+
+        Parameters:
+        - `**kwargs` - Dictionary object containing `receiver_id` of the user whose wall is shown.
+        """
+
+        last_message = self.filter(receiver_id=kwargs["receiver_id"]).order_by("-id").values_list("id", flat=True).first()
+        last_comment = Comment.objects.filter(receiver_id=kwargs["receiver_id"]).order_by("-id").values_list("id", flat=True).first()
+        return encode_cursor([last_message or 0, last_comment or 0])
+
+    def wall_updates(self, **kwargs):
+        """
+        Returns the messages and comments posted to a user's wall after a cursor, oldest first.
+
+        Parameters:
+        - `**kwargs` - Dictionary object with `receiver_id` and `cursor` (from `wall_cursor()`, or a previous update).
+
+        Notes: Ids only grow (AUTOINCREMENT, one writer at a time), so new rows are the ones with
+        larger ids than the cursor's, found through the receiver indexes. Returns `messages` (with
+        senders and comments, like `wall()`), `comments` (with senders, not counting comments on
+        those messages) and the `cursor` to ask with next; at most `WALL_UPDATES_LIMIT` of each,
+        the rest come with the next cursor.
+        """
+
+        errors = []
+
+        # Check the cursor is one of ours:
+        values = decode_cursor(kwargs["cursor"], [self.model._meta.get_field("id"), Comment._meta.get_field("id")])
+        if values is None:
+            errors.append("Invalid cursor.")
+            return {
+                "errors": errors,
+            }
+        last_message, last_comment = values
+
+        messages = list(self.wall(receiver_id=kwargs["receiver_id"]).filter(id__gt=last_message).order_by("id")[:WALL_UPDATES_LIMIT])
+        comments = list(Comment.objects.filter(receiver_id=kwargs["receiver_id"], id__gt=last_comment, sender__deleted_at__isnull=True).select_related("sender").order_by("id")[:WALL_UPDATES_LIMIT])
+        if messages:
+            last_message = messages[-1].id
+        if comments:
+            last_comment = comments[-1].id
+        # Comments on new messages are shown with them:
+        message_ids = set(message.id for message in messages)
+        return {
+            "messages": messages,
+            "comments": [comment for comment in comments if comment.message_id not in message_ids],
+            "cursor": encode_cursor([last_message, last_comment]),
+        }
+
 
 class CommentManager(models.Manager):
     """Additional instance method functions for `Comment`"""
@@ -440,9 +782,23 @@ class CommentManager(models.Manager):
             }
             return errors
 
-        # Else if no errors detected above, Get Sender, Receiver, and Message to which Comment belongs, create Comment:
-        new_comment = Comment(description=kwargs["description"], sender=User.objects.get(id=kwargs["sender_id"]), receiver=User.objects.get(id=kwargs["receiver_id"]), message=Message.objects.get(id=kwargs["message_id"]))
-        new_comment.save()
+        # Check that the commenter exists and is not being removed (a stale session can outlive its user):
+        commenter = User.objects.filter(id=kwargs["sender_id"])
+        # ...and, in the same query, that the message exists, belongs to the receiver's wall, and
+        # neither its sender nor the receiver is being removed:
+        if not Message.objects.filter(id=kwargs["message_id"], receiver_id=kwargs["receiver_id"], sender__deleted_at__isnull=True, receiver__deleted_at__isnull=True).annotate(commenter=Exists(commenter)).filter(commenter=True).exists():
+            return {
+                "errors": ["Message not found."],
+            }
+
+        # Else if no errors detected above, create Comment (assigning ids, so no user or message rows are fetched):
+        new_comment = Comment(description=kwargs["description"], sender_id=kwargs["sender_id"], receiver_id=kwargs["receiver_id"], message_id=kwargs["message_id"])
+        with transaction.atomic():
+            new_comment.save()
+            # Count it for the sender and the message in the same transaction:
+            update_counters(comments=[(new_comment.sender_id, new_comment.message_id)])
+        wall_cache.bump(kwargs["receiver_id"])
+        pubsub.publish(pubsub.WALL_TOPIC.format(new_comment.receiver_id))
         return new_comment
 
 class User(models.Model):
@@ -450,23 +806,40 @@ class User(models.Model):
 
     first_name = models.CharField(max_length=50)
     last_name = models.CharField(max_length=50)
-    email = models.CharField(max_length=50)
+    email = models.CharField(max_length=50, unique=True)
     password = models.CharField(max_length=22)
     description = models.CharField(max_length=500, default="This user has not set a description yet.")
     user_level = models.IntegerField(default=0) # integer representing user level: 0 = normal user (default), 1 = administrator
+    # Activity counters, kept up to date by `update_counters()` (rebuild with `manage.py reconcile_counters`):
+    messages_sent_count = models.IntegerField(default=0)
+    messages_received_count = models.IntegerField(default=0)
+    comments_count = models.IntegerField(default=0) # comments written
+    deleted_at = models.DateTimeField(null=True, default=None) # set while the user is removed in the background, see `UserManager.schedule_removal()`
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     objects = UserManager() # Adds additional instance methods to `User`
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["last_name", "id"]), # Keyset pagination for the dashboard directory
+        ]
+
 class Message(models.Model):
     """Creates instances of a `Message`."""
 
     description = models.CharField(max_length=500)
     sender = models.ForeignKey(User, related_name="messages_sent", on_delete=models.CASCADE) # This is the sender.
     receiver = models.ForeignKey(User, related_name="messages_received", on_delete=models.CASCADE) # This is the receiver.
+    comments_count = models.IntegerField(default=0) # kept up to date by `update_counters()`
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     objects = MessageManager() # Adds additional instance methods to `Message`
+    archived = False # see `ArchivedMessage`
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["receiver", "created_at", "id"]), # Keyset pagination of message walls
+        ]
 
 class Comment(models.Model):
     """Creates instances of a `Comment`."""
@@ -478,3 +851,127 @@ class Comment(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     objects = CommentManager() # Adds additional instance methods to `Comment`
+
+class ArchivedMessageManager(models.Manager):
+    """Additional instance method functions for `ArchivedMessage`"""
+
+    def wall(self, **kwargs):
+        """
+        Returns a user's archived messages with senders and comments preloaded, like `MessageManager.wall()`.
+
+        Parameters:
+        - `**kwargs` - Dictionary object containing `receiver_id` of the user whose wall is shown.
+        """
+
+        comments = ArchivedComment.objects.filter(sender__deleted_at__isnull=True).select_related("sender").order_by("created_at")
+        return self.filter(receiver_id=kwargs["receiver_id"], sender__deleted_at__isnull=True).select_related("sender").prefetch_related(models.Prefetch("comment", queryset=comments))
+
+class ArchivedMessage(models.Model):
+    """Creates instances of an `ArchivedMessage`, an old `Message` moved out of the hot table (see `MessageManager.archive()`)."""
+
+    id = models.IntegerField(primary_key=True) # the message's own id (never reused, AUTOINCREMENT), so wall cursors stay valid
+    description = models.CharField(max_length=500)
+    sender = models.ForeignKey(User, related_name="archived_messages_sent", on_delete=models.CASCADE)
+    receiver = models.ForeignKey(User, related_name="archived_messages_received", on_delete=models.CASCADE)
+    comments_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField() # copied from the message
+    updated_at = models.DateTimeField()
+    objects = ArchivedMessageManager() # Adds additional instance methods to `ArchivedMessage`
+    archived = True # read-only history, shown without a comment form
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["receiver", "created_at", "id"]), # Keyset pagination of deep message wall pages
+        ]
+
+class ArchivedComment(models.Model):
+    """Creates instances of an `ArchivedComment`, a `Comment` archived with its message."""
+
+    id = models.IntegerField(primary_key=True) # the comment's own id
+    description = models.CharField(max_length=500)
+    sender = models.ForeignKey(User, related_name="archived_comments_sent", on_delete=models.CASCADE)
+    receiver = models.ForeignKey(User, related_name="archived_comments_received", on_delete=models.CASCADE)
+    message = models.ForeignKey(ArchivedMessage, on_delete=models.CASCADE, related_name="comment") # same name as `Message.comment`, so templates show both alike
+    created_at = models.DateTimeField() # copied from the comment
+    updated_at = models.DateTimeField()
+
+# Message tables, newest first, as (message model, comment model); a comment is always in its message's tier:
+MESSAGE_TIERS = [(Message, Comment), (ArchivedMessage, ArchivedComment)]
+
+def _copy_rows_sql(source, target, where):
+    """
+    Returns an INSERT ... SELECT copying rows of `source` into `target`, which has the same columns.
+
+    Parameters:
+    - `source` - Model copied from.
+    - `target` - Model copied to.
+    - `where` - SQL after WHERE, with `%s` placeholders (may end in ORDER BY and LIMIT).
+    """
+
+    quote_name = connections[router.db_for_write(source)].ops.quote_name
+    columns = ", ".join(quote_name(field.column) for field in source._meta.concrete_fields)
+    return "INSERT INTO {} ({}) SELECT {} FROM {} WHERE {}".format(quote_name(target._meta.db_table), columns, columns, quote_name(source._meta.db_table), where)
+
+class UserDeletion(models.Model):
+    """Creates instances of a `UserDeletion`, the progress of removing a hidden user in the background (see `./deletion.py`)."""
+
+    user_id = models.IntegerField(unique=True) # not a foreign key, the job outlives the user row
+    comments_deleted = models.IntegerField(default=0)
+    messages_deleted = models.IntegerField(default=0)
+    lease_owner = models.CharField(max_length=100, default="") # worker holding the job
+    lease_expires = models.DateTimeField(null=True, default=None) # another worker may take over after this
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, default=None)
+
+COUNTER_BATCH_SIZE = 500 # ids per counter UPDATE (SQLite allows 999 query parameters)
+
+def _counts_by(queryset, *fields):
+    """Returns {(values of `fields`): number of rows} for `queryset`, grouped by the database."""
+
+    return dict((tuple(row[field] for field in fields), row["count"]) for row in queryset.order_by().values(*fields).annotate(count=Count("id")))
+
+def _add_to_counter(model, field, deltas):
+    """
+    Adds deltas to a counter column with atomic `F()` updates, one UPDATE per distinct delta.
+
+    Parameters:
+    - `model` - Model class holding the counter.
+    - `field` - Name of the counter field.
+    - `deltas` - Dictionary of {primary key: amount to add}.
+    """
+
+    ids_by_delta = defaultdict(list)
+    for pk, delta in deltas.items():
+        # `None` keys stand for rows being deleted, which need no update:
+        if delta and pk is not None:
+            ids_by_delta[delta].append(pk)
+    for delta, ids in ids_by_delta.items():
+        for start in range(0, len(ids), COUNTER_BATCH_SIZE):
+            model.objects.filter(id__in=ids[start:start + COUNTER_BATCH_SIZE]).update(**{field: F(field) + delta})
+
+def update_counters(messages=(), comments=(), sign=1, message_model=None):
+    """
+    Updates the denormalized activity counters for messages and comments added (or removed).
+
+    Call it in the same transaction as the write. Counts are grouped, so a batch costs a few
+    UPDATEs however many rows it holds.
+
+    Parameters:
+    - `messages` - Iterable of (sender_id, receiver_id) of messages added.
+    - `comments` - Iterable of (sender_id, message_id) of comments added.
+    - `sign` - 1 for rows added, -1 for rows removed.
+    - `message_model` - Model of the messages commented on (default `Message`; `ArchivedMessage` for archived comments).
+    """
+
+    sent, received, written, per_message = Counter(), Counter(), Counter(), Counter()
+    for sender_id, receiver_id in messages:
+        sent[sender_id] += sign
+        received[receiver_id] += sign
+    for sender_id, message_id in comments:
+        written[sender_id] += sign
+        per_message[message_id] += sign
+    _add_to_counter(User, "messages_sent_count", sent)
+    _add_to_counter(User, "messages_received_count", received)
+    _add_to_counter(User, "comments_count", written)
+    _add_to_counter(message_model or Message, "comments_count", per_message)
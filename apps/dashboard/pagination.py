@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import base64 # base64 for url-safe cursor encoding
+import json # json for cursor payloads
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+class KeysetPage(object):
+    """Creates instances of a `KeysetPage`, a single page of keyset (cursor) paginated results."""
+
+    def __init__(self, items, page_size, next_cursor=None, prev_cursor=None):
+        """
+        Parameters:
+        - `items` - List of objects on this page, in display order.
+        - `page_size` - Maximum number of objects per page.
+        - `next_cursor` - Cursor pointing after the last item (None if this is the last page).
+        - `prev_cursor` - Cursor pointing before the first item (None if this is the first page).
+        """
+
+        self.items = items
+        self.page_size = page_size
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(values):
+    """
+    Encodes a list of key values into an opaque, url-safe cursor string.
+
+    Parameters:
+    - `values` - List of key values (strings, integers or datetimes).
+    """
+
+    # Datetimes are stored as ISO strings, which Django parses back when filtering:
+    values = [value.isoformat() if hasattr(value, "isoformat") else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor, fields):
+    """
+    Decodes a cursor string back into a list of key values.
+
+    Parameters:
+    - `cursor` - Cursor string from the query string.
+    - `fields` - Model fields of the key values, eg: `[User._meta.get_field("last_name"), User._meta.get_field("id")]`;
+      each value is converted with its field's `to_python()`.
+
+    Returns None if the cursor is missing or has been tampered with (including values of the wrong type).
+    """
+
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+    if not isinstance(values, list) or len(values) != len(fields):
+        return None
+    # Only strings and numbers are encoded (lists, objects and None would pass some fields' `to_python()`):
+    if not all(isinstance(value, (basestring, int, long, float)) for value in values):
+        return None
+    try:
+        return [field.to_python(value) for field, value in zip(fields, values)]
+    except (TypeError, ValueError, ValidationError):
+        return None
+
+def model_fields(model, fields):
+    """Returns the model fields behind ordering fields, eg: ["-created_at", "-id"]."""
+
+    return [model._meta.get_field(field.lstrip("-")) for field in fields]
+
+def _keyset_filter(fields, values, forward):
+    """
+    Builds a `Q` object selecting rows strictly after (or before) the given key.
+
+    For keys (a, b) ordered ascending, "after" expands to: a > x OR (a = x AND b > y).
+    Fields prefixed with "-" are ordered descending, so their comparison is flipped.
+
+    Parameters:
+    - `fields` - Ordering fields, eg: ["last_name", "id"] or ["-created_at", "-id"].
+    - `values` - Key values of the row we are paging from.
+    - `forward` - True for rows after the key, False for rows before it.
+    """
+
+    condition = Q()
+    equal_so_far = Q()
+    for field, value in zip(fields, values):
+        descending = field.startswith("-")
+        name = field.lstrip("-")
+        lookup = "gt" if descending != forward else "lt"
+        condition |= equal_so_far & Q(**{"{}__{}".format(name, lookup): value})
+        equal_so_far &= Q(**{name: value})
+    return condition
+
+def _key_of(obj, fields):
+    """Returns the key values of `obj` for the given ordering fields."""
+
+    return [getattr(obj, field.lstrip("-")) for field in fields]
+
+def keyset_paginate(queryset, fields, page_size, after=None, before=None):
+    """
+    Returns a `KeysetPage` from `queryset`, ordered by `fields`.
+
+    Unlike OFFSET pagination, each page is a single indexed range scan, so page N
+    costs the same as page 1. The last field should be unique (eg: "id").
+
+    Parameters:
+    - `queryset` - Unordered queryset to paginate.
+    - `fields` - Ordering fields, eg: ["last_name", "id"].
+    - `page_size` - Number of rows per page.
+    - `after` - Cursor of the last row on the previous page (loads the next page).
+    - `before` - Cursor of the first row on the following page (loads the previous page).
+    """
+
+    reverse_fields = [field[1:] if field.startswith("-") else "-" + field for field in fields]
+    after_key = decode_cursor(after, model_fields(queryset.model, fields))
+    before_key = decode_cursor(before, model_fields(queryset.model, fields))
+
+    # Paging backwards: read in reverse order from the cursor, then flip the rows back:
+    if before_key is not None:
+        rows = list(queryset.filter(_keyset_filter(fields, before_key, False)).order_by(*reverse_fields)[:page_size + 1])
+        has_previous = len(rows) > page_size
+        items = rows[:page_size][::-1]
+        has_next = True
+    else:
+        if after_key is not None:
+            queryset = queryset.filter(_keyset_filter(fields, after_key, True))
+        # Fetch one extra row to learn whether another page exists:
+        rows = list(queryset.order_by(*fields)[:page_size + 1])
+        has_next = len(rows) > page_size
+        items = rows[:page_size]
+        has_previous = after_key is not None
+
+    next_cursor = encode_cursor(_key_of(items[-1], fields)) if has_next and items else None
+    prev_cursor = encode_cursor(_key_of(items[0], fields)) if has_previous and items else None
+    return KeysetPage(items, page_size, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+def _sort_by_key(rows, fields):
+    """Sorts `rows` in place by the ordering fields (one stable sort per field, last field first)."""
+
+    for field in reversed(fields):
+        rows.sort(key=lambda row: getattr(row, field.lstrip("-")), reverse=field.startswith("-"))
+    return rows
+
+def tiered_paginate(querysets, fields, page_size, after=None):
+    """
+    Returns a `KeysetPage` read across tiers of the same kind of rows, eg: hot messages, then archived ones.
+
+    A tier is only read once the tiers before it run out after the cursor, so pages of recent
+    rows never touch the archive. What a tier returns is merged, in key order, with what was left
+    in the earlier tiers, so the page is exact as long as no row of a later tier sorts before a
+    row of an earlier one that still fills a page (the archive holds the oldest rows). Cursors are
+    the same as `keyset_paginate()`'s, so a page can be loaded after any row of any tier.
+
+    Parameters:
+    - `querysets` - Unordered querysets, newest tier first.
+    - `fields` - Ordering fields, eg: ["-created_at", "-id"] (the last one unique across every tier).
+    - `page_size` - Number of rows per page.
+    - `after` - Cursor of the last row on the previous page (loads the next page).
+    """
+
+    # Every tier has the same key fields:
+    after_key = decode_cursor(after, model_fields(querysets[0].model, fields))
+    rows = []
+    for queryset in querysets:
+        if after_key is not None:
+            queryset = queryset.filter(_keyset_filter(fields, after_key, True))
+        # Fetch one extra row to learn whether another page exists:
+        tier_rows = list(queryset.order_by(*fields)[:page_size + 1])
+        rows = _sort_by_key(rows + tier_rows, fields)
+        if len(tier_rows) > page_size:
+            # This tier fills the page by itself, the later ones hold older rows:
+            break
+    has_next = len(rows) > page_size
+    items = rows[:page_size]
+
+    next_cursor = encode_cursor(_key_of(items[-1], fields)) if has_next and items else None
+    prev_cursor = encode_cursor(_key_of(items[0], fields)) if after_key is not None and items else None
+    return KeysetPage(items, page_size, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+def page_size_from_request(request, default, maximum):
+    """
+    Reads an optional `per_page` query parameter, bounded by `maximum`.
+
+    Parameters:
+    - `request` - Current request.
+    - `default` - Page size used when `per_page` is missing or invalid.
+    - `maximum` - Upper bound on page size.
+    """
+
+    try:
+        page_size = int(request.GET.get("per_page", default))
+    except (TypeError, ValueError):
+        page_size = default
+    return max(1, min(page_size, maximum))
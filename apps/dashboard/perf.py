@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Per-request timing: SQL, template rendering and total time, with rolling percentiles per URL pattern.
+
+`PerfMiddleware` samples a share of requests (`PERF_SAMPLE_RATE`). For a sampled request it
+counts and times every SQL query run on the request's thread, times template rendering, and,
+for admins only (unless `PERF_SERVER_TIMING_PUBLIC`), sends the totals in a `Server-Timing`
+response header, which browser developer tools show next to the request:
+
+    Server-Timing: sql;dur=3.41;desc="7 queries", tpl;dur=5.02, total;dur=11.87
+
+The numbers are also kept in memory per URL pattern, the last `PERF_WINDOW` samples each,
+and `/debug/perf` (admins only) shows their p50/p95/p99. Requests that are not sampled cost
+one random number; queries and renders outside a sampled request cost one thread-local lookup.
+
+- SQL: every connection's cursors are wrapped when the connection opens (see `instrument_connection()`, connected in `./apps.py`).
+- Templates: the `TimedDjangoTemplates` backend (set in `TEMPLATES`) times each top-level render,
+  including any queries it runs (lazy querysets), which also count as SQL.
+- Streaming responses are timed until the view returns them, not until they are sent.
+
+Numbers are per process; each worker process shows its own.
+
+Settings (see `user_dashboard/settings.py`):
+- `PERF_SAMPLE_RATE` - Share of requests measured, 0 (off) to 1 (every request).
+- `PERF_WINDOW` - Samples kept per URL pattern.
+- `PERF_SERVER_TIMING_PUBLIC` - Send `Server-Timing` to every client, not only to admins.
+"""
+from __future__ import unicode_literals
+import random
+import re
+import threading
+import time
+from collections import deque
+from django.conf import settings
+from django.db.backends.utils import CursorWrapper, CursorDebugWrapper
+from django.template.backends.django import DjangoTemplates
+from django.urls import get_resolver
+from .benchmarks import percentile # nearest-rank percentiles
+
+UNRESOLVED = "<unresolved>" # requests answered before URL resolution (eg: static assets) or by no pattern (404s)
+
+_context = threading.local() # `timings` of the sampled request running on this thread, if any
+
+
+class RequestTimings(object):
+    """Creates instances of `RequestTimings`, what a sampled request spent on SQL and templates."""
+
+    def __init__(self):
+        self.queries = 0
+        self.sql = 0.0 # seconds
+        self.template = 0.0 # seconds
+        self.template_depth = 0 # renders in progress (nested ones are counted in the outer one)
+
+    def server_timing(self, total):
+        """Returns the `Server-Timing` header value for these timings and the request's `total` seconds."""
+
+        return 'sql;dur={:.2f};desc="{} queries", tpl;dur={:.2f}, total;dur={:.2f}'.format(self.sql * 1000, self.queries, self.template * 1000, total * 1000)
+
+
+def _current():
+    return getattr(_context, "timings", None)
+
+
+class TimedCursorWrapper(CursorWrapper):
+    """Cursor wrapper adding each query to the `RequestTimings` of the sampled request on its thread."""
+
+    def execute(self, sql, params=None):
+        timings = _current()
+        if timings is None:
+            return super(TimedCursorWrapper, self).execute(sql, params)
+        start = time.time()
+        try:
+            return super(TimedCursorWrapper, self).execute(sql, params)
+        finally:
+            timings.sql += time.time() - start
+            timings.queries += 1
+
+    def executemany(self, sql, param_list):
+        timings = _current()
+        if timings is None:
+            return super(TimedCursorWrapper, self).executemany(sql, param_list)
+        start = time.time()
+        try:
+            return super(TimedCursorWrapper, self).executemany(sql, param_list)
+        finally:
+            timings.sql += time.time() - start
+            timings.queries += 1
+
+
+class TimedCursorDebugWrapper(CursorDebugWrapper, TimedCursorWrapper):
+    """`TimedCursorWrapper` for connections logging their queries (DEBUG, tests); the logging itself is not timed."""
+    pass
+
+
+def instrument_connection(sender, connection, **kwargs):
+    """Wraps the cursors of a new database connection with the query timers (a `connection_created` signal receiver)."""
+
+    connection.make_cursor = lambda cursor: TimedCursorWrapper(cursor, connection)
+    connection.make_debug_cursor = lambda cursor: TimedCursorDebugWrapper(cursor, connection)
+
+
+class TimedTemplate(object):
+    """
+    Creates instances of a `TimedTemplate`, which times the renders of a backend template.
+
+    Parameters:
+    - `template` - Template returned by `DjangoTemplates`.
+    """
+
+    def __init__(self, template):
+        self.wrapped = template
+
+    def __getattr__(self, name):
+        # Everything but `render()` (eg: `origin`, `template`) is the wrapped template's:
+        return getattr(self.wrapped, name)
+
+    def render(self, context=None, request=None):
+        timings = _current()
+        if timings is None:
+            return self.wrapped.render(context, request)
+        timings.template_depth += 1
+        start = time.time()
+        try:
+            return self.wrapped.render(context, request)
+        finally:
+            timings.template_depth -= 1
+            if not timings.template_depth:
+                timings.template += time.time() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """The Django template backend, with renders timed for sampled requests (see `TimedTemplate`)."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super(TimedDjangoTemplates, self).from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super(TimedDjangoTemplates, self).get_template(template_name))
+
+
+class PerfStats(object):
+    """
+    Creates instances of `PerfStats`, the latest samples per URL pattern.
+
+    Parameters:
+    - `window` - Samples kept per URL pattern (older ones are dropped).
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.samples = {} # route -> deque of (time, total, sql, queries, template), seconds
+        self.counts = {} # route -> samples recorded since start
+        self.lock = threading.Lock()
+
+    def record(self, route, timings, total):
+        """Adds the `RequestTimings` of one request to `route`, which took `total` seconds."""
+
+        sample = (time.time(), total, timings.sql, timings.queries, timings.template)
+        with self.lock:
+            if route not in self.samples:
+                self.samples[route] = deque(maxlen=self.window)
+                self.counts[route] = 0
+            self.samples[route].append(sample)
+            self.counts[route] += 1
+
+    def snapshot(self):
+        """Returns one summary per route (percentiles in milliseconds), slowest p95 first."""
+
+        with self.lock:
+            samples = dict((route, list(kept)) for route, kept in self.samples.items())
+            counts = dict(self.counts)
+
+        summaries = []
+        for route, kept in samples.items():
+            def milliseconds(index):
+                return sorted(round(sample[index] * 1000, 2) for sample in kept)
+            total, sql, template = milliseconds(1), milliseconds(2), milliseconds(4)
+            queries = sorted(sample[3] for sample in kept)
+            summaries.append({
+                "route": route,
+                "count": counts[route],
+                "window": len(kept),
+                "span_s": int(time.time() - kept[0][0]), # age of the oldest sample kept
+                "total_p50_ms": percentile(total, 50),
+                "total_p95_ms": percentile(total, 95),
+                "total_p99_ms": percentile(total, 99),
+                "sql_p50_ms": percentile(sql, 50),
+                "sql_p95_ms": percentile(sql, 95),
+                "queries_p50": percentile(queries, 50),
+                "queries_max": queries[-1],
+                "template_p50_ms": percentile(template, 50),
+                "template_p95_ms": percentile(template, 95),
+            })
+        summaries.sort(key=lambda summary: summary["total_p95_ms"], reverse=True)
+        return summaries
+
+    def reset(self):
+        """Drops every sample."""
+
+        with self.lock:
+            self.samples.clear()
+            self.counts.clear()
+
+
+_stats = None
+_stats_lock = threading.Lock()
+
+def get_stats():
+    """Returns this process's `PerfStats`, created on first use."""
+
+    global _stats
+    with _stats_lock:
+        if _stats is None:
+            _stats = PerfStats(settings.PERF_WINDOW)
+        return _stats
+
+def snapshot():
+    """Returns the rolling timings per URL pattern (see `PerfStats.snapshot()`)."""
+
+    return get_stats().snapshot()
+
+
+_routes = {}
+_routes_lock = threading.Lock()
+
+def _url_patterns(resolver, prefix=""):
+    """Yields (view function, full regex) for every URL pattern under `resolver`."""
+
+    for pattern in resolver.url_patterns:
+        regex = prefix + pattern.regex.pattern.lstrip("^")
+        if hasattr(pattern, "url_patterns"):
+            for found in _url_patterns(pattern, regex):
+                yield found
+        else:
+            yield pattern.callback, regex
+
+def route_of(request):
+    """Returns the URL pattern that served `request`, eg: `^users/show/(?P<id>\\d*)$`."""
+
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return UNRESOLVED
+    urlconf = getattr(request, "urlconf", None) or settings.ROOT_URLCONF
+    with _routes_lock:
+        if urlconf not in _routes:
+            # View function -> its patterns, found once per process:
+            routes = {}
+            for callback, regex in _url_patterns(get_resolver(urlconf)):
+                routes.setdefault(callback, []).append(("^" + regex, re.compile(regex)))
+            _routes[urlconf] = routes
+        routes = _routes[urlconf].get(match.func, [])
+    if len(routes) == 1:
+        return routes[0][0]
+    # A view served by several patterns (eg: `/dashboard` and `/dashboard/admin`):
+    for route, compiled in routes:
+        if compiled.match(request.path_info.lstrip("/")):
+            return route
+    return match.view_name
+
+
+class PerfMiddleware(object):
+    """Measures a sample of requests, records them per URL pattern and adds their `Server-Timing` header for admins."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= settings.PERF_SAMPLE_RATE:
+            return self.get_response(request)
+
+        timings = RequestTimings()
+        _context.timings = timings
+        start = time.time()
+        try:
+            response = self.get_response(request)
+        finally:
+            _context.timings = None
+        total = time.time() - start
+        # Query counts tell clients how a request was handled (eg: whether a sign in email exists),
+        # so only admins get them (`logged_in_user` is set by `SessionUserMiddleware`, further in):
+        user = getattr(request, "logged_in_user", None)
+        if settings.PERF_SERVER_TIMING_PUBLIC or (user is not None and user.user_level == 1):
+            response["Server-Timing"] = timings.server_timing(total)
+        get_stats().record(route_of(request), timings, total)
+        return response
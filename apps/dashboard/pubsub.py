@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+In-process pub/sub broker for live updates, with an optional fan-out between worker processes.
+
+Publishers name a topic (eg: `wall:12`, see `MessageManager.add()` and `CommentManager.add()`);
+waiters block until that topic is published to, or they time out. Events carry no data:
+each topic has a version number, waiters note it before reading the database and wake when
+it changes, so a publish made while they read is never lost. What changed is read from the
+database afterwards (see `views.live_wall()`), which keeps cursors the same in every process.
+
+Fan-out (`LIVE_SOCKET_DIR`): every process binds a Unix datagram socket in a shared directory,
+and a publish is sent to every other socket there, so a post handled by one worker process wakes
+the waiters of all of them. Sends never block; a process that has exited is dropped from the
+directory, and one whose queue is full misses the event, its waiters pick it up when they time out.
+Without it, waiters only wake for posts made in their own process.
+
+Settings (see `user_dashboard/settings.py`):
+- `LIVE_POLL_TIMEOUT` - Seconds a waiter waits for a publish.
+- `LIVE_MAX_WAITERS` - Waiters allowed per process at once (each one holds a worker thread).
+- `LIVE_SOCKET_DIR` - Directory of the fan-out sockets, or None to publish in-process only.
+"""
+from __future__ import unicode_literals
+import errno
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from .log import get_logger # structured logging
+
+logger = get_logger(__name__)
+
+MAX_TOPICS = 10000 # topic versions kept per process; the least recently published are dropped
+MAX_TOPIC_LENGTH = 200 # bytes, the largest datagram read
+WALL_TOPIC = "wall:{}" # a user's message wall, by receiver id
+
+
+class Broker(object):
+    """
+    Creates instances of a `Broker`, which keeps a version per topic and wakes waiters when it changes.
+
+    Parameters:
+    - `max_topics` - Most topic versions kept (a dropped topic reads as version 0 again).
+    """
+
+    def __init__(self, max_topics=MAX_TOPICS):
+        self.max_topics = max_topics
+        self.versions = OrderedDict() # topic -> version, least recently published first
+        self.waiters = 0
+        self.condition = threading.Condition()
+
+    def version(self, topic):
+        """Returns the current version of `topic`."""
+
+        with self.condition:
+            return self.versions.get(topic, 0)
+
+    def publish(self, topic):
+        """Bumps the version of `topic` and wakes its waiters."""
+
+        with self.condition:
+            self.versions[topic] = self.versions.pop(topic, 0) + 1
+            if len(self.versions) > self.max_topics:
+                self.versions.popitem(last=False)
+            self.condition.notify_all()
+
+    def wait(self, topic, version, timeout, max_waiters):
+        """
+        Waits until `topic` is no longer at `version`.
+
+        Parameters:
+        - `topic` - Topic waited on.
+        - `version` - Version the caller has seen (from `version()`).
+        - `timeout` - Most seconds to wait.
+        - `max_waiters` - Waiters allowed at once.
+
+        Returns True if the topic was published to, False on timeout, and None, without
+        waiting, if `max_waiters` callers are already waiting.
+        """
+
+        deadline = time.time() + timeout
+        with self.condition:
+            if self.waiters >= max_waiters:
+                return None
+            self.waiters += 1
+            try:
+                while self.versions.get(topic, 0) == version:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                return True
+            finally:
+                self.waiters -= 1
+
+
+class SocketFanout(object):
+    """
+    Creates instances of a `SocketFanout`, which shares publishes with other processes over Unix datagram sockets.
+
+    Parameters:
+    - `directory` - Directory holding one socket per process (created if missing).
+    - `deliver` - Function called with each topic received from another process (on a background thread).
+    - `name` - Socket file name (default: `<pid>.sock`).
+    """
+
+    def __init__(self, directory, deliver, name=None):
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as err:
+                if err.errno != errno.EEXIST: # another process created it first
+                    raise
+        self.directory = directory
+        self.deliver = deliver
+        self.closed = False
+        self.path = os.path.join(directory, name or "{}.sock".format(os.getpid()))
+        if os.path.exists(self.path):
+            os.remove(self.path) # left behind by an earlier process with our pid
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.listener.bind(self.path)
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.setblocking(False) # never hold up the request that publishes
+        thread = threading.Thread(target=self.listen, name="dashboard-pubsub")
+        thread.daemon = True
+        thread.start()
+
+    def listen(self):
+        """Delivers topics received from other processes, until the socket is closed."""
+
+        while not self.closed:
+            try:
+                data = self.listener.recv(MAX_TOPIC_LENGTH)
+            except socket.error:
+                return
+            if data:
+                self.deliver(data.decode("utf-8"))
+
+    def send(self, topic):
+        """Sends `topic` to every other process's socket."""
+
+        data = topic.encode("utf-8")
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(".sock") or path == self.path:
+                continue
+            try:
+                self.sender.sendto(data, path)
+            except socket.error as err:
+                if err.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    # Nobody listens there any more (the process exited):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                else:
+                    # Eg: the other process's queue is full; its waiters fall back to their timeout:
+                    logger.warning("pubsub.send.failed", path=path, error=str(err))
+
+    def close(self):
+        """Stops listening and removes the socket file."""
+
+        self.closed = True
+        try:
+            self.sender.sendto(b"", self.path) # wakes the listening thread, so it sees `closed`
+        except socket.error:
+            pass
+        self.listener.close()
+        self.sender.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+_broker = Broker()
+_fanout = None
+_fanout_pid = None
+_fanout_lock = threading.Lock()
+
+def get_fanout():
+    """Returns this process's `SocketFanout` (started on first use), or None if `LIVE_SOCKET_DIR` is not set."""
+
+    global _fanout, _fanout_pid
+    if not settings.LIVE_SOCKET_DIR:
+        return None
+    with _fanout_lock:
+        # Worker processes forked after first use need a socket of their own:
+        if _fanout_pid != os.getpid():
+            _fanout = SocketFanout(settings.LIVE_SOCKET_DIR, _broker.publish)
+            _fanout_pid = os.getpid()
+        return _fanout
+
+def publish(topic):
+    """
+    Wakes the waiters on `topic`, in every process.
+
+    Parameters:
+    - `topic` - Name of what changed, eg: `wall:12`.
+    """
+
+    _broker.publish(topic)
+    fanout = get_fanout()
+    if fanout is not None:
+        fanout.send(topic)
+
+def version(topic):
+    """Returns the current version of `topic`, to pass to `wait()`."""
+
+    get_fanout() # listen for other processes' publishes before anyone waits
+    return _broker.version(topic)
+
+def wait(topic, seen_version, timeout=None):
+    """
+    Waits for a publish to `topic` after `seen_version`, for at most `timeout` seconds (default `LIVE_POLL_TIMEOUT`).
+
+    Returns True if it was published to, False on timeout, and None if `LIVE_MAX_WAITERS` are already waiting.
+    """
+
+    if timeout is None:
+        timeout = settings.LIVE_POLL_TIMEOUT
+    return _broker.wait(topic, seen_version, timeout, settings.LIVE_MAX_WAITERS)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Read/write database routing with read replicas.
+
+Writes always go to the primary (`default`). Reads go to a random replica from the
+`READ_REPLICAS` setting only while `ReplicaRoutingMiddleware` allows it for the current
+request, ie: a GET (or HEAD) request from a client that has not written recently, and
+only until the request writes or opens a transaction. Everything else reads from the
+primary: management commands, POSTs, and reads inside `use_primary()`.
+
+Read-your-writes: any request that writes (or is a POST) gets a short-lived pin cookie,
+and requests carrying it read from the primary, so a client sees its own message or
+profile change on the redirect after posting it, whatever the replication lag.
+
+Replicas may lag, so anything that fills a shared cache (the wall cache, the session
+user cache) reads from the primary with `use_primary()`; otherwise a stale replica read
+could be cached under a fresh version and outlive the lag.
+
+Settings (see `user_dashboard/settings.py`):
+- `READ_REPLICAS` - Database aliases of the replicas (empty disables routing).
+- `READ_REPLICA_PIN_SECONDS` - How long a client reads from the primary after writing.
+"""
+from __future__ import unicode_literals
+import random
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_COOKIE = "dashboard_primary"
+SAFE_METHODS = ("GET", "HEAD")
+
+_state = threading.local()
+
+def replica_for_read():
+    """Returns the database alias to read from in the current thread."""
+
+    replicas = settings.READ_REPLICAS
+    if not replicas or not getattr(_state, "replica_reads", False) or getattr(_state, "primary", 0):
+        return DEFAULT_DB_ALIAS
+    # Reads inside a transaction must see its writes:
+    if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return DEFAULT_DB_ALIAS
+    return random.choice(replicas)
+
+@contextmanager
+def use_primary():
+    """Reads from the primary inside the block (nestable)."""
+
+    _state.primary = getattr(_state, "primary", 0) + 1
+    try:
+        yield
+    finally:
+        _state.primary -= 1
+
+
+class ReadReplicaRouter(object):
+    """Sends writes to the primary and, where allowed, reads to a replica."""
+
+    def db_for_read(self, model, **hints):
+        return replica_for_read()
+
+    def db_for_write(self, model, **hints):
+        # Once a request writes, it (and the client's next requests) read from the primary:
+        _state.replica_reads = False
+        _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary:
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema from the primary (see `sync_replicas`):
+        return db not in settings.READ_REPLICAS
+
+
+class ReplicaRoutingMiddleware(object):
+    """
+    Allows replica reads for GET requests from clients without a pin cookie, and pins
+    clients to the primary for `READ_REPLICA_PIN_SECONDS` after any request that writes.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _state.replica_reads = request.method in SAFE_METHODS and PIN_COOKIE not in request.COOKIES
+        _state.wrote = False
+        try:
+            response = self.get_response(request)
+            if settings.READ_REPLICAS and (_state.wrote or request.method not in SAFE_METHODS):
+                response.set_cookie(PIN_COOKIE, "1", max_age=settings.READ_REPLICA_PIN_SECONDS, httponly=True)
+            return response
+        finally:
+            # Streaming responses (eg: the export) are consumed later, from the primary:
+            _state.replica_reads = False
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Full-text user search, backed by the SQLite FTS5 table `dashboard_user_fts`.
+
+The table indexes `first_name`, `last_name`, `email` and `description` of `dashboard_user`
+(as external content, so text is not stored twice). Triggers on `dashboard_user` keep it
+in sync with every write, including `QuerySet.update()` and `bulk_create()`, which skip
+model signals (see `migrations/0006_user_search.py`).
+
+The default description is indexed as empty text, so it does not make every user match "user".
+Very broad searches (eg: "example", in every email) are cut to their best
+`DASHBOARD_SEARCH_MAX_CANDIDATES` matches (by bm25, kept with a bounded sort), so paging
+through them stays fast on large tables.
+
+Note: SQLite migrations that rebuild `dashboard_user` (eg: adding a column) drop its
+triggers; such migrations must recreate them.
+"""
+from __future__ import unicode_literals
+import re
+from django.conf import settings
+from django.db import connections
+from .routers import replica_for_read
+
+# Column weights for bm25() ranking, in table column order (first_name, last_name, email, description):
+WEIGHTS = (10.0, 10.0, 5.0, 1.0)
+MAX_TERMS = 8 # search words used per query
+WORD_REGEX = re.compile(r'\w+', re.UNICODE)
+
+# The candidates are the best matches, ranked before the LIMIT (not the first ones found):
+RANKED_SQL = (
+    "SELECT score, id FROM ("
+    "SELECT rowid AS id, bm25(dashboard_user_fts, {weights}) AS score "
+    "FROM dashboard_user_fts WHERE dashboard_user_fts MATCH %s ORDER BY score, id LIMIT %s"
+    ") {where} ORDER BY score {order}, id {order} LIMIT %s"
+)
+
+def match_expression(query):
+    """
+    Turns free text into an FTS5 query: every word must match, as a prefix ("ann lee" finds "Annie Leeds").
+
+    Words are quoted, so FTS5 operators and punctuation typed by users are never parsed as syntax.
+    Returns None if `query` has no words.
+
+    Parameters:
+    - `query` - Search text, as typed.
+    """
+
+    words = WORD_REGEX.findall(query or "")[:MAX_TERMS]
+    if not words:
+        return None
+    return " ".join('"{}"*'.format(word) for word in words)
+
+def ranked_ids(match, limit, after=None, before=None):
+    """
+    Returns (score, id) rows for users matching `match`, best first (lowest bm25 score, then id).
+
+    Parameters:
+    - `match` - FTS5 query, from `match_expression()`.
+    - `limit` - Maximum number of rows.
+    - `after` - (score, id) key to return rows after.
+    - `before` - (score, id) key to return rows before, in reverse order (for paging backwards).
+    """
+
+    params = [match, settings.DASHBOARD_SEARCH_MAX_CANDIDATES]
+    where = ""
+    if after is not None or before is not None:
+        operator = ">" if before is None else "<"
+        score, user_id = after if before is None else before
+        where = "WHERE score {0} %s OR (score = %s AND id {0} %s)".format(operator)
+        params += [score, score, user_id]
+    sql = RANKED_SQL.format(weights=", ".join(str(weight) for weight in WEIGHTS), where=where, order="DESC" if before is not None else "ASC")
+    with connections[replica_for_read()].cursor() as cursor:
+        cursor.execute(sql, params + [limit])
+        return cursor.fetchall()
@@ -6,4 +6,14 @@ $( document ).ready(function() {
         return confirm("Are you sure (cannot be undone)?");
     });
 
+    // Bulk actions: check or uncheck every user on the page:
+    $( '#check-all' ).change(function() {
+        $( 'input[name="user_ids"]' ).prop( 'checked', this.checked );
+    });
+
+    $( '#bulk-remove' ).click(function() {
+        var checked = $( 'input[name="user_ids"]:checked' ).length;
+        return checked > 0 && confirm("Remove " + checked + " user(s) with all their messages and comments (cannot be undone)?");
+    });
+
 });
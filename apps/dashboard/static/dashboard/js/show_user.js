@@ -0,0 +1,71 @@
+$( document ).ready(function() {
+
+    // Load older messages when the "Older Messages" link scrolls into view (or is clicked):
+    var loading = false;
+
+    function loadOlder() {
+        var link = $( '.wall-older a' ).last();
+        if ( loading || !link.length ) {
+            return;
+        }
+        loading = true;
+        $.getJSON( link.data( 'fragment-url' ) ).done(function( data ) {
+            // The fragment ends with the link to the page after it, if there is one:
+            link.parent().replaceWith( data.html );
+        }).always(function() {
+            loading = false;
+        });
+    }
+
+    $( document ).on( 'click', '.wall-older a', function() {
+        loadOlder();
+        return false;
+    });
+
+    $( window ).scroll(function() {
+        var link = $( '.wall-older a' ).last();
+        if ( link.length && link.offset().top < $( window ).scrollTop() + $( window ).height() + 200 ) {
+            loadOlder();
+        }
+    });
+
+    // Add messages and comments posted since the page loaded, long-polling the wall's live URL:
+    var wall = $( '.wall[data-live-url]' );
+
+    function poll( url ) {
+        $.getJSON( url ).done(function( data ) {
+            // Newest on top; skip anything the page already shows:
+            $.each( data.messages, function( index, message ) {
+                if ( !wall.find( '.well[data-message-id="' + message.id + '"]' ).length ) {
+                    wall.find( '.wall-new' ).prepend( message.html );
+                }
+            });
+            // Comments go before the comment form of their message (if that message is on the page):
+            $.each( data.comments, function( index, comment ) {
+                var comments = wall.find( '.comments[data-message-id="' + comment.message_id + '"]' );
+                if ( comments.length && !comments.find( '[data-comment-id="' + comment.id + '"]' ).length ) {
+                    comments.children( 'form' ).before( comment.html );
+                }
+            });
+            if ( data.messages.length ) {
+                wall.removeClass( 'hidden' );
+            }
+            poll( url.split( '?' )[ 0 ] + '?cursor=' + encodeURIComponent( data.cursor ) );
+        }).fail(function( xhr ) {
+            // Logged out, or the user is gone: stop polling:
+            if ( xhr.status >= 400 && xhr.status < 500 ) {
+                return;
+            }
+            // The server is busy (`Retry-After`) or unreachable, try again later:
+            var delay = parseInt( xhr.getResponseHeader( 'Retry-After' ), 10 ) || 10;
+            setTimeout(function() {
+                poll( url );
+            }, delay * 1000 );
+        });
+    }
+
+    if ( wall.length ) {
+        poll( wall.data( 'live-url' ) );
+    }
+
+});
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from django import template
+from django.utils.html import format_html_join
+from ..assets import bundle_urls
+
+register = template.Library()
+
+@register.simple_tag
+def asset_tags(name):
+    """
+    Renders the `<link>` or `<script>` tags loading bundle `name` (see `../assets.py`).
+
+    Parameters:
+    - `name` - Bundle name from `ASSET_BUNDLES`, eg: "dashboard/css/vendor.css".
+    """
+
+    if name.endswith(".css"):
+        return format_html_join("\n", '<link rel="stylesheet" href="{}">', ((url,) for url in bundle_urls(name)))
+    return format_html_join("\n", '<script type="text/javascript" src="{}"></script>', ((url,) for url in bundle_urls(name)))
@@ -1,6 +1,1294 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
+import gzip
+import io
+import json
+import logging
+import os
+import posixpath
+import re
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+from django.conf import settings
+from django.contrib.messages import constants as message_constants
+from django.contrib.messages.storage.base import Message as FlashMessage
+from django.core.cache import cache
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.template.loader import get_template, render_to_string
+from django.test import RequestFactory, TestCase, override_settings
+from django.db import connection
+from datetime import timedelta
+from django.db.models import F
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from .models import User, Message, Comment, UserDeletion, ArchivedMessage, ArchivedComment
+from . import assets, deletion, hashing, models, perf, pubsub, routers, throttle, user_cache, wall_cache
+from .database import configure_connection, current_pragmas, sync_replica
+from .middleware import load_session_user
+from .pagination import encode_cursor
+from .log import JsonFormatter, QueueStreamHandler, get_logger
 
-# Create your tests here.
+# The configured cache is shared with any running server and outlives test runs; tests get their own:
+_test_cache = override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "dashboard-tests"}})
+
+# Keep the JSON event log out of the test output (warnings and errors still show):
+_dashboard_logger = logging.getLogger("apps.dashboard")
+_dashboard_log_level = None
+
+def setUpModule():
+    global _dashboard_log_level
+    _test_cache.enable()
+    _dashboard_log_level = _dashboard_logger.level
+    _dashboard_logger.setLevel(logging.WARNING)
+
+def tearDownModule():
+    _test_cache.disable()
+    _dashboard_logger.setLevel(_dashboard_log_level)
+
+def log_in(client, user_id):
+    """Logs the test client in as `user_id`, whichever session store is configured."""
+
+    session = client.session
+    session["user_id"] = user_id
+    session.save()
+    # Signed cookie sessions change key whenever their data does:
+    client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+
+class DirectoryPaginationTests(TestCase):
+    """Tests for keyset pagination of the user directory."""
+
+    def setUp(self):
+        # Duplicate last names make sure `id` breaks ties between pages:
+        for number, last_name in enumerate(["Cole", "Adams", "Baker", "Baker", "Baker", "Dunn", "Evans"]):
+            User.objects.create(first_name="Test", last_name=last_name, email="user{}@example.com".format(number), password="x")
+        self.ordered = list(User.objects.order_by("last_name", "id"))
+
+    def test_pages_walk_forward_and_back(self):
+        first = User.objects.directory_page(page_size=3)
+        self.assertEqual(first.items, self.ordered[:3])
+        self.assertFalse(first.has_previous)
+
+        second = User.objects.directory_page(page_size=3, after=first.next_cursor)
+        self.assertEqual(second.items, self.ordered[3:6])
+
+        last = User.objects.directory_page(page_size=3, after=second.next_cursor)
+        self.assertEqual(last.items, self.ordered[6:])
+        self.assertFalse(last.has_next)
+
+        back = User.objects.directory_page(page_size=3, before=last.prev_cursor)
+        self.assertEqual(back.items, second.items)
+        self.assertTrue(back.has_previous)
+
+    def test_page_query_count_is_constant(self):
+        first = User.objects.directory_page(page_size=2)
+        with self.assertNumQueries(1):
+            User.objects.directory_page(page_size=2, after=first.next_cursor)
+
+    def test_invalid_cursor_loads_first_page(self):
+        page = User.objects.directory_page(page_size=3, after="not-a-cursor")
+        self.assertEqual(page.items, self.ordered[:3])
+
+    def test_cursor_values_of_the_wrong_type_load_first_page(self):
+        user = self.ordered[0]
+        user.user_level = 1
+        user.save()
+        user_cache.invalidate(user.id)
+        log_in(self.client, user.id)
+        Message.objects.create(description="Post", sender=user, receiver=user)
+        for values in (["x", "notanint"], ["x", {}], ["x", None], [[], 1]):
+            self.assertEqual(User.objects.directory_page(page_size=3, after=encode_cursor(values)).items, self.ordered[:3])
+        # Message walls are keyed on (created_at, id):
+        for values in (["x", "notanint"], ["x", {}], ["garbage", 1]):
+            cursor = encode_cursor(values)
+            for url in ("/dashboard/admin", "/api/users", "/users/show/{}".format(user.id), "/api/users/{}/messages".format(user.id)):
+                self.assertEqual(self.client.get(url, {"after": cursor}).status_code, 200, url)
+
+class MessageWallQueryTests(TestCase):
+    """Regression tests for the N+1 queries on the user show page message wall."""
+
+    def setUp(self):
+        self.receiver = User.objects.create(first_name="Wall", last_name="Owner", email="owner@example.com", password="x")
+        self.senders = [User.objects.create(first_name="Sender", last_name="Number", email="sender{}@example.com".format(i), password="x") for i in range(3)]
+        log_in(self.client, self.receiver.id)
+
+    def add_messages(self, count):
+        for i in range(count):
+            sender = self.senders[i % len(self.senders)]
+            message = Message.objects.create(description="Hello", sender=sender, receiver=self.receiver)
+            for commenter in self.senders:
+                Comment.objects.create(description="Reply", sender=commenter, receiver=self.receiver, message=message)
+
+    def count_show_page_queries(self):
+        # Drop the rendered wall, so the wall is queried every time:
+        wall_cache.bump(self.receiver.id)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/users/show/{}".format(self.receiver.id))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_wall_loader_uses_two_queries(self):
+        self.add_messages(5)
+        with self.assertNumQueries(2):
+            wall = list(Message.objects.wall(receiver_id=self.receiver.id))
+            for message in wall:
+                message.sender.first_name
+                for comment in message.comment.all():
+                    comment.sender.first_name
+
+    def test_show_page_query_count_does_not_grow_with_wall(self):
+        self.add_messages(1)
+        # Warm the logged in user cache, so both counts measure the same work:
+        self.count_show_page_queries()
+        small_wall = self.count_show_page_queries()
+        self.add_messages(20)
+        # (A wall shorter than a page also looks for older messages in the archive, a full one does not:)
+        self.assertLessEqual(self.count_show_page_queries(), small_wall)
+
+class HashingPoolTests(TestCase):
+    """Tests for the bounded bcrypt worker pool."""
+
+    def wait_for_stat(self, pool, name, value, timeout=5):
+        """Polls `pool.stats()` until `name` reaches `value`, failing after `timeout` seconds."""
+
+        deadline = time.time() + timeout
+        while pool.stats()[name] < value:
+            if time.time() > deadline:
+                self.fail("{} never reached {}".format(name, value))
+            time.sleep(0.001)
+
+    def test_full_queue_is_rejected(self):
+        pool = hashing.HashingPool(1, 1)
+        release = threading.Event()
+        try:
+            # Occupy the only worker, then fill the only queue slot:
+            threading.Thread(target=pool.run, args=(release.wait,), kwargs={"timeout": 5}).start()
+            self.wait_for_stat(pool, "busy_workers", 1)
+            threading.Thread(target=pool.run, args=(release.wait,), kwargs={"timeout": 5}).start()
+            self.wait_for_stat(pool, "queue_depth", 1)
+            with self.assertRaises(hashing.PoolSaturated):
+                pool.run(release.wait, timeout=5)
+        finally:
+            release.set()
+        self.assertEqual(pool.stats()["rejected"], 1)
+
+    def test_slow_job_times_out(self):
+        pool = hashing.HashingPool(1, 1)
+        release = threading.Event()
+        with self.assertRaises(hashing.HashTimeout):
+            pool.run(release.wait, timeout=0.01)
+        release.set()
+        self.assertEqual(pool.stats()["timed_out"], 1)
+
+    @override_settings(PASSWORD_HASH_ROUNDS=4)
+    def test_register_then_login(self):
+        User.objects.register(first_name="Pool", last_name="Tester", email="pool@example.com", password="password1", confirm_pwd="password1")
+        self.assertIn("logged_in_user", User.objects.login(email="pool@example.com", password="password1"))
+        self.assertIn("errors", User.objects.login(email="pool@example.com", password="wrongpass1"))
+
+@override_settings(PASSWORD_HASH_ROUNDS=4)
+class ManagerQueryCountTests(TestCase):
+    """Query-count tests for the `UserManager`, `MessageManager` and `CommentManager` write paths."""
+
+    def setUp(self):
+        self.admin = User.objects.create(first_name="Admin", last_name="User", email="admin@example.com", password="x", user_level=1)
+        self.user = User.objects.create(first_name="Normal", last_name="User", email="normal@example.com", password="x")
+        self.message = Message.objects.create(description="Hello", sender=self.admin, receiver=self.user)
+
+    def test_register(self):
+        # Existence check, then insert (wrapped in a savepoint):
+        with self.assertNumQueries(4):
+            validated = User.objects.register(first_name="New", last_name="User", email="new@example.com", password="password1", confirm_pwd="password1")
+        self.assertIn("logged_in_user", validated)
+
+    def test_register_taken_email(self):
+        with self.assertNumQueries(1):
+            validated = User.objects.register(first_name="New", last_name="User", email="normal@example.com", password="password1", confirm_pwd="password1")
+        self.assertEqual(validated["errors"], ["Email address already registered."])
+
+    def test_login(self):
+        User.objects.filter(id=self.user.id).update(password=hashing.hash_password("password1"))
+        with self.assertNumQueries(1):
+            validated = User.objects.login(email="normal@example.com", password="password1")
+        self.assertEqual(validated["logged_in_user"].id, self.user.id)
+
+    def test_update_own_profile(self):
+        # Fetch user, existence check for the new email, then update (wrapped in a savepoint):
+        with self.assertNumQueries(5):
+            updated = User.objects.update_profile(user_id=self.user.id, first_name="Renamed", last_name="User", email="renamed@example.com")
+        self.assertEqual(updated.first_name, "Renamed")
+        self.assertEqual(User.objects.get(id=self.user.id).email, "renamed@example.com")
+
+    def test_admin_update_other_profile(self):
+        # Both users are fetched in one query; email unchanged, so no existence check before the update:
+        with self.assertNumQueries(4):
+            updated = User.objects.update_profile(user_id=self.admin.id, edit_user_id=str(self.user.id), first_name="Normal", last_name="User", email="normal@example.com", user_level="1")
+        self.assertEqual(updated.id, self.user.id)
+        self.assertEqual(User.objects.get(id=self.user.id).user_level, 1)
+
+    def test_update_profile_taken_email(self):
+        with self.assertNumQueries(2):
+            validated = User.objects.update_profile(user_id=self.user.id, first_name="Normal", last_name="User", email="admin@example.com")
+        self.assertEqual(validated["errors"], ["Email address already registered."])
+
+    def test_update_password(self):
+        with self.assertNumQueries(1):
+            User.objects.update_password(user_id=self.user.id, password="password1", confirm_pwd="password1")
+
+    def test_update_profile_description(self):
+        with self.assertNumQueries(1):
+            User.objects.update_profile_description(user_id=self.user.id, description="About me")
+
+    def test_message_add(self):
+        # Existence check, then insert and both users' counters (wrapped in a savepoint):
+        with self.assertNumQueries(6):
+            message = Message.objects.add(description="Hi", sender_id=self.admin.id, receiver_id=self.user.id)
+        self.assertEqual(message.receiver_id, self.user.id)
+
+    def test_message_add_unknown_receiver(self):
+        validated = Message.objects.add(description="Hi", sender_id=self.admin.id, receiver_id=0)
+        self.assertEqual(validated["errors"], ["User not found."])
+
+    def test_comment_add(self):
+        # Existence check, then insert and the sender's and message's counters (wrapped in a savepoint):
+        with self.assertNumQueries(6):
+            comment = Comment.objects.add(description="Reply", sender_id=self.admin.id, receiver_id=self.user.id, message_id=self.message.id)
+        self.assertEqual(comment.message_id, self.message.id)
+
+    def test_comment_add_wrong_wall(self):
+        validated = Comment.objects.add(description="Reply", sender_id=self.admin.id, receiver_id=self.admin.id, message_id=self.message.id)
+        self.assertEqual(validated["errors"], ["Message not found."])
+
+class SessionUserCacheTests(TestCase):
+    """Tests for the logged in user middleware and its cache."""
+
+    def setUp(self):
+        self.user = User.objects.create(first_name="Cached", last_name="User", email="cached@example.com", password="x")
+        log_in(self.client, self.user.id)
+        self.request = type(str("Request"), (object,), {"session": {"user_id": self.user.id}})()
+        user_cache.invalidate(self.user.id)
+
+    def test_cached_user_skips_query(self):
+        load_session_user(self.request)
+        with self.assertNumQueries(0):
+            self.assertEqual(load_session_user(self.request).id, self.user.id)
+
+    def test_update_invalidates_cached_user(self):
+        load_session_user(self.request)
+        User.objects.update_profile_description(user_id=self.user.id, description="Changed")
+        self.assertEqual(load_session_user(self.request).description, "Changed")
+
+    def test_evicted_version_does_not_revive_stale_user(self):
+        users = user_cache.UserCache(10, 60)
+        key = user_cache.VERSION_KEY.format(self.user.id)
+        cache.delete(key)
+        users.set(self.user)
+        user_cache.invalidate(self.user.id)
+        # The backend culls the version key again; the copy cached before the invalidation stays stale:
+        cache.delete(key)
+        self.assertIsNone(users.get(self.user.id))
+        users.set(self.user)
+        self.assertEqual(users.get(self.user.id).id, self.user.id)
+
+    def test_missing_session_user(self):
+        self.request.session = {}
+        self.assertIsNone(load_session_user(self.request))
+
+    def test_dashboard_loads_user_once(self):
+        self.client.get("/dashboard")
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get("/dashboard")
+        # One directory page besides the session read; the logged in user comes from the cache:
+        self.assertEqual(len([query for query in queries if "django_session" not in query["sql"]]), 1)
+
+@override_settings(WALL_PAGE_SIZE=2)
+class WallPaginationTests(TestCase):
+    """Tests for keyset pagination of message walls."""
+
+    def setUp(self):
+        self.receiver = User.objects.create(first_name="Wall", last_name="Owner", email="owner@example.com", password="x")
+        self.messages = [Message.objects.create(description="Post {}".format(number), sender=self.receiver, receiver=self.receiver) for number in range(5)]
+        Comment.objects.create(description="Old reply", sender=self.receiver, receiver=self.receiver, message=self.messages[0])
+        log_in(self.client, self.receiver.id)
+        wall_cache.bump(self.receiver.id)
+
+    def test_pages_walk_back_through_history(self):
+        newest = list(reversed(self.messages))
+        page = Message.objects.wall_page(receiver_id=self.receiver.id, page_size=2)
+        self.assertEqual(page.items, newest[:2])
+        with self.assertNumQueries(2):
+            page = Message.objects.wall_page(receiver_id=self.receiver.id, page_size=2, after=page.next_cursor)
+            [comment for message in page.items for comment in message.comment.all()]
+        self.assertEqual(page.items, newest[2:4])
+
+    def test_show_page_renders_newest_page_only(self):
+        response = self.client.get("/users/show/{}".format(self.receiver.id))
+        self.assertContains(response, "Post 4")
+        self.assertNotContains(response, "Post 2")
+        self.assertContains(response, "Older Messages")
+
+    def test_fragment_endpoint_returns_older_messages(self):
+        first = Message.objects.wall_page(receiver_id=self.receiver.id, page_size=2)
+        data = self.client.get("/users/show/{}/messages".format(self.receiver.id), {"after": first.next_cursor}).json()
+        self.assertIn("Post 2", data["html"])
+        self.assertNotIn("Post 4", data["html"])
+        data = self.client.get("/users/show/{}/messages".format(self.receiver.id), {"after": data["next_cursor"]}).json()
+        self.assertIn("Old reply", data["html"])
+        self.assertIsNone(data["next_cursor"])
+        self.assertNotIn("Older Messages", data["html"])
+
+class WallCacheTests(TestCase):
+    """Tests for the rendered message wall cache."""
+
+    def setUp(self):
+        self.receiver = User.objects.create(first_name="Wall", last_name="Owner", email="owner@example.com", password="x")
+        self.sender = User.objects.create(first_name="Wall", last_name="Sender", email="sender@example.com", password="x")
+        log_in(self.client, self.sender.id)
+        Message.objects.add(description="First post", sender_id=self.sender.id, receiver_id=self.receiver.id)
+
+    def test_cached_wall_skips_wall_queries(self):
+        url = "/users/show/{}".format(self.receiver.id)
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertContains(response, "First post")
+        self.assertFalse([query for query in queries if "dashboard_message" in query["sql"]])
+
+    def test_new_message_invalidates_wall(self):
+        url = "/users/show/{}".format(self.receiver.id)
+        self.client.get(url)
+        self.client.post(url, {"description": "Second post"})
+        self.assertContains(self.client.get(url), "Second post")
+
+    def test_cached_wall_uses_viewer_csrf_token(self):
+        response = self.client.get("/users/show/{}".format(self.receiver.id))
+        self.assertNotContains(response, "__wall_csrf_token__")
+
+    def test_cached_wall_keeps_csrf_placeholder_in_messages(self):
+        url = "/users/show/{}".format(self.receiver.id)
+        self.client.post(url, {"description": "Look: __wall_csrf_token__"})
+        response = self.client.get(url)
+        self.assertContains(response, "Look: __wall_csrf_token__")
+        self.assertNotContains(response, "value='__wall_csrf_token__'")
+
+    def test_concurrent_readers_wait_for_rebuild(self):
+        version = wall_cache.wall_version(self.receiver.id)
+        # Pretend another request holds the rebuild lock, and publishes shortly:
+        cache.add(wall_cache.LOCK_KEY.format(self.receiver.id, version), 1)
+        publish = threading.Timer(0.1, cache.set, [wall_cache.FRAGMENT_KEY.format(self.receiver.id, version), "rebuilt"])
+        publish.start()
+        builds = []
+        self.assertEqual(wall_cache.get_or_build(self.receiver.id, lambda: builds.append(1)), "rebuilt")
+        self.assertEqual(builds, [])
+
+class StructuredLoggingTests(TestCase):
+    """Tests for the queue-backed JSON logging pipeline."""
+
+    def test_events_are_written_as_json_by_writer_thread(self):
+        stream = StringIO()
+        handler = QueueStreamHandler(stream)
+        handler.setFormatter(JsonFormatter())
+        logger = get_logger("apps.dashboard.tests.logging")
+        logger.logger.addHandler(handler)
+        logger.logger.setLevel(logging.INFO)
+        logger.logger.propagate = False # only to this handler, not the quieted `apps.dashboard` one
+        try:
+            logger.info("test.event", user_id=7)
+            logger.debug("test.dropped")
+        finally:
+            logger.logger.propagate = True
+            logger.logger.removeHandler(handler)
+            handler.close()
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        record = json.loads(lines[0])
+        self.assertEqual(record["event"], "test.event")
+        self.assertEqual(record["user_id"], 7)
+
+    def test_response_carries_request_id(self):
+        response = self.client.get("/", HTTP_X_REQUEST_ID="abc-123")
+        self.assertEqual(response["X-Request-ID"], "abc-123")
+        self.assertEqual(len(self.client.get("/")["X-Request-ID"]), 32)
+
+@override_settings(PASSWORD_HASH_ROUNDS=4)
+class ImportDataTests(TestCase):
+    """Tests for the `importdata` bulk import command."""
+
+    def run_import(self, rows, **options):
+        handle, path = tempfile.mkstemp(suffix=".jsonl")
+        with os.fdopen(handle, "w") as import_file:
+            import_file.write("\n".join(json.dumps(row) for row in rows))
+        errors = StringIO()
+        try:
+            call_command("importdata", path, stdout=StringIO(), stderr=errors, **options)
+        finally:
+            os.remove(path)
+        return errors.getvalue()
+
+    def test_imports_users_messages_and_comments(self):
+        User.objects.create(first_name="Old", last_name="User", email="old@example.com", password="x")
+        errors = self.run_import([
+            {"type": "user", "first_name": "Ann", "last_name": "Lee", "email": "ann@example.com", "password": "password1"},
+            {"type": "user", "first_name": "Bob", "last_name": "Ray", "email": "bob@example.com", "password_hash": hashing.hash_password("password2")},
+            {"type": "user", "first_name": "Ann", "last_name": "Lee", "email": "ann@example.com", "password": "password1"},
+            {"type": "user", "first_name": "Old", "last_name": "User", "email": "old@example.com", "password": "password1"},
+            {"type": "message", "sender_email": "ann@example.com", "receiver_email": "bob@example.com", "description": "Hello", "ref": "m1"},
+            {"type": "comment", "sender_email": "bob@example.com", "description": "Hi", "message_ref": "m1"},
+        ], batch_size=2)
+        self.assertIn("appears twice", errors)
+        self.assertIn("already registered", errors)
+        self.assertEqual(User.objects.count(), 3)
+        self.assertIn("logged_in_user", User.objects.login(email="ann@example.com", password="password1"))
+        self.assertIn("logged_in_user", User.objects.login(email="bob@example.com", password="password2"))
+        message = Message.objects.get()
+        self.assertEqual(message.receiver.email, "bob@example.com")
+        self.assertEqual(Comment.objects.get().message_id, message.id)
+        self.assertEqual((message.sender.messages_sent_count, message.receiver.comments_count, message.comments_count), (1, 1, 1))
+
+    def test_dry_run_inserts_nothing(self):
+        self.run_import([{"type": "user", "first_name": "Ann", "last_name": "Lee", "email": "ann@example.com", "password": "password1"}], dry_run=True)
+        self.assertEqual(User.objects.count(), 0)
+
+    def test_rows_that_are_not_objects_are_skipped(self):
+        errors = self.run_import([["user"], "user", 3, None, {"type": "user", "first_name": "Ann", "last_name": "Lee", "email": "ann@example.com", "password": "password1"}])
+        self.assertEqual(errors.count("Unknown row type."), 4)
+        self.assertEqual(User.objects.count(), 1)
+
+    def test_imported_messages_never_reuse_ids_and_wake_live_viewers(self):
+        ann = User.objects.create(first_name="Ann", last_name="Lee", email="ann@example.com", password="x")
+        newest = Message.objects.add(description="Deleted", sender_id=ann.id, receiver_id=ann.id)
+        cursor = Message.objects.wall_cursor(receiver_id=ann.id)
+        Message.objects.filter(id=newest.id).delete()
+        version = pubsub.version(pubsub.WALL_TOPIC.format(ann.id))
+        self.run_import([{"type": "message", "sender_email": "ann@example.com", "receiver_email": "ann@example.com", "description": "Imported"}])
+        self.assertGreater(Message.objects.get().id, newest.id)
+        self.assertGreater(pubsub.version(pubsub.WALL_TOPIC.format(ann.id)), version)
+        # A viewer whose cursor is past the deleted message still gets the imported one:
+        self.assertEqual([message.description for message in Message.objects.wall_updates(receiver_id=ann.id, cursor=cursor)["messages"]], ["Imported"])
+
+@override_settings(DASHBOARD_EXPORT_CHUNK_SIZE=2)
+class UserExportTests(TestCase):
+    """Tests for the streaming user directory export."""
+
+    def setUp(self):
+        self.admin = User.objects.create(first_name="Admin", last_name="User", email="admin@example.com", password="x", user_level=1)
+        self.users = [User.objects.create(first_name="Test", last_name="User", email="user{}@example.com".format(number), password="x") for number in range(4)]
+        Message.objects.add(description="Hello", sender_id=self.users[0].id, receiver_id=self.users[1].id)
+        Message.objects.add(description="Again", sender_id=self.users[0].id, receiver_id=self.users[1].id)
+        self.session_as(self.admin)
+
+    def session_as(self, user):
+        log_in(self.client, user.id)
+        user_cache.invalidate(user.id)
+
+    def test_csv_streams_every_user_with_counts(self):
+        response = self.client.get("/users/export")
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode("utf-8").splitlines()
+        self.assertEqual(lines[0], "id,first_name,last_name,email,created_at,user_level,messages_sent,messages_received")
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[2].endswith(",0,2,0"))
+        self.assertTrue(lines[3].endswith(",0,0,2"))
+
+    def test_jsonl_reads_users_in_chunks(self):
+        response = self.client.get("/users/export?format=jsonl")
+        with CaptureQueriesContext(connection) as queries:
+            rows = [json.loads(line) for line in b"".join(response.streaming_content).decode("utf-8").splitlines()]
+        self.assertEqual([row["id"] for row in rows], [self.admin.id] + [user.id for user in self.users])
+        # Three chunks of users and the final empty chunk:
+        self.assertEqual(len(queries), 4)
+
+    def test_normal_users_are_redirected(self):
+        self.session_as(self.users[0])
+        self.assertRedirects(self.client.get("/users/export"), "/dashboard", fetch_redirect_response=False)
+
+class UserSearchTests(TestCase):
+    """Tests for full-text user search."""
+
+    def setUp(self):
+        self.ann = User.objects.create(first_name="Ann", last_name="Lee", email="ann@example.com", password="x")
+        self.bob = User.objects.create(first_name="Bob", last_name="Ray", email="bob@example.com", password="x", description="Works with Ann on payroll.")
+        self.cy = User.objects.create(first_name="Annika", last_name="Stone", email="cy@example.com", password="x")
+
+    def search(self, query, **kwargs):
+        return User.objects.search_page(query=query, page_size=kwargs.pop("page_size", 10), **kwargs)
+
+    def test_name_matches_rank_above_description_matches(self):
+        results = self.search("ann").items
+        self.assertEqual(set(results[:2]), set([self.ann, self.cy]))
+        self.assertEqual(results[2], self.bob)
+        # The default description is not indexed:
+        self.assertEqual(self.search("description").items, [])
+
+    @override_settings(DASHBOARD_SEARCH_MAX_CANDIDATES=2)
+    def test_broad_searches_keep_the_best_matches(self):
+        for number in range(3):
+            User.objects.create(first_name="Dee", last_name="Vey", email="dee{}@example.com".format(number), password="x", description="Knows Zora.")
+        zora = User.objects.create(first_name="Zora", last_name="Best", email="z@example.com", password="x")
+        self.assertEqual(self.search("zora").items[0], zora)
+
+    def test_index_follows_updates_and_deletes(self):
+        User.objects.update_profile_description(user_id=self.ann.id, description="Gardener")
+        self.assertEqual(self.search("gardener").items, [self.ann])
+        User.objects.filter(id=self.bob.id).update(last_name="Zed")
+        self.assertEqual(self.search("zed").items, [self.bob])
+        self.assertEqual(self.search("ray").items, [])
+        self.ann.delete()
+        self.assertEqual(self.search("gardener").items, [])
+
+    def test_pages_and_punctuation(self):
+        first = self.search("ann", page_size=2)
+        second = self.search("ann", page_size=2, after=first.next_cursor)
+        self.assertEqual(second.items, [self.bob])
+        self.assertEqual(self.search("ann", page_size=2, before=second.prev_cursor).items, first.items)
+        self.assertEqual(self.search('ann" OR NEAR(').items, self.search("ann near").items)
+        self.assertEqual(self.search("!!").items, [])
+
+class ActivityCounterTests(TestCase):
+    """Tests for the denormalized activity counters."""
+
+    def setUp(self):
+        self.ann = User.objects.create(first_name="Ann", last_name="Lee", email="ann@example.com", password="x")
+        self.bob = User.objects.create(first_name="Bob", last_name="Ray", email="bob@example.com", password="x")
+        self.cy = User.objects.create(first_name="Cy", last_name="Day", email="cy@example.com", password="x")
+        self.to_bob = Message.objects.add(description="Hi Bob", sender_id=self.ann.id, receiver_id=self.bob.id)
+        self.to_ann = Message.objects.add(description="Hi Ann", sender_id=self.cy.id, receiver_id=self.ann.id)
+        Comment.objects.add(description="Hey", sender_id=self.cy.id, receiver_id=self.bob.id, message_id=self.to_bob.id)
+        Comment.objects.add(description="Yo", sender_id=self.bob.id, receiver_id=self.ann.id, message_id=self.to_ann.id)
+
+    def counts(self, user):
+        user = User.objects.get(id=user.id)
+        return (user.messages_received_count, user.messages_sent_count, user.comments_count)
+
+    def test_adds_are_counted(self):
+        self.assertEqual(self.counts(self.ann), (1, 1, 0))
+        self.assertEqual(self.counts(self.bob), (1, 0, 1))
+        self.assertEqual(self.counts(self.cy), (0, 1, 1))
+        self.assertEqual(Message.objects.get(id=self.to_bob.id).comments_count, 1)
+
+    def test_removing_a_user_updates_everyone_else(self):
+        # Removes Ann, her message to Bob (and Cy's comment on it), and Cy's message to her (and Bob's comment on it):
+        User.objects.remove(user_ids=[self.ann.id])
+        self.assertEqual(self.counts(self.bob), (0, 0, 0))
+        self.assertEqual(self.counts(self.cy), (0, 0, 0))
+
+    def test_reconcile_fixes_drift(self):
+        User.objects.filter(id=self.bob.id).update(messages_received_count=7)
+        Message.objects.filter(id=self.to_ann.id).update(comments_count=0)
+        output = StringIO()
+        call_command("reconcile_counters", batch_size=2, stdout=output)
+        self.assertIn("User.messages_received_count: 3 rows checked, 1 fixed.", output.getvalue())
+        self.assertEqual(self.counts(self.bob), (1, 0, 1))
+        self.assertEqual(Message.objects.get(id=self.to_ann.id).comments_count, 1)
+
+@override_settings(PASSWORD_HASH_ROUNDS=4)
+class SessionStoreTests(TestCase):
+    """Tests for the session and flash message stores."""
+
+    def setUp(self):
+        self.user = User.objects.create(first_name="Ann", last_name="Lee", email="ann@example.com", password=hashing.hash_password("password1"))
+
+    @override_settings(SESSION_ENGINE="django.contrib.sessions.backends.signed_cookies")
+    def test_login_redirect_cycle_never_touches_session_table(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post("/signin", {"login_email": "ann@example.com", "login_password": "password1"})
+            self.client.get("/dashboard")
+            self.client.get("/logout")
+            response = self.client.get("/")
+        self.assertFalse([query for query in queries if "django_session" in query["sql"]])
+        # The custom `INDEX_MSG` level survives the cookie round trip, with its tag:
+        self.assertContains(response, "User logged out.")
+
+    def test_logout_revokes_session(self):
+        self.client.post("/signin", {"login_email": "ann@example.com", "login_password": "password1"})
+        copied = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        self.client.get("/logout")
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = copied
+        self.assertEqual(self.client.get("/dashboard").status_code, 302)
+
+    @override_settings(SESSION_ENGINE="django.contrib.sessions.backends.db")
+    def test_purge_removes_only_expired_sessions(self):
+        from django.contrib.sessions.backends.db import SessionStore
+        from django.contrib.sessions.models import Session
+        for number in range(3):
+            session = SessionStore()
+            session["user_id"] = number
+            session.set_expiry(-60 if number else 60)
+            session.save()
+        call_command("purge_sessions", batch_size=1, stdout=StringIO())
+        self.assertEqual(Session.objects.count(), 1)
+
+@override_settings(PASSWORD_HASH_ROUNDS=4, LOGIN_THROTTLE_PER_IP={"burst": 3, "per_minute": 60}, LOGIN_THROTTLE_PER_EMAIL={"burst": 2, "per_minute": 1})
+class LoginThrottleTests(TestCase):
+    """Tests for login throttling."""
+
+    def setUp(self):
+        throttle._limiters.clear()
+        cache.clear()
+        User.objects.create(first_name="Ann", last_name="Lee", email="ann@example.com", password=hashing.hash_password("password1"))
+
+    def sign_in(self, email, address="10.0.0.1"):
+        return self.client.post("/signin", {"login_email": email, "login_password": "wrong-password"}, REMOTE_ADDR=address)
+
+    def test_email_bucket_rejects_before_lookup(self):
+        self.sign_in("ann@example.com")
+        self.sign_in("ANN@example.com ", address="10.0.0.2")
+        before = throttle.stats()["throttled_email"]
+        with self.assertNumQueries(0):
+            response = self.sign_in("ann@example.com", address="10.0.0.3")
+        self.assertEqual(response.status_code, 429)
+        self.assertContains(response, "Too many login attempts", status_code=429)
+        self.assertEqual(throttle.stats()["throttled_email"], before + 1)
+
+    def test_ip_bucket_rejects_any_email(self):
+        for number in range(3):
+            self.assertEqual(self.sign_in("user{}@example.com".format(number)).status_code, 302)
+        self.assertEqual(self.sign_in("other@example.com").status_code, 429)
+        self.assertEqual(self.sign_in("other@example.com", address="10.0.0.9").status_code, 302)
+
+    def test_bucket_refills(self):
+        limiter = throttle.TokenBucketLimiter(1, 60, 10)
+        self.assertTrue(limiter.allow("key"))
+        self.assertFalse(limiter.allow("key"))
+        # Pretend a second passed (one token at 60 per minute):
+        tokens, updated = limiter.buckets["key"]
+        limiter.buckets["key"] = (tokens, updated - 1)
+        self.assertTrue(limiter.allow("key"))
+
+    @override_settings(LOGIN_THROTTLE_BACKEND="cache")
+    def test_cache_backend_limits(self):
+        self.sign_in("ann@example.com")
+        self.sign_in("ann@example.com", address="10.0.0.2")
+        self.assertEqual(self.sign_in("ann@example.com", address="10.0.0.3").status_code, 429)
+
+
+
+class SQLiteProfileTests(TestCase):
+    def tearDown(self):
+        # The test connection is shared, put the configured busy timeout back (the journal mode
+        # and `synchronous` cannot be changed inside the test transaction):
+        with override_settings(SQLITE_PRAGMAS=[pragma for pragma in settings.SQLITE_PRAGMAS if pragma[0] == "busy_timeout"]):
+            configure_connection(None, connection)
+
+    def test_pragmas_applied(self):
+        values = current_pragmas(connection, ["busy_timeout", "temp_store", "cache_size"])
+        self.assertEqual(values, {"busy_timeout": 5000, "temp_store": 2, "cache_size": -65536})
+
+    @override_settings(SQLITE_PRAGMAS=[("busy_timeout", 1234), ("cache_size = 0; DROP TABLE dashboard_user", 1), ("temp_store", "MEMORY; --")])
+    def test_invalid_pragmas_skipped(self):
+        configure_connection(None, connection)
+        self.assertEqual(current_pragmas(connection, ["busy_timeout", "temp_store"]), {"busy_timeout": 1234, "temp_store": 2})
+        self.assertFalse(User.objects.exists())
+
+
+@override_settings(READ_REPLICAS=["replica_1"])
+class ReadReplicaRoutingTests(TestCase):
+    def setUp(self):
+        self.router = routers.ReadReplicaRouter()
+
+    def tearDown(self):
+        routers._state.replica_reads = False
+
+    def test_reads_use_primary_outside_requests(self):
+        routers._state.replica_reads = False
+        self.assertEqual(self.router.db_for_read(User), "default")
+
+    def test_safe_request_reads_from_replica_until_it_writes(self):
+        routers._state.replica_reads = True
+        # Test cases run inside a transaction, which pins reads to the primary:
+        connection.in_atomic_block = False
+        try:
+            self.assertEqual(self.router.db_for_read(User), "replica_1")
+            with routers.use_primary():
+                self.assertEqual(self.router.db_for_read(User), "default")
+            self.assertEqual(self.router.db_for_write(User), "default")
+            self.assertEqual(self.router.db_for_read(User), "default")
+        finally:
+            connection.in_atomic_block = True
+
+    def test_middleware_pins_after_writes(self):
+        get = RequestFactory().get("/dashboard")
+        response = routers.ReplicaRoutingMiddleware(lambda request: HttpResponse())(get)
+        self.assertNotIn(routers.PIN_COOKIE, response.cookies)
+
+        def writing_view(request):
+            self.assertTrue(routers._state.replica_reads)
+            self.router.db_for_write(User)
+            return HttpResponse()
+        response = routers.ReplicaRoutingMiddleware(writing_view)(RequestFactory().get("/users/edit/1/delete"))
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+        response = routers.ReplicaRoutingMiddleware(lambda request: HttpResponse())(RequestFactory().post("/users/show/1"))
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+
+        def pinned_view(request):
+            self.assertFalse(routers._state.replica_reads)
+            return HttpResponse()
+        pinned = RequestFactory().get("/dashboard")
+        pinned.COOKIES[routers.PIN_COOKIE] = "1"
+        routers.ReplicaRoutingMiddleware(pinned_view)(pinned)
+
+    def test_sync_replica(self):
+        temp_dir = tempfile.mkdtemp()
+        primary_path, replica_path = os.path.join(temp_dir, "primary.sqlite3"), os.path.join(temp_dir, "replica.sqlite3")
+        primary = sqlite3.connect(primary_path, isolation_level=None)
+        primary.execute("CREATE TABLE item (id INTEGER PRIMARY KEY, name TEXT)")
+        primary.execute("CREATE TABLE item_log (name TEXT)")
+        primary.execute("CREATE TRIGGER item_logged AFTER INSERT ON item BEGIN INSERT INTO item_log VALUES (new.name); END")
+        primary.execute("INSERT INTO item (name) VALUES ('a')")
+        self.assertEqual(sync_replica(primary_path, replica_path), "rebuilt")
+        primary.execute("INSERT INTO item (name) VALUES ('b')")
+        self.assertEqual(sync_replica(primary_path, replica_path), "refreshed")
+        primary.close()
+
+        replica = sqlite3.connect(replica_path)
+        self.assertEqual(replica.execute("SELECT name FROM item ORDER BY id").fetchall(), [("a",), ("b",)])
+        # Rows written by triggers are copied, not written twice:
+        self.assertEqual(replica.execute("SELECT count(*) FROM item_log").fetchone(), (2,))
+        self.assertEqual(replica.execute("SELECT count(*) FROM sqlite_master WHERE type = 'trigger'").fetchone(), (0,))
+        replica.close()
+        shutil.rmtree(temp_dir)
+
+
+class JsonApiTests(TestCase):
+    """Tests for the read-only JSON API and its conditional GETs."""
+
+    def setUp(self):
+        self.user = User.objects.create(first_name="Api", last_name="Owner", email="api@example.com", password="secret")
+        self.other = User.objects.create(first_name="Api", last_name="Other", email="other@example.com", password="secret")
+        self.message = Message.objects.create(description="Hello", sender=self.other, receiver=self.user)
+        Comment.objects.create(description="Reply", sender=self.user, receiver=self.user, message=self.message)
+        user_cache.invalidate(self.user.id)
+        log_in(self.client, self.user.id)
+
+    def test_requires_login(self):
+        self.client.cookies.clear()
+        self.assertEqual(self.client.get("/api/users").status_code, 401)
+
+    def test_user_list_revalidates_with_etag(self):
+        response = self.client.get("/api/users")
+        users = response.json()["users"]
+        self.assertEqual([user["email"] for user in users], ["other@example.com", "api@example.com"])
+        self.assertNotIn("password", users[0])
+
+        self.client.get("/dashboard") # warm the session user cache
+        with self.assertNumQueries(2): # session, then the list's count and last change
+            cached = self.client.get("/api/users", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.content, b"")
+
+        self.other.delete()
+        changed = self.client.get("/api/users", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed["ETag"], response["ETag"])
+
+    def test_user_answers_if_modified_since(self):
+        response = self.client.get("/api/users/{}".format(self.other.id))
+        self.assertEqual(response.json()["first_name"], "Api")
+        self.assertEqual(self.client.get("/api/users/{}".format(self.other.id), HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]).status_code, 304)
+        self.assertEqual(self.client.get("/api/users/0").status_code, 404)
+
+    def test_wall_changes_with_comments(self):
+        path = "/api/users/{}/messages".format(self.user.id)
+        response = self.client.get(path)
+        messages = response.json()["messages"]
+        self.assertEqual(messages[0]["sender_id"], self.other.id)
+        self.assertEqual([comment["description"] for comment in messages[0]["comments"]], ["Reply"])
+        self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+
+        Comment.objects.add(description="Second", sender_id=self.other.id, receiver_id=self.user.id, message_id=self.message.id)
+        self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 200)
+
+    def test_wall_without_comments(self):
+        Message.objects.create(description="Alone", sender=self.user, receiver=self.other)
+        response = self.client.get("/api/users/{}/messages".format(self.other.id))
+        self.assertEqual([message["description"] for message in response.json()["messages"]], ["Alone"])
+        self.assertTrue(response.has_header("Last-Modified"))
+
+
+class StaticAssetTests(TestCase):
+    """Tests for the asset bundle build, template tags and precompressed file serving."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings = override_settings(ASSET_ROOT=self.root)
+        self.settings.enable()
+        assets.reset()
+
+    def tearDown(self):
+        self.settings.disable()
+        assets.reset()
+        shutil.rmtree(self.root)
+
+    def test_unbuilt_bundles_load_sources(self):
+        self.assertEqual(assets.bundle_urls("dashboard/js/vendor.js"), [settings.STATIC_URL + source for source in settings.ASSET_BUNDLES["dashboard/js/vendor.js"]])
+
+    def test_built_bundles_are_served_precompressed(self):
+        manifest = assets.AssetBuilder(self.root).build(settings.ASSET_BUNDLES)
+        assets.reset()
+        built = manifest["bundles"]["dashboard/css/vendor.css"]
+        self.assertRegexpMatches(built, r"^dashboard/css/vendor\.[0-9a-f]{12}\.css$")
+        response = self.client.get("/")
+        self.assertContains(response, settings.STATIC_URL + built)
+        self.assertNotContains(response, "bootstrap.min.css")
+
+        # Fonts are copied under hashed names and the CSS points at them:
+        with open(os.path.join(self.root, built)) as css:
+            fonts = re.findall(r"url\(([^)?#]+)", css.read())
+        self.assertTrue(fonts)
+        for font in fonts:
+            self.assertIn(posixpath.normpath(posixpath.join("dashboard/css", font)), manifest["files"])
+
+        compressed = self.client.get(settings.STATIC_URL + built, HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(compressed["Content-Encoding"], "gzip")
+        self.assertEqual(compressed["Cache-Control"], assets.CACHE_CONTROL)
+        self.assertEqual(compressed["Vary"], "Accept-Encoding")
+        plain = self.client.get(settings.STATIC_URL + built)
+        self.assertFalse(plain.has_header("Content-Encoding"))
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(b"".join(compressed.streaming_content))).read(), b"".join(plain.streaming_content))
+
+    def test_rebuild_keeps_earlier_files_until_pruned(self):
+        with override_settings(ASSET_BUNDLES={"dashboard/css/style.css": ["dashboard/css/style.css"]}):
+            first = assets.AssetBuilder(self.root).build(settings.ASSET_BUNDLES)["bundles"]["dashboard/css/style.css"]
+        self.assertEqual(assets.bundle_urls("dashboard/css/style.css"), [settings.STATIC_URL + first])
+        # A build of changed sources, as a running process sees it (no `reset()`):
+        source = "dashboard/css/style.css"
+        original = assets.read_source
+        assets.read_source = lambda path: original(path) + "\nbody{margin:0}"
+        try:
+            with override_settings(ASSET_BUNDLES={source: [source]}):
+                builder = assets.AssetBuilder(self.root)
+                builder.built_at += 1 # a later build
+                second = builder.build(settings.ASSET_BUNDLES)["bundles"][source]
+        finally:
+            assets.read_source = original
+        os.utime(os.path.join(self.root, assets.MANIFEST_NAME), (time.time() + 1, time.time() + 1)) # (coarse mtimes)
+        self.assertNotEqual(first, second)
+        self.assertEqual(assets.bundle_urls(source), [settings.STATIC_URL + second])
+        # Pages rendered before the build still get their files:
+        self.assertEqual(self.client.get(settings.STATIC_URL + first).status_code, 200)
+
+        self.assertEqual(assets.prune(self.root, 0), [first])
+        self.assertFalse(os.path.exists(os.path.join(self.root, first)))
+        self.assertTrue(os.path.exists(os.path.join(self.root, second)))
+        self.assertEqual(self.client.get(settings.STATIC_URL + second).status_code, 200)
+
+    def test_minify_css(self):
+        self.assertEqual(assets.minify_css("/* note */\na > b ,\nc:hover {\n  color: red;\n}\n"), "a>b,c:hover{color: red}")
+
+
+class TemplateLayoutTests(TestCase):
+    """Tests for the shared page layouts."""
+
+    PAGES = ["index", "login", "register", "user_dashboard", "admin_dashboard", "show_user", "admin_add_user", "admin_edit_user", "user_edit_profile"]
+
+    def test_pages_extend_a_layout(self):
+        for page in self.PAGES:
+            template = get_template("dashboard/{}.html".format(page)).template
+            self.assertIn(template.nodelist[0].parent_name.token, ['"dashboard/public_base.html"', '"dashboard/member_base.html"'], page)
+
+    def test_flash_messages_show_one_tag(self):
+        messages = [FlashMessage(message_constants.ERROR, "Wrong password", extra_tags="login_errors"), FlashMessage(message_constants.SUCCESS, "Saved")]
+        html = render_to_string("dashboard/flash_messages.html", {"messages": messages, "tag": "login_errors error", "level": "danger", "label": "Error!"})
+        self.assertIn("<strong>Error!</strong> Wrong password", html)
+        self.assertIn("alert-danger", html)
+        self.assertNotIn("Saved", html)
+
+
+@override_settings(LIVE_POLL_TIMEOUT=0.1)
+class LiveWallTests(TestCase):
+    """Tests for live message wall updates and the pub/sub broker behind them."""
+
+    def setUp(self):
+        self.receiver = User.objects.create(first_name="Wall", last_name="Owner", email="owner@example.com", password="x")
+        self.sender = User.objects.create(first_name="Wall", last_name="Sender", email="sender@example.com", password="x")
+        self.message = Message.objects.add(description="First post", sender_id=self.sender.id, receiver_id=self.receiver.id)
+        self.url = "/users/show/{}/live".format(self.receiver.id)
+        log_in(self.client, self.sender.id)
+
+    def test_poll_returns_posts_after_cursor(self):
+        cursor = Message.objects.wall_cursor(receiver_id=self.receiver.id)
+        message = Message.objects.add(description="Second post", sender_id=self.sender.id, receiver_id=self.receiver.id)
+        Comment.objects.add(description="Old message reply", sender_id=self.sender.id, receiver_id=self.receiver.id, message_id=self.message.id)
+        Comment.objects.add(description="New message reply", sender_id=self.sender.id, receiver_id=self.receiver.id, message_id=message.id)
+        data = self.client.get(self.url, {"cursor": cursor}).json()
+        self.assertEqual([item["id"] for item in data["messages"]], [message.id])
+        self.assertIn("Second post", data["messages"][0]["html"])
+        self.assertIn("New message reply", data["messages"][0]["html"])
+        self.assertEqual([item["message_id"] for item in data["comments"]], [self.message.id])
+        self.assertIn("Old message reply", data["comments"][0]["html"])
+
+        # Nothing is new after the returned cursor, so the poll waits and times out empty:
+        data = self.client.get(self.url, {"cursor": data["cursor"]}).json()
+        self.assertEqual((data["messages"], data["comments"]), ([], []))
+
+    def test_show_page_carries_live_cursor(self):
+        response = self.client.get("/users/show/{}".format(self.receiver.id))
+        live_url = re.search(r'data-live-url="([^"]+)"', response.content.decode("utf-8")).group(1)
+        Message.objects.add(description="Second post", sender_id=self.sender.id, receiver_id=self.receiver.id)
+        data = self.client.get(live_url).json()
+        self.assertEqual(len(data["messages"]), 1)
+        self.assertIn("Second post", data["messages"][0]["html"])
+
+    def test_invalid_cursor_and_busy_process(self):
+        self.assertEqual(self.client.get(self.url, {"cursor": "nonsense"}).status_code, 400)
+        cursor = Message.objects.wall_cursor(receiver_id=self.receiver.id)
+        with override_settings(LIVE_MAX_WAITERS=0):
+            response = self.client.get(self.url, {"cursor": cursor})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "5")
+
+    def test_waiter_wakes_on_publish(self):
+        broker = pubsub.Broker()
+        version = broker.version("wall:1")
+        threading.Timer(0.05, broker.publish, ["wall:1"]).start()
+        start = time.time()
+        self.assertTrue(broker.wait("wall:1", version, 5, 10))
+        self.assertLess(time.time() - start, 1)
+        # Publishes to other topics do not end the wait:
+        threading.Timer(0.01, broker.publish, ["wall:2"]).start()
+        self.assertFalse(broker.wait("wall:1", broker.version("wall:1"), 0.1, 10))
+
+    def test_socket_fanout_reaches_other_processes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        received = []
+        delivered = threading.Event()
+        sender = pubsub.SocketFanout(directory, received.append, name="sender.sock")
+        listener = pubsub.SocketFanout(directory, lambda topic: (received.append(topic), delivered.set()), name="listener.sock")
+        self.addCleanup(sender.close)
+        self.addCleanup(listener.close)
+        # A socket left behind by a process that exited:
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(os.path.join(directory, "stale.sock"))
+        stale.close()
+
+        sender.send("wall:7")
+        self.assertTrue(delivered.wait(5))
+        self.assertEqual(received, ["wall:7"])
+        self.assertFalse(os.path.exists(os.path.join(directory, "stale.sock")))
+
+
+class BulkAdminActionTests(TestCase):
+    """Tests for the admin bulk level change and delete actions."""
+
+    def setUp(self):
+        self.admin = User.objects.create(first_name="Ad", last_name="Min", email="admin@example.com", password="x", user_level=1)
+        self.users = [User.objects.create(first_name="User", last_name="Number", email="user{}@example.com".format(number), password="x") for number in range(4)]
+        self.keep = self.users[3]
+        message = Message.objects.add(description="Hi", sender_id=self.users[0].id, receiver_id=self.keep.id)
+        Message.objects.add(description="Hello", sender_id=self.keep.id, receiver_id=self.users[1].id)
+        Comment.objects.add(description="Reply", sender_id=self.users[2].id, receiver_id=self.keep.id, message_id=message.id)
+        log_in(self.client, self.admin.id)
+
+    def test_level_change_counts_changed_users(self):
+        User.objects.filter(id=self.users[1].id).update(user_level=1)
+        ids = [self.admin.id, self.users[0].id, self.users[1].id]
+        response = self.client.post("/users/bulk", {"action": "level", "user_level": "1", "user_ids": ids}, follow=True)
+        self.assertContains(response, "User level changed for 1 user.")
+        self.assertEqual(User.objects.get(id=self.users[0].id).user_level, 1)
+
+        # Admins cannot change their own level:
+        response = self.client.post("/users/bulk", {"action": "level", "user_level": "0", "user_ids": [self.admin.id]}, follow=True)
+        self.assertEqual([(message.level, message.message) for message in response.context["messages"]], [(message_constants.ERROR, "Select at least one other user.")])
+        self.assertContains(response, "alert-danger")
+        self.assertEqual(User.objects.get(id=self.admin.id).user_level, 1)
+
+    def test_delete_reports_rows_and_keeps_counters(self):
+        ids = [self.admin.id, self.users[0].id, self.users[1].id, self.users[2].id]
+        response = self.client.post("/users/bulk", {"action": "delete", "user_ids": ids}, follow=True)
+        self.assertContains(response, "Deleted 3 users, 2 messages and 1 comment.")
+        self.assertEqual(sorted(User.objects.values_list("id", flat=True)), [self.admin.id, self.keep.id])
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(Comment.objects.exists())
+        keep = User.objects.get(id=self.keep.id)
+        self.assertEqual((keep.messages_received_count, keep.messages_sent_count, keep.comments_count), (0, 0, 0))
+
+    def test_normal_users_cannot_bulk_act(self):
+        log_in(self.client, self.users[0].id)
+        self.client.post("/users/bulk", {"action": "delete", "user_ids": [self.keep.id]})
+        self.assertTrue(User.objects.filter(id=self.keep.id).exists())
+
+    def test_rows_shared_by_users_in_different_batches_are_counted_once(self):
+        between = Message.objects.add(description="Between", sender_id=self.users[0].id, receiver_id=self.users[1].id)
+        Comment.objects.add(description="Mine", sender_id=self.keep.id, receiver_id=self.users[1].id, message_id=between.id)
+        batch_size = models.DELETE_BATCH_SIZE
+        models.DELETE_BATCH_SIZE = 1
+        try:
+            deleted = User.objects.remove(user_ids=[self.users[0].id, self.users[1].id])
+        finally:
+            models.DELETE_BATCH_SIZE = batch_size
+        self.assertEqual(deleted, {"users": 2, "messages": 3, "comments": 2})
+        for user in User.objects.filter(id__in=[self.keep.id, self.users[2].id]):
+            self.assertEqual((user.messages_received_count, user.messages_sent_count, user.comments_count), (0, 0, 0))
+
+    def test_remove_does_not_load_messages_or_hit_parameter_limit(self):
+        Message.objects.bulk_create([Message(description="Bulk", sender=self.users[0], receiver=self.keep) for number in range(1200)])
+        User.objects.filter(id=self.keep.id).update(messages_received_count=F("messages_received_count") + 1200) # `bulk_create()` skips the counters
+        with CaptureQueriesContext(connection) as queries:
+            deleted = User.objects.remove(user_ids=[self.users[0].id])
+        self.assertEqual(deleted, {"users": 1, "messages": 1201, "comments": 1})
+        self.assertEqual(User.objects.get(id=self.keep.id).messages_received_count, 0)
+        # No per-row statements (eg: a collector deleting messages in batches), only a few grouped counts and DELETEs per tier:
+        self.assertLess(len(queries), 20)
+        self.assertFalse([query for query in queries if query["sql"].startswith("SELECT") and "COUNT(" not in query["sql"]])
+
+
+@override_settings(USER_DELETION_THREAD=False, USER_DELETION_PAUSE=0)
+class BackgroundDeletionTests(TestCase):
+    """Tests for hiding deleted users at once and removing their rows in chunks."""
+
+    def setUp(self):
+        self.admin = User.objects.create(first_name="Ad", last_name="Min", email="admin@example.com", password="x", user_level=1)
+        self.heavy = User.objects.create(first_name="Heavy", last_name="Poster", email="heavy@example.com", password="x")
+        self.other = User.objects.create(first_name="Other", last_name="User", email="other@example.com", password="x")
+        for number in range(3):
+            Message.objects.add(description="Out", sender_id=self.heavy.id, receiver_id=self.other.id)
+        received = Message.objects.add(description="In", sender_id=self.other.id, receiver_id=self.heavy.id)
+        kept = Message.objects.add(description="Kept", sender_id=self.admin.id, receiver_id=self.other.id)
+        Comment.objects.add(description="On kept", sender_id=self.heavy.id, receiver_id=self.other.id, message_id=kept.id)
+        Comment.objects.add(description="On heavy wall", sender_id=self.other.id, receiver_id=self.heavy.id, message_id=received.id)
+        self.kept = kept
+
+    def schedule(self):
+        log_in(self.client, self.admin.id)
+        response = self.client.get("/users/edit/{}/delete".format(self.heavy.id), follow=True)
+        self.assertContains(response, "being removed in the background")
+        return UserDeletion.objects.get(user_id=self.heavy.id)
+
+    def test_user_hidden_before_rows_are_deleted(self):
+        user_client = self.client_class()
+        log_in(user_client, self.heavy.id)
+        self.schedule()
+        self.assertFalse(User.objects.filter(id=self.heavy.id).exists())
+        self.assertTrue(User._base_manager.filter(id=self.heavy.id).exists())
+        self.assertEqual(Message.objects.filter(sender_id=self.heavy.id).count(), 3)
+        # Gone from the wall they wrote on, and they are logged out:
+        wall = list(Message.objects.wall(receiver_id=self.other.id))
+        self.assertEqual([message.id for message in wall], [self.kept.id])
+        self.assertEqual(list(wall[0].comment.all()), [])
+        self.assertEqual(user_client.get("/dashboard").status_code, 302)
+
+    def test_hidden_user_cannot_post(self):
+        self.schedule()
+        sent_count = User._base_manager.get(id=self.heavy.id).messages_sent_count
+        validated = Message.objects.add(description="Stale", sender_id=self.heavy.id, receiver_id=self.other.id)
+        self.assertEqual(validated["errors"], ["User not found."])
+        validated = Comment.objects.add(description="Stale", sender_id=self.heavy.id, receiver_id=self.other.id, message_id=self.kept.id)
+        self.assertEqual(validated["errors"], ["Message not found."])
+        self.assertEqual(User._base_manager.get(id=self.heavy.id).messages_sent_count, sent_count)
+        self.assertEqual(Message.objects.get(id=self.kept.id).comments_count, 1)
+
+    @override_settings(PASSWORD_HASH_ROUNDS=4)
+    def test_hidden_user_email_still_taken(self):
+        self.schedule()
+        validated = User.objects.register(first_name="New", last_name="User", email="heavy@example.com", password="password1", confirm_pwd="password1")
+        self.assertEqual(validated["errors"], ["Email address already registered."])
+        handle, path = tempfile.mkstemp(suffix=".jsonl")
+        with os.fdopen(handle, "w") as import_file:
+            import_file.write(json.dumps({"type": "user", "first_name": "New", "last_name": "User", "email": "heavy@example.com", "password": "password1"}))
+        errors = StringIO()
+        try:
+            call_command("importdata", path, stdout=StringIO(), stderr=errors)
+        finally:
+            os.remove(path)
+        self.assertIn("already registered", errors.getvalue())
+
+    def test_run_pending_deletes_in_chunks_and_keeps_counters(self):
+        job = self.schedule()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(deletion.run_pending(chunk_size=2), 1)
+        self.assertFalse(User._base_manager.filter(id=self.heavy.id).exists())
+        self.assertFalse(Message.objects.filter(sender_id=self.heavy.id).exists())
+        self.assertFalse(Message.objects.filter(receiver_id=self.heavy.id).exists())
+        self.assertEqual(Comment.objects.count(), 0)
+        job = UserDeletion.objects.get(id=job.id)
+        self.assertEqual((job.messages_deleted, job.comments_deleted), (4, 2))
+        self.assertIsNotNone(job.finished_at)
+        other = User.objects.get(id=self.other.id)
+        self.assertEqual((other.messages_received_count, other.messages_sent_count, other.comments_count), (1, 0, 0))
+        self.assertEqual(Message.objects.get(id=self.kept.id).comments_count, 0)
+        # One DELETE per chunk, never per row:
+        deletes = [query["sql"] for query in queries.captured_queries if query["sql"].startswith("DELETE")]
+        self.assertEqual(len(deletes), 6) # comments written, comments received, messages sent (2 chunks), messages received, the user
+        self.assertEqual(deletion.run_pending(), 0)
+
+    def test_leased_job_is_skipped_until_lease_expires(self):
+        job = self.schedule()
+        UserDeletion.objects.filter(id=job.id).update(lease_owner="elsewhere", lease_expires=timezone.now() + timedelta(seconds=60))
+        self.assertEqual(deletion.run_pending(), 0)
+        self.assertTrue(Message.objects.filter(sender_id=self.heavy.id).exists())
+
+        # The other worker crashed; once its lease runs out the job is resumed:
+        UserDeletion.objects.filter(id=job.id).update(lease_expires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(deletion.run_pending(), 1)
+        self.assertFalse(User._base_manager.filter(id=self.heavy.id).exists())
+
+    def test_command_finishes_pending_jobs(self):
+        self.schedule()
+        output = StringIO()
+        call_command("process_deletions", stdout=output)
+        self.assertIn("Removed 1 users", output.getvalue())
+        self.assertFalse(UserDeletion.objects.filter(finished_at__isnull=True).exists())
+
+
+class MessageArchiveTests(TestCase):
+    """Tests for moving old messages to the archive tables and reading them back on deep wall pages."""
+
+    def setUp(self):
+        self.owner = User.objects.create(first_name="Wall", last_name="Owner", email="owner@example.com", password="x")
+        self.writer = User.objects.create(first_name="Old", last_name="Writer", email="writer@example.com", password="x")
+        self.messages = [Message.objects.add(description="Post {}".format(number), sender_id=self.writer.id, receiver_id=self.owner.id) for number in range(5)]
+        Comment.objects.add(description="Old reply", sender_id=self.owner.id, receiver_id=self.owner.id, message_id=self.messages[0].id)
+        Comment.objects.add(description="New reply", sender_id=self.writer.id, receiver_id=self.owner.id, message_id=self.messages[4].id)
+        # The first three posts are from long ago (oldest first, like their ids):
+        for number, message in enumerate(self.messages[:3]):
+            Message.objects.filter(id=message.id).update(created_at=timezone.now() - timedelta(days=400 - number))
+        self.ids = [message.id for message in reversed(self.messages)] # wall order, newest first
+
+    def archive(self):
+        output = StringIO()
+        call_command("archive_messages", days=365, batch_size=2, stdout=output)
+        return output.getvalue()
+
+    def test_command_moves_old_messages_with_comments(self):
+        self.assertIn("Archived 3 messages and 1 comments", self.archive())
+        self.assertEqual(sorted(Message.objects.values_list("id", flat=True)), self.ids[:2][::-1])
+        self.assertEqual(sorted(ArchivedMessage.objects.values_list("id", flat=True)), sorted(self.ids[2:]))
+        archived = ArchivedMessage.objects.get(id=self.messages[0].id)
+        self.assertEqual((archived.description, archived.sender_id, archived.comments_count), ("Post 0", self.writer.id, 1))
+        self.assertEqual(list(archived.comment.values_list("description", flat=True)), ["Old reply"])
+        self.assertEqual(Comment.objects.count(), 1)
+        # Archived rows still count, so the counters are all still right:
+        output = StringIO()
+        call_command("reconcile_counters", dry_run=True, stdout=output)
+        self.assertNotRegexpMatches(output.getvalue(), r"[1-9]\d* drifted")
+        self.assertIn("Archived 0 messages", self.archive())
+
+    def test_wall_reads_archive_only_past_the_hot_messages(self):
+        self.archive()
+        with CaptureQueriesContext(connection) as queries:
+            page = Message.objects.wall_page(receiver_id=self.owner.id, page_size=1)
+        self.assertFalse(any("archived" in query["sql"] for query in queries.captured_queries))
+        seen = [message.id for message in page.items]
+        while page.next_cursor:
+            page = Message.objects.wall_page(receiver_id=self.owner.id, page_size=1, after=page.next_cursor)
+            seen.extend(message.id for message in page.items)
+        self.assertEqual(seen, self.ids)
+
+        # A page spanning both tiers, rendered without comment forms on archived messages:
+        log_in(self.client, self.owner.id)
+        first = Message.objects.wall_page(receiver_id=self.owner.id, page_size=1)
+        with self.settings(WALL_PAGE_SIZE=3):
+            data = self.client.get("/users/show/{}/messages".format(self.owner.id), {"after": first.next_cursor}).json()
+        self.assertIn("Post 3", data["html"])
+        self.assertNotIn("Post 0", data["html"])
+        self.assertIn('name="message_id" value="{}"'.format(self.messages[3].id), data["html"])
+        self.assertNotIn('name="message_id" value="{}"'.format(self.messages[2].id), data["html"])
+        self.assertIsNotNone(data["next_cursor"])
+
+    def test_api_wall_includes_archived_messages(self):
+        self.archive()
+        log_in(self.client, self.owner.id)
+        data = self.client.get("/api/users/{}/messages".format(self.owner.id), {"per_page": 10}).json()
+        self.assertEqual([message["id"] for message in data["messages"]], self.ids)
+        self.assertEqual([comment["description"] for comment in data["messages"][-1]["comments"]], ["Old reply"])
+
+    def test_removing_users_deletes_archived_rows(self):
+        self.archive()
+        self.assertEqual(User.objects.remove(user_ids=[self.writer.id]), {"users": 1, "messages": 5, "comments": 2})
+        self.assertFalse(ArchivedMessage.objects.exists())
+        self.assertFalse(ArchivedComment.objects.exists())
+        owner = User.objects.get(id=self.owner.id)
+        self.assertEqual((owner.messages_received_count, owner.comments_count), (0, 0))
+
+    @override_settings(USER_DELETION_THREAD=False, USER_DELETION_PAUSE=0)
+    def test_background_removal_deletes_archived_rows(self):
+        self.archive()
+        User.objects.schedule_removal(user_ids=[self.owner.id])
+        self.assertEqual(deletion.run_pending(chunk_size=2), 1)
+        self.assertFalse(ArchivedMessage.objects.exists())
+        self.assertFalse(ArchivedComment.objects.exists())
+        writer = User.objects.get(id=self.writer.id)
+        self.assertEqual((writer.messages_sent_count, writer.comments_count), (0, 0))
+
+
+@override_settings(PERF_SAMPLE_RATE=1.0)
+class PerfTimingTests(TestCase):
+    """Tests for the per-request timing middleware and the rolling timings page."""
+
+    def setUp(self):
+        self.admin = User.objects.create(first_name="Ad", last_name="Min", email="admin@example.com", password="x", user_level=1)
+        self.user = User.objects.create(first_name="Nor", last_name="Mal", email="normal@example.com", password="x")
+        Message.objects.add(description="Hi", sender_id=self.user.id, receiver_id=self.admin.id)
+        # Ids repeat between tests, drop users cached by earlier ones:
+        user_cache.invalidate(self.admin.id)
+        user_cache.invalidate(self.user.id)
+        perf.get_stats().reset()
+        log_in(self.client, self.admin.id)
+
+    def timing(self, response):
+        return dict((name, float(value)) for name, value in re.findall(r"(\w+);dur=([\d.]+)", response["Server-Timing"]))
+
+    def test_server_timing_counts_every_query(self):
+        wall_cache.bump(self.admin.id)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/users/show/{}".format(self.admin.id))
+        self.assertIn('desc="{} queries"'.format(len(queries)), response["Server-Timing"])
+        timing = self.timing(response)
+        self.assertGreater(timing["tpl"], 0)
+        self.assertGreaterEqual(timing["total"], timing["tpl"])
+
+    def test_server_timing_is_only_sent_to_admins(self):
+        log_in(self.client, self.user.id)
+        self.assertFalse(self.client.get("/dashboard").has_header("Server-Timing"))
+        self.client.cookies.clear()
+        self.assertFalse(self.client.post("/signin", {"login_email": "nobody@example.com", "login_password": "password1"}).has_header("Server-Timing"))
+        # Still recorded:
+        self.assertEqual(dict((summary["route"], summary["count"]) for summary in perf.snapshot())["^dashboard$"], 1)
+        with self.settings(PERF_SERVER_TIMING_PUBLIC=True):
+            self.assertTrue(self.client.get("/").has_header("Server-Timing"))
+
+    @override_settings(PERF_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_left_alone(self):
+        response = self.client.get("/dashboard")
+        self.assertFalse(response.has_header("Server-Timing"))
+        self.assertEqual(perf.snapshot(), [])
+
+    def test_timings_are_grouped_by_url_pattern(self):
+        self.client.get("/users/show/{}".format(self.admin.id))
+        self.client.get("/users/show/{}".format(self.user.id))
+        self.client.get("/dashboard")
+        self.client.get("/dashboard/admin")
+        self.client.get("/no/such/page")
+        routes = dict((summary["route"], summary) for summary in perf.snapshot())
+        self.assertEqual(routes["^users/show/(?P<id>\\d*)$"]["count"], 2)
+        self.assertEqual(routes["^dashboard$"]["count"], 1)
+        self.assertEqual(routes["^dashboard/admin$"]["count"], 1)
+        self.assertEqual(routes[perf.UNRESOLVED]["count"], 1)
+        self.assertGreater(routes["^dashboard$"]["queries_max"], 0)
+
+    def test_window_keeps_latest_samples(self):
+        stats = perf.PerfStats(window=3)
+        for number in range(5):
+            timings = perf.RequestTimings()
+            timings.queries = number
+            stats.record("^route$", timings, number / 1000.0)
+        summary = stats.snapshot()[0]
+        self.assertEqual((summary["count"], summary["window"], summary["queries_max"]), (5, 3, 4))
+        self.assertEqual((summary["total_p50_ms"], summary["total_p99_ms"]), (3.0, 4.0))
+
+    def test_perf_page_is_admin_only(self):
+        self.client.get("/dashboard")
+        response = self.client.get("/debug/perf")
+        self.assertContains(response, "<code>^dashboard$</code>", html=False)
+        data = self.client.get("/debug/perf", {"format": "json"}).json()
+        self.assertIn("^debug/perf$", [summary["route"] for summary in data["routes"]])
+
+        log_in(self.client, self.user.id)
+        self.assertRedirects(self.client.get("/debug/perf"), "/dashboard", fetch_redirect_response=False)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Login throttling, checked before any user lookup or password hashing.
+
+Every sign in attempt takes a token from two buckets: one for the client IP and one
+for the email being signed in to. When either is empty the attempt is rejected, so
+a flood of attempts costs a dictionary lookup each instead of a bcrypt hash.
+
+Backends (`LOGIN_THROTTLE_BACKEND`):
+- `local` - Token buckets in process memory (each worker process limits on its own).
+- `cache` - Fixed-window counters in Django's cache, shared by every worker using the same
+  cache; `add()` and `incr()` are atomic on memcached and redis.
+
+Settings (see `user_dashboard/settings.py`):
+- `LOGIN_THROTTLE_PER_IP` / `LOGIN_THROTTLE_PER_EMAIL` - `{"burst": n, "per_minute": n}`, or None to disable.
+- `LOGIN_THROTTLE_MAX_KEYS` - Buckets kept per limiter by the `local` backend (oldest are dropped).
+- `LOGIN_THROTTLE_TRUST_X_FORWARDED_FOR` - Take the client IP from `X-Forwarded-For` (only behind a proxy that sets it).
+"""
+from __future__ import unicode_literals
+import hashlib
+import threading
+import time
+from collections import Counter, OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+
+CACHE_KEY = "dashboard:throttle:{}:{}:{}"
+
+
+class TokenBucketLimiter(object):
+    """
+    Creates instances of a `TokenBucketLimiter`, which keeps one token bucket per key in process memory.
+
+    Parameters:
+    - `burst` - Bucket size: attempts allowed at once.
+    - `per_minute` - Tokens added back per minute.
+    - `max_keys` - Most buckets kept; the least recently used are dropped.
+    """
+
+    def __init__(self, burst, per_minute, max_keys):
+        self.burst = float(burst)
+        self.rate = per_minute / 60.0
+        self.max_keys = max_keys
+        self.buckets = OrderedDict() # key -> (tokens, last update time), least recently used first
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        """Takes a token for `key`, returning False if its bucket is empty."""
+
+        now = time.time()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return allowed
+
+
+class CacheWindowLimiter(object):
+    """
+    Creates instances of a `CacheWindowLimiter`, which counts attempts per key in Django's cache.
+
+    Allows `burst` attempts per window of `burst / per_minute` minutes (the token bucket's refill time).
+
+    Parameters:
+    - `name` - Limiter name, part of the cache keys.
+    - `burst` - Attempts allowed per window.
+    - `per_minute` - Average attempts allowed per minute.
+    """
+
+    def __init__(self, name, burst, per_minute):
+        self.name = name
+        self.burst = burst
+        self.window = max(1, int(burst * 60.0 / per_minute))
+
+    def allow(self, key):
+        """Counts an attempt for `key`, returning False once the window's allowance is used up."""
+
+        window = int(time.time() // self.window)
+        # Hash keys, so emails are safe as cache keys (and are not stored in the cache):
+        cache_key = CACHE_KEY.format(self.name, hashlib.sha1(key.encode("utf-8")).hexdigest(), window)
+        cache.add(cache_key, 0, self.window * 2)
+        try:
+            count = cache.incr(cache_key)
+        except ValueError:
+            # The key expired or was evicted in between:
+            cache.set(cache_key, 1, self.window * 2)
+            count = 1
+        return count <= self.burst
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+_counts = Counter()
+_counts_lock = threading.Lock()
+
+def _get_limiter(name, rate):
+    """Returns the limiter for `name` at the configured `rate`, or None if it is disabled."""
+
+    if not rate:
+        return None
+    backend = settings.LOGIN_THROTTLE_BACKEND
+    config = (name, backend, rate["burst"], rate["per_minute"])
+    with _limiters_lock:
+        if config not in _limiters:
+            if backend == "cache":
+                _limiters[config] = CacheWindowLimiter(name, rate["burst"], rate["per_minute"])
+            else:
+                _limiters[config] = TokenBucketLimiter(rate["burst"], rate["per_minute"], settings.LOGIN_THROTTLE_MAX_KEYS)
+        return _limiters[config]
+
+def _count(name):
+    with _counts_lock:
+        _counts[name] += 1
+
+def client_ip(request):
+    """Returns the client IP of `request`."""
+
+    if settings.LOGIN_THROTTLE_TRUST_X_FORWARDED_FOR and request.META.get("HTTP_X_FORWARDED_FOR"):
+        return request.META["HTTP_X_FORWARDED_FOR"].split(",")[0].strip()
+    return request.META.get("REMOTE_ADDR", "")
+
+def check_login(request, email):
+    """
+    Takes a login attempt from both buckets.
+
+    Parameters:
+    - `request` - Current request.
+    - `email` - Email being signed in to.
+
+    Returns None if the attempt may go ahead, else the name of the bucket that ran out ("ip" or "email").
+    """
+
+    limiter = _get_limiter("ip", settings.LOGIN_THROTTLE_PER_IP)
+    if limiter is not None and not limiter.allow(client_ip(request)):
+        _count("throttled_ip")
+        return "ip"
+    limiter = _get_limiter("email", settings.LOGIN_THROTTLE_PER_EMAIL)
+    if limiter is not None and not limiter.allow(email.strip().lower()):
+        _count("throttled_email")
+        return "email"
+    _count("allowed")
+    return None
+
+def stats():
+    """Returns this process's login throttle counters."""
+
+    with _counts_lock:
+        counts = dict(_counts)
+    return {
+        "backend": settings.LOGIN_THROTTLE_BACKEND,
+        "allowed": counts.get("allowed", 0),
+        "throttled_ip": counts.get("throttled_ip", 0),
+        "throttled_email": counts.get("throttled_email", 0),
+    }
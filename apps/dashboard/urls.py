@@ -12,11 +12,22 @@ urlpatterns = [
     url(r'^users/new$', views.new_user), # load new user form or create new user
     url(r'^users/show/(?P<id>\d*)$', views.show_or_message_user), # Show user / Create Message on User Show page
     url(r'^users/show/(?P<id>\d*)/comment$', views.comment), # Comment
+    url(r'^users/show/(?P<id>\d*)/messages$', views.wall_messages), # Older page of a user's message wall (JSON)
+    url(r'^users/show/(?P<id>\d+)/live$', views.live_wall), # New messages and comments on a user's message wall (JSON, long-poll)
     url(r'^users/edit/(?P<id>\d*)$', views.admin_update_user), # Admin Edit / update a user
     url(r'^users/edit/(?P<id>\d*)/password$', views.admin_update_password), # Admin update user password
     url(r'^users/edit$', views.update_profile), # Edit / update
     url(r'^users/edit/password$', views.update_password), # Update user password
     url(r'^users/edit/description$', views.update_profile_description), # Update user description
     url(r'^users/edit/(?P<id>\d*)/delete$', views.delete_user), # Delete a user
+    url(r'^users/bulk$', views.bulk_users), # Change level of, or delete, checked users (admin only)
     url(r'^logout$', views.logout), # Logout user
+    url(r'^users/search$', views.search_users), # Search users (admin only)
+    url(r'^users/export$', views.export_users), # Stream the user directory as CSV or JSON lines (admin only)
+    url(r'^api/users$', views.api_users), # User directory (JSON, conditional GET)
+    url(r'^api/users/(?P<id>\d+)$', views.api_user), # Single user (JSON, conditional GET)
+    url(r'^api/users/(?P<id>\d+)/messages$', views.api_user_messages), # User's received messages and comments (JSON, conditional GET)
+    url(r'^debug/hashing$', views.hashing_stats), # Password hashing pool metrics (admin only)
+    url(r'^debug/throttle$', views.throttle_stats), # Login throttle counters (admin only)
+    url(r'^debug/perf$', views.perf_stats), # Rolling request timings per URL pattern (admin only)
 ]
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Process-local LRU cache of `User` rows, used to load the logged in user.
+
+Entries expire after `SESSION_USER_CACHE_TTL` seconds. Each user also has a version
+token, kept in Django's cache framework; `invalidate()` replaces it with a new random
+one, so every process sharing that cache backend drops its stale copy on the next lookup.
+Tokens never repeat, so a version key evicted from the backend cannot bring an old copy back. The backend must be
+shared by every process (settings refuse a local-memory one while this cache is on).
+
+Settings (see `user_dashboard/settings.py`):
+- `SESSION_USER_CACHE_SIZE` - Maximum number of cached users (0 disables the cache).
+- `SESSION_USER_CACHE_TTL` - Seconds before a cached user is reloaded.
+"""
+from __future__ import unicode_literals
+import copy # hand out copies, so callers cannot mutate the cached row
+import threading # guards the LRU between request threads
+import time
+import uuid # version tokens
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+
+VERSION_KEY = "dashboard:user_version:{}"
+
+class UserCache(object):
+    """Creates instances of a `UserCache`, a bounded LRU of users with TTL and version checks."""
+
+    def __init__(self, max_entries, timeout):
+        """
+        Parameters:
+        - `max_entries` - Maximum number of users held.
+        - `timeout` - Seconds an entry stays fresh.
+        """
+
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = OrderedDict() # user_id -> (version, expires, user), oldest first
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """
+        Returns a copy of the cached user, or None if missing, expired or invalidated.
+
+        Parameters:
+        - `user_id` - ID of the user to look up.
+        """
+
+        version = current_version(user_id)
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+            if entry is None:
+                return None
+            if entry[0] != version or entry[1] < time.time():
+                return None
+            # Re-insert to mark as most recently used:
+            self._entries[user_id] = entry
+        return copy.copy(entry[2])
+
+    def set(self, user):
+        """
+        Stores a user, evicting the least recently used entry if full.
+
+        Parameters:
+        - `user` - `User` instance to cache.
+        """
+
+        entry = (current_version(user.id), time.time() + self.timeout, copy.copy(user))
+        with self._lock:
+            self._entries.pop(user.id, None)
+            self._entries[user.id] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, user_id):
+        """Drops a user from this process's cache."""
+
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+def current_version(user_id):
+    """Returns the current version token of a user's cached row."""
+
+    key = VERSION_KEY.format(user_id)
+    version = cache.get(key)
+    if version is None:
+        # Never set, or evicted: start from a new token rather than a default, which an old entry could still hold:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+def invalidate(user_id):
+    """
+    Invalidates every cached copy of a user (call after any change to the user's row).
+
+    Parameters:
+    - `user_id` - ID of the changed (or deleted) user.
+    """
+
+    user_id = int(user_id)
+    cache.set(VERSION_KEY.format(user_id), uuid.uuid4().hex, None)
+    if _user_cache is not None:
+        _user_cache.discard(user_id)
+
+
+_user_cache = UserCache(settings.SESSION_USER_CACHE_SIZE, settings.SESSION_USER_CACHE_TTL) if settings.SESSION_USER_CACHE_SIZE > 0 else None
+
+def get_user_cache():
+    """Returns the process-wide `UserCache`, or None if disabled."""
+
+    return _user_cache
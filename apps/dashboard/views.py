@@ -1,8 +1,26 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 from django.shortcuts import render, redirect
+from django.http import JsonResponse, StreamingHttpResponse
+from django.template.defaulttags import CsrfTokenNode
+from django.template.loader import render_to_string
+from django.middleware.csrf import get_token
+from django.utils.safestring import mark_safe
+from django.conf import settings # access project settings (page sizes, etc.)
 from django.contrib import messages # access django's `messages` module.
 from models import User, Message, Comment # access our models
+from pagination import page_size_from_request # bounded `?per_page=` parsing
+import hashing # password hashing pool metrics
+import throttle # login throttling
+import user_cache # logged in user cache invalidation
+import wall_cache # rendered message wall cache
+import export # streaming user directory export
+import api # read-only JSON API with conditional GET
+import pubsub # live wall updates
+import deletion # background user removal
+import perf # request timing
+from routers import use_primary # primary reads for shared cache fills
+from log import get_logger # structured logging
 
 # Add extra message levels to default messaging to handle login or registration error generation:
 # https://docs.djangoproject.com/en/1.11/ref/contrib/messages/#creating-custom-message-levels
@@ -10,6 +28,26 @@ LOGIN_ERR = 50 # Messages level for login errors
 REG_ERR = 60 # Messages level for registration errors
 INDEX_MSG = 70 # Messages level for homepage messages
 
+logger = get_logger(__name__)
+
+WALL_CSRF_PLACEHOLDER = "__wall_csrf_token__" # Stands in for the CSRF token in cached message walls
+
+def csrf_input(csrf_token):
+    """Returns the hidden form input `{% csrf_token %}` renders for `csrf_token`."""
+
+    return CsrfTokenNode().render({"csrf_token": csrf_token})
+
+
+def session_user(request):
+    """
+    Returns the logged in user, as loaded once per request by `SessionUserMiddleware`.
+
+    Raises `KeyError` if there is no valid session, just as reading `request.session["user_id"]` would.
+    """
+
+    if request.logged_in_user is None:
+        raise KeyError("user_id")
+    return request.logged_in_user
 
 def index(request):
     """Loads homepage."""
@@ -26,11 +64,21 @@ def login(request):
             "email": request.POST["login_email"],
             "password": request.POST["login_password"],
         }
+
+        # Reject floods of attempts before any lookup or hashing (see `./throttle.py`):
+        throttled = throttle.check_login(request, login_data["email"])
+        if throttled:
+            logger.warning("user.login.throttled", bucket=throttled)
+            messages.add_message(request, LOGIN_ERR, "Too many login attempts. Please wait a minute and try again.", extra_tags="login_errors")
+            response = render(request, "dashboard/login.html", status=429)
+            response["Retry-After"] = "60"
+            return response
+
         validated = User.objects.login(**login_data)
         try:
             # If errors, reload login page with errors:
             if len(validated["errors"]) > 0:
-                print "User could not be logged in."
+                logger.debug("user.login.failed")
                 # Loop through errors and Generate Django Message for each with custom level and tag:
                 for error in validated["errors"]:
                     messages.add_message(request, LOGIN_ERR, error, extra_tags="login_errors")
@@ -38,10 +86,9 @@ def login(request):
                 return redirect("/signin")
         except KeyError:
             # If validation successful, set session, and load dashboard based on user level:
-            print "User passed validation..."
+            logger.info("user.login.succeeded", user_id=validated["logged_in_user"].id)
 
             # Set session to validated User:
-            print "Setting session data for logged in user..."
             request.session["user_id"] = validated["logged_in_user"].id
 
             # Check user level:
@@ -80,7 +127,7 @@ def register(request):
         # If errors, reload register page with errors:
         try:
             if len(validated["errors"]) > 0:
-                print "User could not be registered."
+                logger.debug("user.register.failed")
                 # Loop through errors and Generate Django Message for each with custom level and tag:
                 for error in validated["errors"]:
                     messages.add_message(request, REG_ERR, error, extra_tags="reg_errors")
@@ -88,17 +135,17 @@ def register(request):
                 return redirect("/register")
         except KeyError:
             # If validation successful, set session and load dashboard based on user level:
-            print "User passed validation and has been created..."
+            logger.debug("user.register.succeeded", user_id=validated["logged_in_user"].id)
 
             # Set session to validated User:
-            print "Setting session data for logged in new user..."
             request.session["user_id"] = validated["logged_in_user"].id
 
             # If this is the first user, set to admin and tell them so:
-            if len(User.objects.all()) <= 5:
+            if User.objects.count() <= 5:
                 # Set first user to admin:
                 validated["logged_in_user"].user_level = 1
                 validated["logged_in_user"].save()
+                user_cache.invalidate(validated["logged_in_user"].id)
                 # Set message:
                 messages.success(request, "As one of the first 5 users, you are an admin! After all 5 admin accounts are created, new users will be normal level unless changed by you!")
 
@@ -114,15 +161,24 @@ def dashboard(request):
 
     # Check session before loading dashboard:
     try:
-        user = User.objects.get(id=request.session["user_id"])
-        print "User session validated."
+        user = session_user(request)
+        logger.debug("session.valid", user_id=user.id)
+
+        # Get one page of the user directory (see `./models.py`, `UserManager.directory_page()`):
+        page_data = {
+            "page_size": page_size_from_request(request, settings.DASHBOARD_PAGE_SIZE, settings.DASHBOARD_MAX_PAGE_SIZE),
+            "after": request.GET.get("after"),
+            "before": request.GET.get("before"),
+        }
+        page = User.objects.directory_page(**page_data)
 
         # Check if Normal User:
         if user.user_level == 0:
             # If normal user, get data for normal user dashboard:
             user_data = {
-                "logged_in_user": User.objects.get(id=request.session["user_id"]),
-                "all_users": User.objects.all().order_by("last_name")
+                "logged_in_user": user,
+                "all_users": page.items,
+                "page": page,
             }
 
             # Remove password properties from all_users.
@@ -131,15 +187,16 @@ def dashboard(request):
                 # delete password property
                 del user.password
 
-                # Load normal user dashboard:
-                return render(request, "dashboard/user_dashboard.html", user_data)
+            # Load normal user dashboard:
+            return render(request, "dashboard/user_dashboard.html", user_data)
 
         # Check if Admin User:
         if user.user_level == 1:
             # Get data for admin user dashboard:
             admin_data = {
-                "logged_in_user": User.objects.get(id=request.session["user_id"]),
-                "all_users": User.objects.all().order_by("last_name")
+                "logged_in_user": user,
+                "all_users": page.items,
+                "page": page,
             }
 
             # Load admin dashboard:
@@ -148,7 +205,47 @@ def dashboard(request):
 
     except (KeyError, User.DoesNotExist) as err:
         # If session object not found, load index:
-        print "User session not validated."
+        logger.debug("session.invalid")
+        messages.add_message(request, INDEX_MSG, "You must be logged in to view this page.", extra_tags="index_msg")
+        return redirect("/")
+
+def search_users(request):
+    """
+    Searches users by name, email and description (admins only).
+
+    - `?q=` - Search text.
+    """
+
+    try:
+        user = session_user(request)
+
+        # Check if user is admin:
+        if user.user_level == 1:
+            query = request.GET.get("q", "").strip()
+            if not query:
+                return redirect('/dashboard')
+
+            # Get one page of ranked results (see `./models.py`, `UserManager.search_page()`):
+            page = User.objects.search_page(
+                query=query,
+                page_size=page_size_from_request(request, settings.DASHBOARD_PAGE_SIZE, settings.DASHBOARD_MAX_PAGE_SIZE),
+                after=request.GET.get("after"),
+                before=request.GET.get("before"),
+            )
+            search_data = {
+                "logged_in_user": user,
+                "all_users": page.items,
+                "page": page,
+                "query": query,
+            }
+
+            # Load admin dashboard, showing the search results:
+            return render(request, "dashboard/admin_dashboard.html", search_data)
+        else:
+            return redirect('/dashboard')
+
+    except (KeyError, User.DoesNotExist):
+        logger.debug("session.invalid")
         messages.add_message(request, INDEX_MSG, "You must be logged in to view this page.", extra_tags="index_msg")
         return redirect("/")
 
@@ -169,7 +266,7 @@ def show_or_message_user(request, id):
         # If errors, reload user show page with errors:
         try:
             if len(validated["errors"]) > 0:
-                print "Message could not be created."
+                logger.debug("message.add.failed")
                 # Loop through errors and Generate Django Message for each with custom level and tag:
                 for error in validated["errors"]:
                     messages.error(request, error, extra_tags="message_errors")
@@ -177,17 +274,183 @@ def show_or_message_user(request, id):
                 return redirect("/users/show/" + id)
         except TypeError:
             # If validation successful, reload show page:
-            print "Message passed validation and has been created..."
+            logger.info("message.added", message_id=validated.id)
             return redirect("/users/show/" + id)
     else:
         # GET request, load show user page (assemble data for show template):
+        show_user = User.objects.get(id=id) # Get user by id (for user profile)
         user_data = {
-            "show_user": User.objects.get(id=id), # Get user by id (for user profile)
-            "logged_in_user": User.objects.get(id=request.session["user_id"]),
-            "user_messages": User.objects.get(id=id).messages_received.all().order_by("-created_at"),
+            "show_user": show_user,
+            "logged_in_user": session_user(request),
+            "wall": render_wall(request, show_user, after=request.GET.get("after")), # Messages and comments (newest page cached, see `./wall_cache.py`)
         }
         return render(request, "dashboard/show_user.html", user_data)
 
+def render_wall(request, show_user, after=None):
+    """
+    Returns the rendered message wall of `show_user`, from the wall cache when possible.
+
+    Parameters:
+    - `show_user` - User whose received messages are shown.
+    - `after` - Cursor of an older page to show instead of the newest one (not cached; used when JavaScript is off).
+    """
+
+    def build(csrf_token):
+        wall_data = {
+            "show_user": show_user,
+            # Taken before the page is read, so a post made in between is shown twice (and dropped by `show_user.js`), never missed:
+            "live_cursor": Message.objects.wall_cursor(receiver_id=show_user.id),
+            "page": Message.objects.wall_page(receiver_id=show_user.id, page_size=settings.WALL_PAGE_SIZE, after=after), # Messages with senders and comments preloaded
+            "csrf_token": csrf_token,
+        }
+        return render_to_string("dashboard/message_wall.html", wall_data)
+
+    if after:
+        return mark_safe(build(get_token(request)))
+
+    def build_shared():
+        # Cached walls outlive replication lag, so they are built from the primary:
+        with use_primary():
+            return build(WALL_CSRF_PLACEHOLDER)
+
+    # The cached wall is shared by every viewer, swap in this viewer's CSRF token. Only whole form
+    # inputs are swapped: escaped messages can hold the placeholder, but never the input's `<` or `'`:
+    return mark_safe(wall_cache.get_or_build(show_user.id, build_shared).replace(csrf_input(WALL_CSRF_PLACEHOLDER), csrf_input(get_token(request))))
+
+def wall_messages(request, id):
+    """
+    Returns an older page of a user's message wall as JSON, for loading history on scroll.
+
+    - `id` - ID of user whose wall is shown.
+    - `?after=` - Cursor of the last message already shown.
+
+    Response: `html` (the rendered messages and comments, ending with a link to the next page
+    if there is one) and `next_cursor`.
+    """
+
+    try:
+        session_user(request)
+        show_user = User.objects.get(id=id)
+    except (KeyError, User.DoesNotExist):
+        logger.debug("session.invalid")
+        return JsonResponse({"errors": ["Not found."]}, status=404)
+
+    page = Message.objects.wall_page(receiver_id=show_user.id, page_size=settings.WALL_PAGE_SIZE, after=request.GET.get("after"))
+    html = render_to_string("dashboard/message_wall_page.html", {"show_user": show_user, "page": page}, request=request)
+    return JsonResponse({"html": html, "next_cursor": page.next_cursor})
+
+def live_wall(request, id):
+    """
+    Long-polls a user's message wall for messages and comments posted after a cursor, as JSON.
+
+    - `id` - ID of user whose wall is shown.
+    - `?cursor=` - `cursor` of the previous response (the first comes from the wall's `data-live-url`).
+
+    If nothing is new, waits up to `LIVE_POLL_TIMEOUT` seconds for a post (see `./pubsub.py`).
+    Response: `messages` (`id` and rendered `html`, oldest first), `comments` (`id`, `message_id`
+    and rendered `html`) and the `cursor` to poll with next. Answers `503` when this process has
+    `LIVE_MAX_WAITERS` polls waiting already; clients retry after `Retry-After` seconds.
+    """
+
+    try:
+        session_user(request)
+        show_user = User.objects.get(id=id)
+    except (KeyError, User.DoesNotExist):
+        logger.debug("session.invalid")
+        return JsonResponse({"errors": ["Not found."]}, status=404)
+
+    topic = pubsub.WALL_TOPIC.format(show_user.id)
+    update_data = {
+        "receiver_id": show_user.id,
+        "cursor": request.GET.get("cursor"),
+    }
+    # Noted before reading, so a post made while we read still wakes us:
+    version = pubsub.version(topic)
+    # Replicas may not have the post that woke us yet, read from the primary:
+    with use_primary():
+        updates = Message.objects.wall_updates(**update_data)
+        if "errors" in updates:
+            return JsonResponse(updates, status=400)
+
+        # Nothing new yet, wait for a post:
+        if not updates["messages"] and not updates["comments"]:
+            posted = pubsub.wait(topic, version)
+            if posted is None:
+                logger.warning("live.busy", receiver_id=show_user.id)
+                response = JsonResponse({"errors": ["Too many live updates in progress."]}, status=503)
+                response["Retry-After"] = "5"
+                return response
+            if posted:
+                updates = Message.objects.wall_updates(**update_data)
+
+    return JsonResponse({
+        "messages": [{"id": message.id, "html": render_to_string("dashboard/message_wall_item.html", {"show_user": show_user, "message": message}, request=request)} for message in updates["messages"]],
+        "comments": [{"id": comment.id, "message_id": comment.message_id, "html": render_to_string("dashboard/message_wall_comment.html", {"comment": comment}, request=request)} for comment in updates["comments"]],
+        "cursor": updates["cursor"],
+    })
+
+def api_users(request):
+    """
+    Returns one page of the user directory as JSON, ordered by last name.
+
+    - `?after=` / `?before=` - Cursors of the next / previous page.
+    - `?per_page=` - Page size (bounded by `DASHBOARD_MAX_PAGE_SIZE`).
+
+    Answers `304` when `If-None-Match` matches the directory's ETag (see `./api.py`).
+    """
+
+    try:
+        session_user(request)
+    except (KeyError, User.DoesNotExist):
+        logger.debug("session.invalid")
+        return JsonResponse({"errors": ["Login required."]}, status=401)
+
+    page_size = page_size_from_request(request, settings.DASHBOARD_PAGE_SIZE, settings.DASHBOARD_MAX_PAGE_SIZE)
+    return api.conditional_json(request, api.user_list_validators(), lambda: api.user_list(page_size, after=request.GET.get("after"), before=request.GET.get("before")))
+
+def api_user(request, id):
+    """
+    Returns one user as JSON.
+
+    - `id` - ID of user to show.
+
+    Answers `304` when `If-None-Match` or `If-Modified-Since` shows the client's copy is current.
+    """
+
+    try:
+        session_user(request)
+    except (KeyError, User.DoesNotExist):
+        logger.debug("session.invalid")
+        return JsonResponse({"errors": ["Login required."]}, status=401)
+
+    validators = api.user_validators(id)
+    if validators is None:
+        return JsonResponse({"errors": ["Not found."]}, status=404)
+    return api.conditional_json(request, validators, lambda: api.user_detail(id))
+
+def api_user_messages(request, id):
+    """
+    Returns one page of a user's received messages, with their comments, as JSON.
+
+    - `id` - ID of user whose wall is shown.
+    - `?after=` - Cursor of the last message already loaded.
+    - `?per_page=` - Page size (bounded by `DASHBOARD_MAX_PAGE_SIZE`).
+
+    Answers `304` when `If-None-Match` matches the wall's ETag (see `./api.py`).
+    """
+
+    try:
+        session_user(request)
+    except (KeyError, User.DoesNotExist):
+        logger.debug("session.invalid")
+        return JsonResponse({"errors": ["Login required."]}, status=401)
+
+    validators = api.wall_validators(id)
+    if validators is None:
+        return JsonResponse({"errors": ["Not found."]}, status=404)
+    page_size = page_size_from_request(request, settings.WALL_PAGE_SIZE, settings.DASHBOARD_MAX_PAGE_SIZE)
+    return api.conditional_json(request, validators, lambda: api.wall(id, page_size, after=request.GET.get("after")))
+
 def comment(request, id):
     """
     Comment on a message.
@@ -210,7 +473,7 @@ def comment(request, id):
     # If errors, reload user show page with errors:
     try:
         if len(validated["errors"]) > 0:
-            print "Comment could not be created."
+            logger.debug("comment.add.failed")
             # Loop through errors and Generate Django Message for each with custom level and tag:
             for error in validated["errors"]:
                 messages.error(request, error, extra_tags="comment_errors")
@@ -218,14 +481,14 @@ def comment(request, id):
             return redirect("/users/show/" + id)
     except TypeError:
         # If validation successful, reload show page:
-        print "Comment passed validation and has been created..."
+        logger.info("comment.added", comment_id=validated.id)
         return redirect("/users/show/" + id)
 
 def new_user(request):
     """If GET, load admin new user page, if POST, create new user."""
 
     # First ensure that only an admin may access this page:
-    user = User.objects.get(id=request.session["user_id"])
+    user = session_user(request)
 
     # If user is normal user, bring back to dashboard:
     if user.user_level == 0:
@@ -250,7 +513,7 @@ def new_user(request):
             # If errors, reload index page with errors:
             try:
                 if len(validated["errors"]) > 0:
-                    print "User could not be created."
+                    logger.debug("user.create.failed")
                     # Loop through errors and Generate Django Message for each with custom level and tag:
                     for error in validated["errors"]:
                         messages.add_message(request, REG_ERR, error, extra_tags="reg_errors")
@@ -258,7 +521,7 @@ def new_user(request):
                     return redirect("/users/new")
             except KeyError:
                 # If validation successful, set session and load dashboard based on user level:
-                print "User passed validation and has been created..."
+                logger.debug("user.create.succeeded", user_id=validated["logged_in_user"].id)
                 # Create success message:
                 messages.success(request, 'New user {} {} has been created.'.format(validated["logged_in_user"].first_name, validated["logged_in_user"].last_name))
                 # Redirect to dashboard:
@@ -276,7 +539,7 @@ def new_user(request):
 
     # In the event the user level is spoofed redirect to dashboard:
     else:
-        print "Session invalid."
+        logger.debug("session.invalid")
         return redirect('/')
 
 def admin_update_user(request, id):
@@ -289,7 +552,7 @@ def admin_update_user(request, id):
 
     try:
         # Check if user has valid session and is admin:
-        if User.objects.get(id=request.session["user_id"]).user_level == 1:
+        if session_user(request).user_level == 1:
 
             # If POST, validate and update user information:
             if request.method == "POST":
@@ -308,7 +571,7 @@ def admin_update_user(request, id):
                 # If errors, reload profile page with errors:
                 try:
                     if len(validated["errors"]) > 0:
-                        print "User could not be updated."
+                        logger.debug("user.update.failed")
                         # Loop through errors and Generate Django Message for each with custom level and tag:
                         for error in validated["errors"]:
                             messages.error(request, error, extra_tags="admin_edit_errors")
@@ -316,7 +579,7 @@ def admin_update_user(request, id):
                         return redirect("/users/edit/" + id)
                 except TypeError:
                     # If validation successful, set session and load dashboard based on user level:
-                    print "User passed validation and has been created..."
+                    logger.debug("user.update.succeeded")
                     # Create success message:
                     messages.success(request, 'User profile {} {} has been updated.'.format(validated.first_name, validated.last_name))
                     # Redirect to dashboard:
@@ -335,7 +598,7 @@ def admin_update_user(request, id):
             return redirect('/dashboard')
 
     except KeyError:
-        print "Session not valid."
+        logger.debug("session.invalid")
         # This would only fire if session key is invalid, or if id submitted is non integer:
         return redirect('/')
 
@@ -347,18 +610,9 @@ def admin_update_password(request, id):
     - `id` - ID of user for password update.
     """
 
-    print "Admin Password Update Running"
-
-    if request.method == "POST":
-        print "POST"
-    else:
-        print "GET"
-
     try:
-        # Check if user has valid session:
-        request.session["user_id"]
-        # Check if user is admin:
-        if User.objects.get(id=request.session["user_id"]).user_level == 1:
+        # Check if user has valid session and is admin:
+        if session_user(request).user_level == 1:
 
             # If POST method, validate and update user password:
             if request.method == "POST":
@@ -376,7 +630,7 @@ def admin_update_password(request, id):
                 # If errors, reload profile page with errors:
                 try:
                     if len(validated["errors"]) > 0:
-                        print "User password could not be updated."
+                        logger.debug("user.password.update_failed")
                         # Loop through errors and Generate Django Message for each with custom level and tag:
                         for error in validated["errors"]:
                             messages.error(request, error, extra_tags="admin_password_errors")
@@ -384,7 +638,7 @@ def admin_update_password(request, id):
                         return redirect("/users/edit/" + id)
                 except TypeError:
                     # If validation successful, send success message and load dashboard:
-                    print "User password has been updated..."
+                    logger.debug("user.password.update_succeeded")
                     # Create success message:
                     messages.success(request, 'Password updated.')
                     # Redirect to dashboard:
@@ -400,7 +654,7 @@ def admin_update_password(request, id):
 
     except KeyError:
         # If no session key, go home:
-        print "Session invalid."
+        logger.debug("session.invalid")
         return redirect('/')
 
 def update_profile(request):
@@ -426,7 +680,7 @@ def update_profile(request):
             # If errors, reload profile page with errors:
             try:
                 if len(validated["errors"]) > 0:
-                    print "User could not be updated."
+                    logger.debug("user.update.failed")
                     # Loop through errors and Generate Django Message for each with custom level and tag:
                     for error in validated["errors"]:
                         messages.error(request, error, extra_tags="profile_errors")
@@ -434,7 +688,7 @@ def update_profile(request):
                     return redirect("/users/edit")
             except TypeError:
                 # If validation successful, set session and load dashboard based on user level:
-                print "User passed validation and has been created..."
+                logger.debug("user.update.succeeded")
                 # Create success message:
                 messages.success(request, 'User profile {} {} has been updated.'.format(validated.first_name, validated.last_name))
                 # Redirect to dashboard:
@@ -443,7 +697,7 @@ def update_profile(request):
         else:
             # Else GET currently logged in user and load edit user profile page:
             user = {
-                "user": User.objects.get(id=request.session["user_id"]) # retreive user with current session
+                "user": session_user(request) # retreive user with current session
             }
 
             # Load edit profile page with current session user:
@@ -451,7 +705,7 @@ def update_profile(request):
 
     except KeyError:
         # This would only fire if session key is invalid:
-        print "Session invalid."
+        logger.debug("session.invalid")
         return redirect('/')
 
 def update_password(request):
@@ -476,7 +730,7 @@ def update_password(request):
             # If errors, reload profile page with errors:
             try:
                 if len(validated["errors"]) > 0:
-                    print "User password could not be updated."
+                    logger.debug("user.password.update_failed")
                     # Loop through errors and Generate Django Message for each with custom level and tag:
                     for error in validated["errors"]:
                         messages.error(request, error, extra_tags="password_errors")
@@ -484,7 +738,7 @@ def update_password(request):
                     return redirect("/users/edit")
             except TypeError:
                 # If validation successful, set success message and load dashboard:
-                print "User password has been updated..."
+                logger.debug("user.password.update_succeeded")
                 # Create success message:
                 messages.success(request, 'Password updated.')
                 # Redirect to dashboard:
@@ -496,7 +750,7 @@ def update_password(request):
 
     except KeyError:
         # This would only fire if session key is invalid:
-        print "Session invalid."
+        logger.debug("session.invalid")
         return redirect('/')
 
 def update_profile_description(request):
@@ -520,7 +774,7 @@ def update_profile_description(request):
             # If errors, reload profile page with errors:
             try:
                 if len(validated["errors"]) > 0:
-                    print "User description could not be updated."
+                    logger.debug("user.description.update_failed")
                     # Loop through errors and Generate Django Message for each with custom level and tag:
                     for error in validated["errors"]:
                         messages.error(request, error, extra_tags="description_errors")
@@ -528,7 +782,7 @@ def update_profile_description(request):
                     return redirect("/users/edit")
             except TypeError:
                 # If validation successful, set session and load dashboard based on user level:
-                print "User description has been updated..."
+                logger.info("user.description.updated", user_id=request.session["user_id"])
                 # Create success message:
                 messages.success(request, 'Description updated.')
                 # Redirect to dashboard:
@@ -537,7 +791,7 @@ def update_profile_description(request):
         else:
             # Else GET currently logged in user and load edit user profile page:
             user = {
-                "user": User.objects.get(id=request.session["user_id"]) # retreive user with current session
+                "user": session_user(request) # retreive user with current session
             }
 
             # Load edit profile page with current session user:
@@ -545,7 +799,7 @@ def update_profile_description(request):
 
     except KeyError:
         # This would only fire if session key is invalid:
-        print "Session invalid."
+        logger.debug("session.invalid")
         return redirect('/')
 
 
@@ -557,22 +811,158 @@ def delete_user(request, id):
     """
 
     # Do not allow a user to delete themselves
-    if User.objects.get(id=request.session["user_id"]).id == id:
+    if str(session_user(request).id) == id:
         # Create success message:
         messages.success(request, 'You cannot delete yourself here.')
         # Return to dashboard:
         return redirect('/dashboard')
 
-    # Delete user by id:
-    User.objects.get(id=id).delete()
+    # Hide the user at once; their messages and comments are deleted in the background, a chunk at a time
+    # (see `./models.py`, `UserManager.schedule_removal()`, and `./deletion.py`):
+    User.objects.schedule_removal(user_ids=[id])
+    deletion.start_worker()
 
     # Create success message:
-    messages.success(request, 'User deleted.')
+    messages.success(request, 'User deleted. Their messages and comments are being removed in the background.')
 
     # Return to dashboard:
     return redirect('/dashboard')
 
 
+def counted(number, noun):
+    """Returns eg: "1 user" or "3 users"."""
+
+    return "{} {}{}".format(number, noun, "" if number == 1 else "s")
+
+def bulk_users(request):
+    """
+    Admin bulk actions on the users checked on the admin dashboard.
+
+    - `user_ids` - IDs of the checked users (the admin's own ID is ignored).
+    - `action` - `level` (set `user_level` for all of them) or `delete`.
+
+    Each action runs as one transaction of set-based statements; the dashboard reports the rows affected.
+    """
+
+    try:
+        user = session_user(request)
+
+        # Check if user is admin, and this is a form submission:
+        if user.user_level == 1 and request.method == "POST":
+            user_ids = [user_id for user_id in request.POST.getlist("user_ids") if user_id.isdigit()]
+
+            if request.POST.get("action") == "level":
+                # Validate and update levels (errors returned, else number of users changed):
+                level_data = {
+                    "user_ids": user_ids,
+                    "user_level": request.POST.get("user_level", ""),
+                    "admin_id": user.id,
+                }
+                validated = User.objects.bulk_update_level(**level_data)
+                try:
+                    if len(validated["errors"]) > 0:
+                        for error in validated["errors"]:
+                            messages.error(request, error, extra_tags="bulk_errors")
+                except TypeError:
+                    messages.success(request, "User level changed for {}.".format(counted(validated, "user")))
+
+            elif request.POST.get("action") == "delete":
+                # Do not allow a user to delete themselves:
+                user_ids = [user_id for user_id in user_ids if int(user_id) != user.id]
+                if user_ids:
+                    # See `./models.py`, `UserManager.remove()`:
+                    deleted = User.objects.remove(user_ids=user_ids)
+                    messages.success(request, "Deleted {}, {} and {}.".format(counted(deleted["users"], "user"), counted(deleted["messages"], "message"), counted(deleted["comments"], "comment")))
+                else:
+                    messages.error(request, "Select at least one other user.", extra_tags="bulk_errors")
+
+        return redirect('/dashboard')
+
+    except (KeyError, User.DoesNotExist):
+        logger.debug("session.invalid")
+        return redirect('/')
+
+
+def hashing_stats(request):
+    """Returns password hashing pool saturation metrics as JSON (admins only)."""
+
+    try:
+        # Check if user has valid session and is admin:
+        if session_user(request).user_level == 1:
+            return JsonResponse(hashing.stats())
+        else:
+            return redirect('/dashboard')
+
+    except (KeyError, User.DoesNotExist):
+        logger.debug("session.invalid")
+        return redirect('/')
+
+
+def export_users(request):
+    """
+    Streams the full user directory as CSV or JSON lines (admins only).
+
+    - `?format=` - `csv` (default) or `jsonl`.
+    """
+
+    try:
+        # Check if user has valid session and is admin:
+        if session_user(request).user_level == 1:
+            users = export.iter_directory(settings.DASHBOARD_EXPORT_CHUNK_SIZE)
+            if request.GET.get("format") == "jsonl":
+                response = StreamingHttpResponse(export.jsonl_lines(users), content_type="application/x-ndjson; charset=utf-8")
+                response["Content-Disposition"] = 'attachment; filename="users.jsonl"'
+            else:
+                response = StreamingHttpResponse(export.csv_lines(users), content_type="text/csv; charset=utf-8")
+                response["Content-Disposition"] = 'attachment; filename="users.csv"'
+            logger.info("user.export", format=request.GET.get("format", "csv"))
+            return response
+        else:
+            return redirect('/dashboard')
+
+    except (KeyError, User.DoesNotExist):
+        logger.debug("session.invalid")
+        return redirect('/')
+
+
+def throttle_stats(request):
+    """Returns login throttle counters as JSON (admins only)."""
+
+    try:
+        # Check if user has valid session and is admin:
+        if session_user(request).user_level == 1:
+            return JsonResponse(throttle.stats())
+        else:
+            return redirect('/dashboard')
+
+    except (KeyError, User.DoesNotExist):
+        logger.debug("session.invalid")
+        return redirect('/')
+
+
+def perf_stats(request):
+    """
+    Shows rolling request timings per URL pattern (admins only).
+
+    - `?format=json` - Returns them as JSON instead.
+    """
+
+    try:
+        # Check if user has valid session and is admin:
+        user = session_user(request)
+        if user.user_level == 1:
+            routes = perf.snapshot()
+            if request.GET.get("format") == "json":
+                return JsonResponse({"sample_rate": settings.PERF_SAMPLE_RATE, "routes": routes})
+            return render(request, "dashboard/debug_perf.html", {"logged_in_user": user, "routes": routes, "sample_rate": settings.PERF_SAMPLE_RATE, "window": settings.PERF_WINDOW})
+        else:
+            return redirect('/dashboard')
+
+    except (KeyError, User.DoesNotExist):
+        logger.debug("session.invalid")
+        return redirect('/')
+
+
 def logout(request):
     """Logs out current user."""
 
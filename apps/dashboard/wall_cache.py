@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of rendered message walls (the messages and comments on `show_user.html`).
+
+Each receiver has a wall version token in Django's cache; the rendered fragment is stored
+under a key that includes it. Posting a message or comment, or deleting a user, replaces
+the token, so the next reader renders a fresh wall and old fragments simply expire.
+Tokens never repeat, so an evicted version key cannot point back at an old fragment.
+
+Only one request rebuilds a missing fragment: it takes a short lock with `cache.add()`,
+and concurrent readers wait for its result instead of all querying and rendering the
+same wall at once.
+
+Settings (see `user_dashboard/settings.py`):
+- `WALL_CACHE_TIMEOUT` - Seconds a rendered wall is kept (also bounds how stale "x minutes ago" gets).
+- `WALL_CACHE_LOCK_TIMEOUT` - Seconds readers wait on a rebuild before rendering it themselves.
+"""
+from __future__ import unicode_literals
+import time
+import uuid # version tokens
+from django.conf import settings
+from django.core.cache import cache
+
+VERSION_KEY = "dashboard:wall_version:{}"
+FRAGMENT_KEY = "dashboard:wall:{}:{}"
+LOCK_KEY = "dashboard:wall_lock:{}:{}"
+POLL_INTERVAL = 0.05 # seconds between checks while another request rebuilds
+
+def wall_version(receiver_id):
+    """Returns the current wall version token of a receiver."""
+
+    key = VERSION_KEY.format(receiver_id)
+    version = cache.get(key)
+    if version is None:
+        # Never set, or evicted: start from a new token rather than a default, which an old fragment could still be under:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+def bump(*receiver_ids):
+    """
+    Invalidates the cached walls of the given receivers.
+
+    Parameters:
+    - `*receiver_ids` - IDs of users whose walls changed.
+    """
+
+    for receiver_id in set(int(receiver_id) for receiver_id in receiver_ids):
+        cache.set(VERSION_KEY.format(receiver_id), uuid.uuid4().hex, None)
+
+def get_or_build(receiver_id, build):
+    """
+    Returns a receiver's rendered wall, calling `build()` to render it on a cache miss.
+
+    Parameters:
+    - `receiver_id` - ID of the user whose wall is shown.
+    - `build` - Function returning the rendered wall as a string.
+    """
+
+    version = wall_version(receiver_id)
+    key = FRAGMENT_KEY.format(receiver_id, version)
+    html = cache.get(key)
+    if html is not None:
+        return html
+
+    lock_key = LOCK_KEY.format(receiver_id, version)
+    if cache.add(lock_key, 1, settings.WALL_CACHE_LOCK_TIMEOUT):
+        # We hold the lock, rebuild and publish the wall:
+        try:
+            html = build()
+            cache.set(key, html, settings.WALL_CACHE_TIMEOUT)
+        finally:
+            cache.delete(lock_key)
+        return html
+
+    # Another request is rebuilding this wall, wait for its result:
+    deadline = time.time() + settings.WALL_CACHE_LOCK_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        html = cache.get(key)
+        if html is not None:
+            return html
+        if cache.get(lock_key) is None:
+            # The rebuild finished without publishing (eg: it failed), stop waiting:
+            break
+
+    # The rebuild is taking too long (or failed), render it ourselves:
+    return build()
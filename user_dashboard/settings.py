@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 
 import os
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -19,8 +20,8 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/1.11/howto/deployment/checklist/
 
-# SECURITY WARNING: keep the secret key used in production secret!
-SECRET_KEY = 'l!_jl(egyot*-+b7z^5i_s3_tcrs25$k%0-3@z#c7s_)zr$o7)'
+# SECURITY WARNING: keep the secret key used in production secret! Set `DASHBOARD_SECRET_KEY` outside development:
+SECRET_KEY = os.environ.get('DASHBOARD_SECRET_KEY') or 'l!_jl(egyot*-+b7z^5i_s3_tcrs25$k%0-3@z#c7s_)zr$o7)'
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
@@ -31,7 +32,7 @@ ALLOWED_HOSTS = ['192.168.1.12', 'localhost']
 # Application definition
 
 INSTALLED_APPS = [
-    'apps.dashboard', # adds our `dashboard` application
+    'apps.dashboard.apps.DashboardConfig', # adds our `dashboard` application
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -41,23 +42,38 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'apps.dashboard.log.RequestLogMiddleware', # request correlation ids and timing (first, to time everything below)
+    'apps.dashboard.perf.PerfMiddleware', # SQL and template timing of sampled requests, `Server-Timing` header, `/debug/perf`
+    'apps.dashboard.assets.StaticAssetMiddleware', # built asset bundles, precompressed, cached for good
+    'apps.dashboard.routers.ReplicaRoutingMiddleware', # read replica routing and read-your-writes pinning (before anything reads)
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'apps.dashboard.middleware.SessionUserMiddleware', # attaches `request.logged_in_user`
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
 ROOT_URLCONF = 'user_dashboard.urls'
 
+# Templates are read from app `templates/` directories. Outside development they are compiled once per
+# process and kept by the cached loader; with DEBUG on, edits show up on the next request (compare the two
+# with `python manage.py template_benchmark`):
+
+DASHBOARD_TEMPLATE_LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'apps.dashboard.perf.TimedDjangoTemplates', # Django templates, with renders timed for `/debug/perf`
+        'NAME': 'django', # the alias Django's own backend has
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
+            'loaders': DASHBOARD_TEMPLATE_LOADERS if DEBUG else [('django.template.loaders.cached.Loader', DASHBOARD_TEMPLATE_LOADERS)],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -78,9 +94,37 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # Keep connections open between requests (seconds), so each worker thread reuses its connection:
+        'CONN_MAX_AGE': int(os.environ.get('DASHBOARD_CONN_MAX_AGE', 60)),
     }
 }
 
+# Read replicas: comma separated SQLite files kept in step with the primary by `python manage.py sync_replicas`
+# (a stand-in for real replication), eg: DASHBOARD_READ_REPLICAS=replica1.sqlite3,replica2.sqlite3.
+# GET requests read from a random replica; writes, and clients that wrote recently, use the primary
+# (see `apps/dashboard/routers.py`):
+
+READ_REPLICAS = []
+for number, path in enumerate([path.strip() for path in os.environ.get('DASHBOARD_READ_REPLICAS', '').split(',') if path.strip()], 1):
+    alias = 'replica_{}'.format(number)
+    DATABASES[alias] = dict(DATABASES['default'], NAME=os.path.join(BASE_DIR, path), TEST={'MIRROR': 'default'})
+    READ_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['apps.dashboard.routers.ReadReplicaRouter']
+
+READ_REPLICA_PIN_SECONDS = 10 # clients read from the primary this long after writing (longer than the replication lag)
+
+# PRAGMAs applied to every new SQLite connection (see `apps/dashboard/database.py`), in order:
+
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'WAL'), # readers no longer block the writer (or each other), and the writer does not block readers
+    ('synchronous', 'NORMAL'), # durable with WAL except for the last commits on power loss; no fsync per commit
+    ('busy_timeout', 5000), # milliseconds a writer waits for the lock before "database is locked"
+    ('mmap_size', 268435456), # read the database through a 256 MiB memory map
+    ('cache_size', -65536), # page cache per connection, in KiB when negative (64 MiB)
+    ('temp_store', 'MEMORY'), # temporary tables and sort files in memory
+]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
@@ -119,3 +163,207 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.11/howto/static-files/
 
 STATIC_URL = '/static/'
+
+# Static asset bundles, built by `python manage.py build_assets` into `ASSET_ROOT` (see `apps/dashboard/assets.py`).
+# Templates load them with `{% asset_tags %}`; until they are built, the sources are loaded one by one:
+
+ASSET_ROOT = os.path.join(BASE_DIR, 'assets')
+ASSET_BUNDLES = {
+    'dashboard/css/vendor.css': ['dashboard/bower_components/bootstrap/dist/css/bootstrap.min.css'],
+    'dashboard/css/style.css': ['dashboard/css/style.css'],
+    'dashboard/js/vendor.js': ['dashboard/bower_components/jquery/dist/jquery.min.js', 'dashboard/bower_components/bootstrap/dist/js/bootstrap.min.js'],
+    'dashboard/js/show_user.js': ['dashboard/js/show_user.js'],
+    'dashboard/js/admin_dashboard.js': ['dashboard/js/admin_dashboard.js'],
+}
+# Files of earlier builds stay served for pages that still point at them; `python manage.py prune_assets` deletes
+# those no build has produced for this long:
+ASSET_KEEP_DAYS = 7
+
+# Let `runserver` find built assets too (in production `StaticAssetMiddleware` serves them, precompressed):
+STATICFILES_DIRS = [ASSET_ROOT] if os.path.isdir(ASSET_ROOT) else []
+
+
+# Dashboard user directory pagination
+# Users per page on `/dashboard` and `/dashboard/admin` (overridable with `?per_page=`, up to the max):
+
+DASHBOARD_PAGE_SIZE = 25
+DASHBOARD_MAX_PAGE_SIZE = 100
+
+# Users read per query while streaming `/users/export`:
+
+DASHBOARD_EXPORT_CHUNK_SIZE = 2000
+
+# Best matches kept per `/users/search` query, ranked before the cut (bounds paging through very broad searches):
+
+DASHBOARD_SEARCH_MAX_CANDIDATES = 10000
+
+
+# Password hashing pool (see `apps/dashboard/hashing.py`)
+# bcrypt runs on a fixed number of threads behind a bounded queue, so slow hashes cannot tie up every request worker:
+
+PASSWORD_HASH_ROUNDS = 14
+PASSWORD_HASH_WORKERS = 2
+PASSWORD_HASH_QUEUE_SIZE = 8
+PASSWORD_HASH_TIMEOUT = 10 # seconds
+
+
+# Sessions and flash messages
+# https://docs.djangoproject.com/en/1.11/topics/http/sessions/#configuring-the-session-engine
+# Sessions live in the session table by default. Choose another store with `DASHBOARD_SESSION_STORE`:
+# - `db` - Django's default, a session table read on every request.
+# - `cached_db` - Database writes, cache reads; needs a shared cache (see `CACHES`) when running several processes.
+# - `cache` - Cache only; also needs a shared cache.
+# - `signed_cookies` - No server storage, but anyone holding `SECRET_KEY` can sign any session (eg: an admin's
+#   `user_id`), and logging out cannot revoke a copied cookie. Only allowed with `DASHBOARD_SECRET_KEY` set.
+# Run `python manage.py purge_sessions` to remove expired rows when using `db` or `cached_db`.
+
+SESSION_STORES = {
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+    'cache': 'django.contrib.sessions.backends.cache',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'db': 'django.contrib.sessions.backends.db',
+}
+DASHBOARD_SESSION_STORE = os.environ.get('DASHBOARD_SESSION_STORE', 'db')
+if DASHBOARD_SESSION_STORE == 'signed_cookies' and not os.environ.get('DASHBOARD_SECRET_KEY'):
+    # The committed key is public, so cookies signed with it could be forged:
+    raise ImproperlyConfigured("DASHBOARD_SESSION_STORE=signed_cookies needs a private DASHBOARD_SECRET_KEY.")
+SESSION_ENGINE = SESSION_STORES[DASHBOARD_SESSION_STORE]
+
+# Flash messages (including the custom `LOGIN_ERR`, `REG_ERR` and `INDEX_MSG` levels in `apps/dashboard/views.py`)
+# are kept in a cookie, falling back to the session only if they outgrow it (`fallback`).
+# `DASHBOARD_MESSAGE_STORE=session` keeps them in the session instead:
+
+MESSAGE_STORES = {
+    'fallback': 'django.contrib.messages.storage.fallback.FallbackStorage',
+    'cookie': 'django.contrib.messages.storage.cookie.CookieStorage',
+    'session': 'django.contrib.messages.storage.session.SessionStorage',
+}
+DASHBOARD_MESSAGE_STORE = os.environ.get('DASHBOARD_MESSAGE_STORE', 'fallback')
+MESSAGE_STORAGE = MESSAGE_STORES[DASHBOARD_MESSAGE_STORE]
+
+
+# Login throttling (see `apps/dashboard/throttle.py`)
+# Sign in attempts are limited per client IP and per email before any password is hashed.
+# Use the `cache` backend (with a shared cache) to limit across several worker processes:
+
+LOGIN_THROTTLE_BACKEND = os.environ.get('DASHBOARD_LOGIN_THROTTLE', 'local')
+LOGIN_THROTTLE_PER_IP = {'burst': 20, 'per_minute': 10}
+LOGIN_THROTTLE_PER_EMAIL = {'burst': 5, 'per_minute': 2}
+LOGIN_THROTTLE_MAX_KEYS = 100000
+LOGIN_THROTTLE_TRUST_X_FORWARDED_FOR = False
+
+
+# Logged in user cache (see `apps/dashboard/user_cache.py`)
+# Process-local LRU of session users, invalidated through the shared cache (see `CACHES`); set the size to 0
+# to load the user from the database on every request:
+
+SESSION_USER_CACHE_SIZE = 1000
+SESSION_USER_CACHE_TTL = 60 # seconds
+
+
+# Cache
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+# Holds logged in user and message wall versions, and rendered message walls. It must be shared by
+# every process (web workers and management commands, eg: `importdata`), or their invalidations
+# never reach the others. In production use memcached (`MemcachedCache`) or a database cache table
+# (`DatabaseCache`, after `python manage.py createcachetable`). The file-based cache in
+# `DASHBOARD_CACHE_DIR` is only the zero-setup default for development: it lists its whole directory
+# on every `set()` to decide whether to cull, which gets slow as entries pile up.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('DASHBOARD_CACHE_DIR') or os.path.join(BASE_DIR, 'cache'),
+        'OPTIONS': {
+            # Culling drops a third of the entries once this is reached; evicted versions only cost a reload:
+            'MAX_ENTRIES': 100000,
+        },
+    }
+}
+
+# Backends only the process that wrote to them can read:
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+if SESSION_USER_CACHE_SIZE > 0 and CACHES['default']['BACKEND'] in PROCESS_LOCAL_CACHES:
+    # Other processes would keep acting with a changed (eg: demoted or deleted) user's cached rights:
+    raise ImproperlyConfigured("SESSION_USER_CACHE_SIZE needs a shared cache backend in CACHES, or 0.")
+
+# Rendered message walls (see `apps/dashboard/wall_cache.py`):
+
+WALL_CACHE_TIMEOUT = 60 # seconds
+WALL_CACHE_LOCK_TIMEOUT = 5 # seconds
+
+# Messages per page of a message wall (the newest page is the one cached):
+
+WALL_PAGE_SIZE = 20
+
+# Message archive (see `MessageManager.archive()` in `apps/dashboard/models.py`)
+# `python manage.py archive_messages` moves messages older than this, with their comments, out of the hot
+# tables; walls read them back on deep pages. Archived messages can no longer be commented on:
+
+MESSAGE_ARCHIVE_AFTER_DAYS = 365
+MESSAGE_ARCHIVE_BATCH_SIZE = 500 # messages per transaction (at most 999, SQLite's query parameter limit)
+
+# Live message wall updates (see `apps/dashboard/pubsub.py`)
+# Show pages long-poll `/users/show/<id>/live`, which waits for new posts. Each waiting poll holds a
+# worker thread, so run threaded workers and keep `LIVE_MAX_WAITERS` below their thread count.
+# With several worker processes, set `DASHBOARD_LIVE_SOCKET_DIR` to a directory they all share, so a post
+# on one wakes waiting polls on every other (without it they pick the post up when their poll times out):
+
+LIVE_POLL_TIMEOUT = 25 # seconds, below common proxy read timeouts
+LIVE_MAX_WAITERS = 20 # per process
+LIVE_SOCKET_DIR = os.environ.get('DASHBOARD_LIVE_SOCKET_DIR') or None
+
+# Background user removal (see `apps/dashboard/deletion.py`)
+# Deleted users are hidden at once; their messages and comments are then deleted a chunk per short
+# transaction, by a thread in the web process (unless turned off) or `python manage.py process_deletions`:
+
+USER_DELETION_CHUNK_SIZE = 500 # rows per transaction (SQLite allows 999 query parameters)
+USER_DELETION_PAUSE = 0.05 # seconds between chunks, leaving room for other writers
+USER_DELETION_LEASE_SECONDS = 60 # a job left by a crashed worker is picked up after this
+USER_DELETION_THREAD = True
+
+
+# Request timing (see `apps/dashboard/perf.py`)
+# A share of requests is measured: SQL query count and time, template render time and total time, sent to admins
+# in a `Server-Timing` header and kept per URL pattern for the rolling percentiles on `/debug/perf` (admins only).
+# Set `DASHBOARD_PERF_SAMPLE_RATE` between 0 (off) and 1 (every request):
+
+PERF_SAMPLE_RATE = float(os.environ.get('DASHBOARD_PERF_SAMPLE_RATE', 1.0 if DEBUG else 0.1))
+PERF_WINDOW = 1000 # samples kept per URL pattern
+PERF_SERVER_TIMING_PUBLIC = False # send `Server-Timing` to every client (it shows how each request was handled)
+
+
+# Logging
+# https://docs.djangoproject.com/en/1.11/topics/logging/
+# Dashboard events are written as JSON lines by a background thread (see `apps/dashboard/log.py`).
+# Set `DASHBOARD_LOG_LEVEL=WARNING` in production to drop per-request chatter.
+
+DASHBOARD_LOG_LEVEL = os.environ.get('DASHBOARD_LOG_LEVEL', 'INFO')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {
+            '()': 'apps.dashboard.log.JsonFormatter',
+        },
+    },
+    'handlers': {
+        'queue': {
+            'class': 'apps.dashboard.log.QueueStreamHandler',
+            'formatter': 'json',
+            'stream': 'ext://sys.stdout',
+            'queue_size': 10000,
+        },
+    },
+    'loggers': {
+        'apps.dashboard': {
+            'handlers': ['queue'],
+            'level': DASHBOARD_LOG_LEVEL,
+            'propagate': False,
+        },
+    },
+}